@@ -1,32 +1,1846 @@
+import abc
+import asyncio
+import atexit
+import collections
+import contextlib
+import gzip
+import http
 import requests
-import streamlit as st
+import requests.adapters
 import concurrent.futures
+import copy
 import threading
 import time
-import collections
 import datetime as dt
+import json
+import hashlib
+import math
+import os
+import sqlite3
+import uuid
+import zlib
 
+try:
+    import fcntl # POSIX only: used to share the rate budget between processes
+except ImportError:
+    fcntl = None
+
+import api_models
 import config
+import data_utils
+
+# --- Rate Limiting (spécifique à ce client API) ---
+class RateLimiter:
+    """
+    Limiteur de débit à seau de jetons (token bucket), partagé par toutes les requêtes du processus.
+    Le seau se remplit de `rate` jetons par seconde jusqu'à `burst` jetons. Chaque requête réserve un jeton
+    sous le verrou : si le seau est vide, la réservation est prise à découvert et fixe l'instant où la requête
+    pourra partir. L'attente se fait ensuite hors du verrou, de sorte qu'un thread qui dort ne bloque
+    pas les réservations des autres.
+    Le débit peut être modifié en cours de route (set_rate) et tout le pool suspendu (pause), par exemple
+    pendant la durée d'un en-tête Retry-After.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.burst = float(burst)
+        self._default_rate = float(rate)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self._initial_state(clock())
+
+    def _initial_state(self, now):
+        return {"tokens": self.burst, "updated_at": now, "rate": self._default_rate, "paused_until": 0.0}
+
+    def _update_state(self, update):
+        """Applique update(state, now) à l'état du seau sous le verrou et retourne son résultat."""
+        with self._lock:
+            return update(self._state, self._clock())
+
+    def _take_token(self, state, now):
+        """
+        Remplit le seau jusqu'à l'instant d'envoi possible (fin de pause éventuelle) puis en retire un jeton.
+        Returns:
+            float: Délai d'attente en secondes avant d'envoyer la requête.
+        """
+        send_at = max(now, state["paused_until"])
+        tokens = min(self.burst, state["tokens"] + max(0.0, send_at - state["updated_at"]) * state["rate"]) - 1
+        state["tokens"], state["updated_at"] = tokens, send_at
+        return (send_at - now) + (0.0 if tokens >= 0 else -tokens / state["rate"])
+
+    @property
+    def rate(self):
+        """Débit courant, en requêtes par seconde."""
+        return self._update_state(lambda state, now: state["rate"])
+
+    def update_rate(self, compute_rate):
+        """
+        Remplace le débit par compute_rate(débit courant), en une seule mise à jour de l'état.
+        Les jetons déjà accumulés sont comptés à l'ancien débit. Retourne le nouveau débit.
+        """
+        def update(state, now):
+            send_at = max(now, state["paused_until"])
+            if send_at > state["updated_at"]:
+                state["tokens"] = min(self.burst, state["tokens"] + (send_at - state["updated_at"]) * state["rate"])
+                state["updated_at"] = send_at
+            state["rate"] = float(compute_rate(state["rate"]))
+            return state["rate"]
+        return self._update_state(update)
+
+    def set_rate(self, rate):
+        """Fixe le débit, en requêtes par seconde."""
+        return self.update_rate(lambda current_rate: rate)
+
+    def pause(self, duration):
+        """Suspend toutes les réservations pendant `duration` secondes (une pause plus longue en cours est conservée)."""
+        def update(state, now):
+            state["paused_until"] = max(state["paused_until"], now + duration)
+        self._update_state(update)
+
+    def reserve(self):
+        """Réserve un jeton et retourne le délai (en secondes) à attendre avant d'envoyer la requête."""
+        return self._update_state(self._take_token)
+
+    def try_reserve(self):
+        """Réserve un jeton seulement s'il est disponible immédiatement (hors pause). Retourne True si c'est le cas."""
+        def update(state, now):
+            if state["paused_until"] > now:
+                return False
+            tokens = min(self.burst, state["tokens"] + max(0.0, now - state["updated_at"]) * state["rate"])
+            if tokens < 1:
+                return False
+            state["tokens"], state["updated_at"] = tokens - 1, max(now, state["updated_at"])
+            return True
+        return self._update_state(update)
+
+    def acquire(self, cancel_event=None):
+        """
+        Bloque le thread courant jusqu'à ce que sa requête puisse partir. Retourne le délai attendu.
+        Si cancel_event est fourni, l'attente est écourtée dès qu'il est positionné.
+        """
+        wait_time = self.reserve()
+        if wait_time > 0:
+            if cancel_event is not None:
+                cancel_event.wait(wait_time)
+            else:
+                time.sleep(wait_time)
+        return wait_time
+
+    def reset(self):
+        """Remet le seau plein au débit initial (utile pour les tests ; une recherche ne doit pas l'appeler)."""
+        with self._lock:
+            self._state = self._initial_state(self._clock())
+
+
+class FileRateLimiter(RateLimiter):
+    """
+    Seau de jetons dont l'état (jetons, horodatage, débit, pause) est stocké dans un fichier verrouillé
+    par fcntl.flock. Tous les processus et sessions Streamlit de la machine qui utilisent le même fichier
+    partagent ainsi un seul budget de débit, la limite de l'API s'appliquant par adresse IP cliente.
+    Le verrou fichier n'est tenu que le temps de la mise à jour ; l'attente se fait hors verrou.
+    """
+
+    def __init__(self, rate, burst=1, state_file=None, clock=time.time):
+        # Horloge murale : contrairement à time.monotonic, elle a la même origine pour tous les processus.
+        super().__init__(rate, burst=burst, clock=clock)
+        self.state_file = state_file or config.RATE_LIMIT_STATE_FILE
+
+    def _update_state(self, update):
+        with self._lock: # Serialises the threads of this process before taking the file lock
+            fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = self._clock()
+                state = self._initial_state(now)
+                try:
+                    stored_state = json.loads(os.read(fd, 4096) or b"{}")
+                    state.update({key: float(stored_state[key]) for key in ("tokens", "updated_at")})
+                    # Optional keys: state files written before adaptive rate control lack them
+                    state.update({key: float(stored_state[key]) for key in ("rate", "paused_until") if key in stored_state})
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    pass # Missing or corrupt state: start from a full bucket
+                result = update(state, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, json.dumps(state).encode("utf-8"))
+                return result
+            finally:
+                os.close(fd) # Also releases the flock
+
+    def reset(self):
+        with self._lock:
+            try:
+                os.remove(self.state_file)
+            except FileNotFoundError:
+                pass
+
+
+def _build_rate_limiter():
+    """Crée le limiteur selon config.RATE_LIMIT_BACKEND ("file" : partagé entre processus, "memory" : par processus)."""
+    if config.RATE_LIMIT_BACKEND == "file" and fcntl is not None:
+        return FileRateLimiter(config.MAX_REQUESTS_PER_SECOND, burst=config.RATE_LIMIT_BURST)
+    # fcntl n'existe pas sous Windows : repli sur un budget propre au processus.
+    return RateLimiter(config.MAX_REQUESTS_PER_SECOND, burst=config.RATE_LIMIT_BURST)
+
+
+# Budget de débit unique : il n'est pas remis à zéro entre deux recherches, pour que des recherches
+# rapprochées ou simultanées (autres sessions, autres processus) ne dépassent pas ensemble la limite de l'API.
+rate_limiter = _build_rate_limiter()
+
+
+class AdaptiveRateController:
+    """
+    Contrôle AIMD (additive increase, multiplicative decrease) du débit d'un RateLimiter.
+    - Chaque réponse réussie (2xx ou 3xx) augmente le débit de increase_step req/s par seconde de trafic
+      (soit increase_step / débit par réponse), jusqu'à max_rate.
+    - Un 429, un 5xx, un timeout ou une latence supérieure à latency_spike_factor fois la moyenne mobile, multiplie le débit
+      par decrease_factor, au plus une fois par decrease_cooldown secondes : les réponses des requêtes
+      déjà en vol au moment de la saturation ne divisent pas le débit plusieurs fois.
+    - Un 429 suspend aussi tout le pool (RateLimiter.pause) pendant la durée Retry-After.
+    Le débit atteint est enregistré dans state_file (save) et sert de point de départ aux recherches suivantes.
+    """
+
+    LATENCY_EWMA_ALPHA = 0.2
+    LATENCY_WARMUP_SAMPLES = 10 # Responses needed before a latency spike is trusted
+
+    def __init__(self, limiter, min_rate=None, max_rate=None, increase_step=None, decrease_factor=None,
+                 latency_spike_factor=None, decrease_cooldown=None, state_file=None, clock=time.monotonic):
+        self.limiter = limiter
+        self.min_rate = float(min_rate if min_rate is not None else config.ADAPTIVE_RATE_MIN)
+        self.max_rate = float(max_rate if max_rate is not None else config.ADAPTIVE_RATE_MAX)
+        self.increase_step = increase_step if increase_step is not None else config.ADAPTIVE_RATE_INCREASE_STEP
+        self.decrease_factor = decrease_factor if decrease_factor is not None else config.ADAPTIVE_RATE_DECREASE_FACTOR
+        self.latency_spike_factor = latency_spike_factor if latency_spike_factor is not None else config.ADAPTIVE_RATE_LATENCY_SPIKE_FACTOR
+        self.decrease_cooldown = decrease_cooldown if decrease_cooldown is not None else config.ADAPTIVE_RATE_DECREASE_COOLDOWN
+        self.state_file = state_file
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latency_ewma = None
+        self._latency_samples = 0
+        self._last_decrease_at = None
+        self.throttled_responses = 0 # Counters, for diagnostics
+        self.latency_spikes = 0
+        self.server_errors = 0
+
+    def _clamp(self, rate):
+        return min(self.max_rate, max(self.min_rate, rate))
+
+    def load(self):
+        """Reprend le débit enregistré par une recherche précédente, s'il existe. Retourne le débit appliqué ou None."""
+        if not self.state_file:
+            return None
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                saved_rate = float(json.load(f)["rate"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None # No usable saved rate: keep the configured default
+        rate = self._clamp(saved_rate)
+        self.limiter.set_rate(rate)
+        return rate
+
+    def save(self):
+        """Enregistre le débit courant (écriture atomique) pour les recherches suivantes."""
+        if not self.state_file:
+            return
+        tmp_path = f"{self.state_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"rate": self.limiter.rate, "saved_at": time.time()}, f)
+            os.replace(tmp_path, self.state_file)
+        except OSError:
+            pass # Persisting the rate is an optimisation: never fail a search because of it
+
+    def _decrease(self, now):
+        # Caller holds self._lock
+        if self._last_decrease_at is not None and now - self._last_decrease_at < self.decrease_cooldown:
+            return
+        self._last_decrease_at = now
+        self.limiter.update_rate(lambda current_rate: self._clamp(current_rate * self.decrease_factor))
+
+    def on_success(self, latency):
+        """Réponse réussie de l'API (statut 2xx ou 3xx) en `latency` secondes."""
+        with self._lock:
+            now = self._clock()
+            is_spike = (
+                self._latency_samples >= self.LATENCY_WARMUP_SAMPLES
+                and latency > self.latency_spike_factor * self._latency_ewma
+            )
+            if is_spike:
+                self.latency_spikes += 1
+                self._decrease(now)
+                return # A spike is not folded into the average, so that it keeps its reference value
+            self._latency_samples += 1
+            if self._latency_ewma is None:
+                self._latency_ewma = latency
+            else:
+                self._latency_ewma += self.LATENCY_EWMA_ALPHA * (latency - self._latency_ewma)
+            self.limiter.update_rate(lambda current_rate: self._clamp(current_rate + self.increase_step / current_rate))
+
+    def on_timeout(self):
+        """Requête expirée : traitée comme un pic de latence."""
+        with self._lock:
+            self.latency_spikes += 1
+            self._decrease(self._clock())
+
+    def on_server_error(self):
+        """Réponse 5xx : l'API est en difficulté, le débit est réduit comme sur un timeout."""
+        with self._lock:
+            self.server_errors += 1
+            self._decrease(self._clock())
+
+    def on_throttled(self, retry_after):
+        """Réponse 429 : réduit le débit et suspend tout le pool pendant retry_after secondes."""
+        with self._lock:
+            self.throttled_responses += 1
+            self._decrease(self._clock())
+        self.limiter.pause(retry_after)
+
+
+def _build_rate_controller(limiter):
+    controller = AdaptiveRateController(limiter, state_file=config.ADAPTIVE_RATE_STATE_FILE)
+    controller.load()
+    return controller
+
+
+# Contrôleur du débit de rate_limiter, alimenté par chaque réponse de l'API.
+rate_controller = _build_rate_controller(rate_limiter)
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Requête refusée sans être envoyée : le disjoncteur est ouvert (API en panne ou très dégradée)."""
+
+
+class CircuitBreaker:
+    """
+    Disjoncteur partagé par toutes les requêtes de l'API (pages 1, pages suivantes, sondes de comptage).
+    - Fermé : les requêtes passent ; chaque réponse est comptée comme succès ou échec (timeout, erreur réseau,
+      statut 5xx ; un 429 est un succès, géré par le contrôleur de débit) sur les window dernières réponses.
+    - Ouvert dès que la proportion d'échecs atteint error_rate (sur au moins min_calls réponses) : les requêtes
+      échouent aussitôt (CircuitOpenError), sans attente de débit ni relances, pendant open_seconds.
+    - Semi-ouvert ensuite : une seule requête d'essai à la fois, identifiée par le jeton que retourne
+      allow_request ; son succès referme le disjoncteur, son échec le rouvre pour open_seconds. Les réponses
+      tardives des requêtes envoyées avant l'ouverture sont ignorées.
+    """
+
+    def __init__(self, window=None, min_calls=None, error_rate=None, open_seconds=None, clock=time.monotonic):
+        self.min_calls = min_calls if min_calls is not None else config.CIRCUIT_BREAKER_MIN_CALLS
+        self.error_rate = error_rate if error_rate is not None else config.CIRCUIT_BREAKER_ERROR_RATE
+        self.open_seconds = open_seconds if open_seconds is not None else config.CIRCUIT_BREAKER_OPEN_SECONDS
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window if window is not None else config.CIRCUIT_BREAKER_WINDOW)
+        self._opened_at = None # None while closed
+        self._probe = None # Token of the half-open probe in flight
+        self.openings = 0 # Counters, for diagnostics
+        self.rejected_requests = 0
+
+    def _current_state(self, now):
+        # Caller holds self._lock
+        if self._opened_at is None:
+            return "closed"
+        return "open" if now - self._opened_at < self.open_seconds else "half_open"
+
+    def _open(self, now):
+        # Caller holds self._lock
+        self._opened_at = now
+        self._probe = None
+        self._outcomes.clear()
+        self.openings += 1
 
-# --- Ressources partagées pour le Rate Limiting (spécifiques à ce client API) ---
-request_timestamps = collections.deque()
-rate_limit_lock = threading.Lock()
+    @property
+    def state(self):
+        """"closed", "open" ou "half_open"."""
+        with self._lock:
+            return self._current_state(self._clock())
+
+    def retry_in(self):
+        """Secondes avant la prochaine requête d'essai (0 si le disjoncteur n'est pas ouvert)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - self._clock())
+
+    def allow_request(self):
+        """
+        Indique si une requête peut partir.
+        Returns:
+            False si la requête est refusée ; sinon un jeton à transmettre à record (ou release_probe) :
+            True disjoncteur fermé, un objet unique pour la requête d'essai en semi-ouvert.
+        """
+        with self._lock:
+            state = self._current_state(self._clock())
+            if state == "closed":
+                return True
+            if state == "half_open" and self._probe is None:
+                self._probe = object()
+                return self._probe
+            self.rejected_requests += 1
+            return False
+
+    def release_probe(self, token):
+        """Requête autorisée puis abandonnée avant l'envoi (recherche annulée) : l'essai reste disponible."""
+        with self._lock:
+            if token is self._probe:
+                self._probe = None
+
+    def record(self, success, token=True):
+        """Issue d'une requête envoyée avec le jeton token (voir allow_request)."""
+        with self._lock:
+            now = self._clock()
+            state = self._current_state(now)
+            if state == "open":
+                return # Late answers of requests sent before the opening neither close nor extend it
+            if state == "half_open":
+                if token is not self._probe:
+                    return # Only the probe decides: other answers were sent before the opening
+                if success:
+                    self._opened_at = None # Probe answered: the API is back
+                    self._probe = None
+                else:
+                    self._open(now)
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures >= self.error_rate * len(self._outcomes):
+                self._open(now)
+
+    def status(self):
+        """État courant, délai avant l'essai suivant et compteurs, pour l'affichage."""
+        return {"state": self.state, "retry_in": round(self.retry_in(), 1), "openings": self.openings, "rejected_requests": self.rejected_requests}
+
+
+def _build_circuit_breaker():
+    return CircuitBreaker() if config.CIRCUIT_BREAKER_ENABLED else None
+
+
+# Disjoncteur commun à toutes les recherches du processus (None si config.CIRCUIT_BREAKER_ENABLED est False).
+circuit_breaker = _build_circuit_breaker()
 
 # Constant for batching codes (commune or postal) per API call
 MAX_CODES_PER_API_CALL = 5 # Adjustable, API doc says "liste de valeurs séparées par des virgules"
 
+
+# --- Client HTTP (sessions keep-alive) ---
+class ApiHttpClient:
+    """
+    Client HTTP pour l'API recherche-entreprises.
+    Une seule requests.Session est partagée par tous les threads de travail : son pool de connexions
+    (urllib3, thread-safe) garde jusqu'à pool_size connexions TCP/TLS ouvertes, réutilisées d'une page,
+    d'un lot et d'une recherche à l'autre au lieu d'être renégociées à chaque appel de requests.get.
+    La session vit aussi longtemps que le client, indépendamment des pools de threads des recherches.
+    """
+
+    def __init__(self, pool_size=None):
+        # pool_size: nombre de connexions conservées par hôte, à aligner sur le nombre de requêtes en vol.
+        self.pool_size = pool_size or config.HTTP_POOL_SIZE
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _create_session(self):
+        session = requests.Session()
+        # max_retries=0: les relances (429, timeouts) sont gérées par fetch_page_with_retry.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def session(self):
+        """Retourne la session partagée, créée à la première utilisation."""
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        """Effectue un GET via la session partagée (même signature que requests.get)."""
+        return self.session.get(url, params=params, headers=headers, timeout=timeout)
+
+    def close(self):
+        """Ferme la session et toutes ses connexions ; une nouvelle session sera créée au prochain appel."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+# Client partagé par toutes les fonctions de ce module, fermé à l'arrêt du processus.
+http_client = ApiHttpClient()
+atexit.register(http_client.close)
+
+# --- Cache disque des pages /search ---
+# Parameters whose comma-separated values form an unordered set
+_MULTI_VALUE_PARAMS = frozenset({
+    "activite_principale", "section_activite_principale", "tranche_effectif_salarie",
+    "code_postal", "code_commune", "include",
+})
+
+
+def canonical_request_key(url, params):
+    """
+    Clé d'une requête GET, indépendante de l'ordre des paramètres et des valeurs multiples : les valeurs
+    séparées par des virgules (sections et codes NAF, tranches d'effectifs, codes postaux ou communes) sont triées.
+    """
+    canonical_params = []
+    for name, value in sorted((params or {}).items()):
+        value = str(value)
+        if name in _MULTI_VALUE_PARAMS:
+            value = ",".join(sorted(v.strip() for v in value.split(",") if v.strip()))
+        canonical_params.append([name, value])
+    canonical = json.dumps([url, canonical_params], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _SqliteStore(abc.ABC):
+    """Base des stockages SQLite de ce module : une connexion partagée par les threads, protégée par un verrou."""
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @abc.abstractmethod
+    def _create_schema(self, connection):
+        """Crée les tables et index du stockage (à la première connexion)."""
+
+    def _connect(self):
+        # Caller holds self._lock
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL") # Readers of other processes do not block writers
+            self._create_schema(connection)
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class PageCache(_SqliteStore):
+    """
+    Cache SQLite des pages de l'API /search, partagé par les threads, les sessions et les processus.
+    - Clé : canonical_request_key(url, params), page comprise. Deux recherches qui ne diffèrent que par
+      l'ordre de leurs codes partagent leurs pages.
+    - Les entrées plus anciennes que ttl_seconds sont ignorées puis supprimées.
+    - Au-delà de max_bytes de corps compressés, les pages les moins récemment lues sont évincées (LRU).
+    - Les corps JSON sont compressés par zlib.
+    Une erreur SQLite n'interrompt jamais une recherche : la page est alors simplement demandée à l'API.
+    """
+
+    def __init__(self, path, ttl_seconds, max_bytes, clock=time.time):
+        super().__init__(path, clock=clock)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0 # Counters, for diagnostics
+        self.misses = 0
+
+    def _create_schema(self, connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " key TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL,"
+            " stored_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+
+    def get(self, url, params, stale_ok=False):
+        """
+        Retourne la page (JSON décodé) en cache pour (url, params), ou None si absente ou expirée.
+        stale_ok: une page expirée est retournée (et conservée) plutôt que supprimée, quand l'API est indisponible.
+        """
+        key = canonical_request_key(url, params)
+        with self._lock:
+            try:
+                connection = self._connect()
+                now = self._clock()
+                row = connection.execute("SELECT body, stored_at FROM pages WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] > self.ttl_seconds and not stale_ok:
+                    connection.execute("DELETE FROM pages WHERE key = ?", (key,))
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                connection.execute("UPDATE pages SET last_access = ? WHERE key = ?", (now, key))
+                data = api_models.decode_page(zlib.decompress(row[0]))
+            except (sqlite3.Error, zlib.error, ValueError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+
+    def put(self, url, params, data):
+        """Enregistre la page data pour (url, params), puis évince les pages les moins récemment lues si besoin."""
+        key = canonical_request_key(url, params)
+        body = zlib.compress(api_models.dumps(data))
+        with self._lock:
+            try:
+                connection = self._connect()
+                now = self._clock()
+                connection.execute(
+                    "INSERT OR REPLACE INTO pages (key, body, size, stored_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, body, len(body), now, now),
+                )
+                self._evict(connection)
+            except sqlite3.Error:
+                pass
+
+    def _evict(self, connection):
+        # Caller holds self._lock
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        # Evict down to 90 % of the cap so that the next puts do not evict one page each
+        excess = total_size - int(self.max_bytes * 0.9)
+        evicted_keys = []
+        for key, size in connection.execute("SELECT key, size FROM pages ORDER BY last_access"):
+            evicted_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM pages WHERE key = ?", evicted_keys)
+
+    def clear(self):
+        """Vide le cache."""
+        with self._lock:
+            try:
+                self._connect().execute("DELETE FROM pages")
+            except sqlite3.Error:
+                pass
+
+
+def _build_page_cache():
+    """Crée le cache de pages selon config.PAGE_CACHE_ENABLED (None si désactivé)."""
+    if not config.PAGE_CACHE_ENABLED:
+        return None
+    return PageCache(config.PAGE_CACHE_FILE, config.PAGE_CACHE_TTL_SECONDS, config.PAGE_CACHE_MAX_BYTES)
+
+
+page_cache = _build_page_cache()
+if page_cache is not None:
+    atexit.register(page_cache.close)
+
+
+class ResultCountStore(_SqliteStore):
+    """
+    Nombres de résultats (total_results) connus par requête, indépendamment de la pagination.
+    Alimenté par les sondes de comptage et par les lots entièrement récupérés, il permet au planificateur
+    de lots (plan_localisation_batches) de regrouper les codes sans nouvelle requête.
+    Les comptes plus anciens que ttl_seconds sont ignorés.
+    """
+
+    # Parameters that change the page layout but not the set of matching entreprises
+    PAGING_PARAMS = frozenset({"page", "per_page", "include", "limite_matching_etablissements", "minimal"})
+
+    def __init__(self, path, ttl_seconds, clock=time.time):
+        super().__init__(path, clock=clock)
+        self.ttl_seconds = ttl_seconds
+
+    def _create_schema(self, connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS result_counts ("
+            " key TEXT PRIMARY KEY, total_results INTEGER NOT NULL, stored_at REAL NOT NULL)"
+        )
+
+    @classmethod
+    def query_key(cls, url, params):
+        return canonical_request_key(url, {name: value for name, value in params.items() if name not in cls.PAGING_PARAMS})
+
+    def get_many(self, url, params_list):
+        """Retourne le compte connu de chaque requête de params_list (None si inconnu ou expiré)."""
+        keys = [self.query_key(url, params) for params in params_list]
+        with self._lock:
+            try:
+                connection = self._connect()
+                min_stored_at = self._clock() - self.ttl_seconds
+                known_counts = {}
+                for start in range(0, len(keys), 500): # Stay under SQLite's bound parameter limit
+                    key_chunk = keys[start:start + 500]
+                    known_counts.update(connection.execute(
+                        f"SELECT key, total_results FROM result_counts WHERE stored_at >= ? AND key IN ({','.join('?' * len(key_chunk))})",
+                        [min_stored_at, *key_chunk],
+                    ).fetchall())
+            except sqlite3.Error:
+                return [None] * len(keys)
+        return [known_counts.get(key) for key in keys]
+
+    def put_many(self, url, params_and_counts):
+        """Enregistre les comptes d'une liste de couples (params, total_results)."""
+        now = self._clock()
+        rows = [(self.query_key(url, params), int(count), now) for params, count in params_and_counts]
+        with self._lock:
+            try:
+                self._connect().executemany(
+                    "INSERT OR REPLACE INTO result_counts (key, total_results, stored_at) VALUES (?, ?, ?)", rows
+                )
+            except sqlite3.Error:
+                pass
+
+
+def _build_result_count_store():
+    """Crée le stockage des comptes selon config.RESULT_COUNT_STORE_ENABLED (None si désactivé)."""
+    if not config.RESULT_COUNT_STORE_ENABLED:
+        return None
+    return ResultCountStore(config.PAGE_CACHE_FILE, config.RESULT_COUNT_TTL_SECONDS)
+
+
+result_count_store = _build_result_count_store()
+if result_count_store is not None:
+    atexit.register(result_count_store.close)
+
+
+class SearchJobStore(_SqliteStore):
+    """
+    Recherches persistées sur disque (jobs) : chaque job enregistre ses paramètres, son plan de lots et
+    chaque page récupérée avec succès, rattachée à sa requête (paramètres sans pagination) et à son numéro.
+    Relancer la même recherche (mêmes codes, critères et mode) reprend le dernier job interrompu ou incomplet de
+    moins de max_age_seconds : seules les pages manquantes sont demandées à l'API, les autres sont relues sur
+    disque. Un job en cours n'est jamais repris : deux recherches identiques simultanées ont chacune le leur.
+    Une erreur SQLite n'interrompt jamais une recherche : la page concernée sera simplement redemandée.
+    """
+
+    def __init__(self, path, max_age_seconds, clock=time.time):
+        super().__init__(path, clock=clock)
+        self.max_age_seconds = max_age_seconds
+
+    def _create_schema(self, connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS search_jobs ("
+            " job_id TEXT PRIMARY KEY, plan_key TEXT NOT NULL, plan TEXT NOT NULL, status TEXT NOT NULL,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS search_jobs_plan_key ON search_jobs (plan_key)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS search_job_pages ("
+            " job_id TEXT NOT NULL, query_key TEXT NOT NULL, page INTEGER NOT NULL, body BLOB NOT NULL,"
+            " PRIMARY KEY (job_id, query_key, page))"
+        )
+
+    @classmethod
+    def plan_key(cls, plan):
+        """Clé d'un plan de recherche (voir open) : deux recherches identiques partagent la même clé."""
+        plan_params = dict(plan["api_params"], force_full_fetch=bool(plan["force_full_fetch"]))
+        localisation_key = _code_param_key(plan["code_type"])
+        if localisation_key is not None: # A geographic search has its point and radius in api_params
+            plan_params[localisation_key] = ",".join(plan["localisation_codes"])
+        return canonical_request_key(plan["url"], plan_params)
+
+    def open(self, plan):
+        """
+        Retourne le dernier job de même plan à reprendre (statut "interrupted" ou "incomplete"), réclamé
+        atomiquement (il passe à "running", y compris vis-à-vis des autres processus), ou un nouveau job.
+        plan contient url, api_params (paramètres /search de base), localisation_codes, code_type et
+        force_full_fetch ; le plan de lots ("batches") est ajouté par la recherche.
+        """
+        plan_key = self.plan_key(plan)
+        with self._lock:
+            try:
+                connection = self._connect()
+                now = self._clock()
+                self._purge(connection, now)
+                row = connection.execute(
+                    "SELECT job_id, plan FROM search_jobs WHERE plan_key = ? AND status IN ('interrupted', 'incomplete')"
+                    " ORDER BY updated_at DESC LIMIT 1", (plan_key,)
+                ).fetchone()
+                # Claimed only if no other process resumed it in between
+                if row is not None and connection.execute(
+                    "UPDATE search_jobs SET status = 'running', updated_at = ? WHERE job_id = ? AND status IN ('interrupted', 'incomplete')",
+                    (now, row[0]),
+                ).rowcount == 1:
+                    return SearchJob(self, row[0], json.loads(row[1]), resumed=True)
+                job = SearchJob(self, uuid.uuid4().hex, dict(plan, batches=None))
+                connection.execute(
+                    "INSERT INTO search_jobs (job_id, plan_key, plan, status, created_at, updated_at) VALUES (?, ?, ?, 'running', ?, ?)",
+                    (job.job_id, plan_key, json.dumps(job.plan, ensure_ascii=False), now, now),
+                )
+                return job
+            except sqlite3.Error:
+                return SearchJob(self, uuid.uuid4().hex, dict(plan, batches=None)) # Not persisted, but the search runs
+
+    def _previous_batches(self, job):
+        """Plan de lots du dernier autre job de même plan (quel que soit son statut), ou None."""
+        with self._lock:
+            try:
+                rows = self._connect().execute(
+                    "SELECT plan FROM search_jobs WHERE plan_key = ? AND job_id != ? ORDER BY updated_at DESC",
+                    (self.plan_key(job.plan), job.job_id),
+                ).fetchall()
+            except sqlite3.Error:
+                return None
+        for (plan,) in rows:
+            batches = json.loads(plan).get("batches")
+            if batches is not None:
+                return batches
+        return None
+
+    def _purge(self, connection, now):
+        # Caller holds self._lock. Pages of jobs too old to be resumed are deleted with them.
+        expired_job_ids = connection.execute(
+            "SELECT job_id FROM search_jobs WHERE updated_at < ?", (now - self.max_age_seconds,)
+        ).fetchall()
+        if expired_job_ids:
+            connection.executemany("DELETE FROM search_job_pages WHERE job_id = ?", expired_job_ids)
+            connection.executemany("DELETE FROM search_jobs WHERE job_id = ?", expired_job_ids)
+
+    def _update(self, job, status=None):
+        with self._lock:
+            try:
+                self._connect().execute(
+                    "UPDATE search_jobs SET plan = ?, status = COALESCE(?, status), updated_at = ? WHERE job_id = ?",
+                    (json.dumps(job.plan, ensure_ascii=False), status, self._clock(), job.job_id),
+                )
+            except sqlite3.Error:
+                pass
+
+    def _put_page(self, job_id, query_key, page, data):
+        body = zlib.compress(api_models.dumps(data))
+        with self._lock:
+            try:
+                self._connect().execute(
+                    "INSERT OR REPLACE INTO search_job_pages (job_id, query_key, page, body) VALUES (?, ?, ?, ?)",
+                    (job_id, query_key, page, body),
+                )
+            except sqlite3.Error:
+                pass
+
+    def _get_page(self, job_id, query_key, page):
+        with self._lock:
+            try:
+                row = self._connect().execute(
+                    "SELECT body FROM search_job_pages WHERE job_id = ? AND query_key = ? AND page = ?", (job_id, query_key, page)
+                ).fetchone()
+                return api_models.decode_page(zlib.decompress(row[0])) if row is not None else None
+            except (sqlite3.Error, zlib.error, ValueError):
+                return None
+
+    def _page_keys(self, job_id):
+        with self._lock:
+            try:
+                return self._connect().execute(
+                    "SELECT query_key, page FROM search_job_pages WHERE job_id = ?", (job_id,)
+                ).fetchall()
+            except sqlite3.Error:
+                return []
+
+    def _pages(self, job_id):
+        with self._lock:
+            try:
+                rows = self._connect().execute(
+                    "SELECT query_key, page, body FROM search_job_pages WHERE job_id = ? ORDER BY rowid", (job_id,)
+                ).fetchall()
+            except sqlite3.Error:
+                return []
+        pages = []
+        for query_key, page, body in rows:
+            try:
+                pages.append((query_key, page, api_models.decode_page(zlib.decompress(body))))
+            except (zlib.error, ValueError):
+                continue # A corrupt page is skipped, like in _get_page
+        return pages
+
+
+class SearchJob:
+    """
+    Une recherche persistée par SearchJobStore (voir SearchJobStore.open) : l'ordonnanceur relit les pages
+    déjà enregistrées (stored_page) et enregistre les nouvelles (record_page).
+    Statut : "running", puis "completed" (toutes les pages récupérées), "incomplete" (des pages ont échoué)
+    ou "interrupted" (arrêt anticipé ou abandon par l'appelant) ; seuls les jobs "completed" ne sont pas repris.
+    """
+
+    def __init__(self, store, job_id, plan, resumed=False):
+        self.store = store
+        self.job_id = job_id
+        self.plan = plan
+        self.resumed = resumed
+
+    def _query_key(self, query_params):
+        return ResultCountStore.query_key(self.plan["url"], query_params)
+
+    def previous_batches(self):
+        """Lots de la dernière recherche identique (voir SearchJobStore._previous_batches), ou None."""
+        return self.store._previous_batches(self)
+
+    def set_batches(self, batches):
+        self.plan["batches"] = [list(batch) for batch in batches]
+        self.store._update(self)
+
+    def finish(self, status):
+        self.store._update(self, status=status)
+
+    def stored_page(self, query_params, page):
+        """Retourne le résultat enregistré de la page (tel que retourné par fetch_first_page / fetch_page_with_retry), ou None."""
+        return self.store._get_page(self.job_id, self._query_key(query_params), page)
+
+    def record_page(self, query_params, page, result):
+        self.store._put_page(self.job_id, self._query_key(query_params), page, result)
+
+    def completed_pages(self):
+        """Ensemble des couples (clé de requête, numéro de page) déjà enregistrés."""
+        return {(query_key, page) for query_key, page in self.store._page_keys(self.job_id)}
+
+    def results(self):
+        """Reconstruit la liste fusionnée des entreprises (par SIREN) à partir des pages enregistrées."""
+        merge_index = SirenMergeIndex()
+        for _, _, result in self.store._pages(self.job_id):
+            merge_index.add_many(result.get("results") or [])
+        return merge_index.entreprises()
+
+
+def _build_search_job_store():
+    """Crée le stockage des jobs de recherche selon config.SEARCH_JOBS_ENABLED (None si désactivé)."""
+    if not config.SEARCH_JOBS_ENABLED:
+        return None
+    return SearchJobStore(config.SEARCH_JOBS_FILE, config.SEARCH_JOBS_MAX_AGE_SECONDS)
+
+
+search_job_store = _build_search_job_store()
+if search_job_store is not None:
+    atexit.register(search_job_store.close)
+
+
+# --- Regroupement des requêtes identiques en vol (single-flight) ---
+class SingleFlight:
+    """
+    Regroupe les appels simultanés d'une même clé : le premier appelant (meneur) exécute la fonction,
+    les suivants attendent son résultat au lieu d'envoyer une requête identique. Chaque suiveur reçoit
+    une copie profonde du résultat, les recherches modifiant les objets "entreprise" lors de la déduplication.
+    Si le meneur est annulé (résultat None), un suiveur non annulé prend le relais et exécute la fonction.
+    """
+
+    FOLLOWER_POLL_INTERVAL = 0.1 # Seconds between two checks of a follower's cancel_event
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.upstream_calls = 0 # Counters: calls executed, and identical calls saved by waiting
+        self.saved_calls = 0
+
+    def do(self, key, func, cancel_event=None):
+        """Exécute func() ou attend l'appel identique en cours. Retourne None si cancel_event est positionné pendant l'attente."""
+        while True:
+            with self._lock:
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = concurrent.futures.Future()
+                    self._in_flight[key] = future
+                    self.upstream_calls += 1
+                else:
+                    self.saved_calls += 1
+            if is_leader:
+                return self._lead(key, future, func)
+            while not future.done():
+                if _is_cancelled(cancel_event):
+                    return None
+                concurrent.futures.wait([future], timeout=self.FOLLOWER_POLL_INTERVAL)
+            result = future.result() # Re-raises the leader's exception
+            if result is not None:
+                return copy.deepcopy(result)
+            with self._lock:
+                self.saved_calls -= 1 # The leader was cancelled: nothing was saved, try again
+
+    def _lead(self, key, future, func):
+        try:
+            result = func()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+single_flight = SingleFlight()
+
+
+def request_stats():
+    """Compteurs d'appels à l'API économisés par le cache disque et le regroupement des requêtes identiques."""
+    return {
+        "cache_hits": page_cache.hits if page_cache is not None else 0,
+        "cache_misses": page_cache.misses if page_cache is not None else 0,
+        "upstream_calls": single_flight.upstream_calls,
+        "coalesced_calls_saved": single_flight.saved_calls,
+        "throttled_responses": rate_controller.throttled_responses,
+        "circuit_breaker": circuit_breaker.status() if circuit_breaker is not None else None,
+    }
+
+# --- Enregistrement et rejeu du trafic API (cassettes) ---
+class RecordingHttpClient:
+    """
+    Enveloppe d'un client HTTP (ApiHttpClient) qui enregistre chaque requête et sa réponse dans une cassette :
+    fichier JSON Lines compressé (gzip), un enregistrement par appel (url, paramètres, en-têtes de la requête,
+    statut, en-têtes et corps de la réponse, instant d'envoi et latence). Les timeouts sont enregistrés aussi.
+    """
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self.recorded = 0
+
+    def _write(self, record):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.recorded += 1
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        sent_at = time.monotonic()
+        record = {"offset": round(sent_at - self._started_at, 4), "url": url, "params": params or {}, "request_headers": headers or {}}
+        try:
+            response = self.inner.get(url, params=params, headers=headers, timeout=timeout)
+        except requests.exceptions.Timeout:
+            self._write(dict(record, elapsed=round(time.monotonic() - sent_at, 4), error="timeout"))
+            raise
+        self._write(dict(
+            record, elapsed=round(time.monotonic() - sent_at, 4), status=response.status_code,
+            headers=dict(response.headers), body=response.text,
+        ))
+        return response
+
+    def close_cassette(self):
+        """Termine la cassette sans fermer le client enveloppé."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def close(self):
+        self.close_cassette()
+        self.inner.close()
+
+
+class CassetteMiss(requests.exceptions.ConnectionError):
+    """Requête absente de la cassette rejouée (le client rejoué envoie une requête que l'original n'a pas faite)."""
+
+
+class ReplayHttpClient:
+    """
+    Client HTTP qui rejoue une cassette de RecordingHttpClient au lieu d'appeler l'API.
+    Les réponses sont retrouvées par requête (canonical_request_key) dans l'ordre d'enregistrement : un 429
+    suivi d'une relance réussie est rejoué tel quel. Une fois ses réponses épuisées, une requête reçoit
+    à nouveau la dernière ; une requête jamais enregistrée lève CassetteMiss.
+    timing="original" reproduit la latence enregistrée de chaque réponse (divisée par speed), "fast" répond
+    immédiatement.
+    """
+
+    def __init__(self, path, timing="original", speed=1.0):
+        if timing not in ("original", "fast"):
+            raise ValueError(f"timing inconnu : {timing}")
+        self.path = path
+        self.timing = timing
+        self.speed = speed
+        self._responses = {}
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self._responses.setdefault(canonical_request_key(record["url"], record["params"]), collections.deque()).append(record)
+        self._lock = threading.Lock()
+        self.replayed = 0
+        self.misses = 0
+
+    def _next_record(self, key):
+        with self._lock:
+            records = self._responses.get(key)
+            if not records:
+                self.misses += 1
+                return None
+            self.replayed += 1
+            return records.popleft() if len(records) > 1 else records[0]
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        record = self._next_record(canonical_request_key(url, params or {}))
+        if record is None:
+            raise CassetteMiss(f"Requête absente de la cassette {self.path} : {url} {params}")
+        if self.timing == "original":
+            delay = record["elapsed"] / self.speed
+            time.sleep(min(delay, timeout) if timeout and record.get("error") == "timeout" else delay)
+        if record.get("error") == "timeout":
+            raise requests.exceptions.Timeout(f"Timeout enregistré : {url}")
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.reason = http.HTTPStatus(record["status"]).phrase
+        response.headers = requests.structures.CaseInsensitiveDict(record["headers"])
+        response._content = record["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = requests.Request("GET", url, params=params).prepare().url
+        return response
+
+    def close(self):
+        pass
+
+
+# Débit du limiteur installé pendant un rejeu : assez grand pour ne jamais faire attendre une requête.
+_REPLAY_RATE = 1e9
+
+
+@contextlib.contextmanager
+def cassette(path, mode, timing="original", speed=1.0):
+    """
+    Enregistre (mode="record") ou rejoue (mode="replay") le trafic API des recherches lancées dans le bloc with.
+    Le cache disque des pages, les comptes stockés et les jobs de recherche sont écartés pendant le bloc :
+    une recherche enregistrée interroge réellement l'API pour chaque page, et son rejeu refait les mêmes requêtes.
+    Au rejeu, le débit n'est pas limité (le rythme est celui de timing) et le budget de débit partagé,
+    le contrôle AIMD et les latences de couverture sont remplacés le temps du bloc : un rejeu ne les consomme
+    ni ne les alimente.
+    Yields:
+        RecordingHttpClient or ReplayHttpClient: Le client installé (compteurs recorded, replayed, misses).
+    """
+    global http_client, page_cache, result_count_store, search_job_store
+    global rate_limiter, rate_controller, response_latencies
+    if mode == "record":
+        client = RecordingHttpClient(http_client, path)
+    elif mode == "replay":
+        client = ReplayHttpClient(path, timing=timing, speed=speed)
+    else:
+        raise ValueError(f"Mode de cassette inconnu : {mode}")
+    saved = (http_client, page_cache, result_count_store, search_job_store)
+    saved_pacing = (rate_limiter, rate_controller, response_latencies)
+    http_client, page_cache, result_count_store, search_job_store = client, None, None, None
+    if mode == "replay":
+        rate_limiter = RateLimiter(_REPLAY_RATE, burst=_REPLAY_RATE)
+        # min_rate == max_rate: replayed latencies and 429s never move the rate
+        rate_controller = AdaptiveRateController(rate_limiter, min_rate=_REPLAY_RATE, max_rate=_REPLAY_RATE)
+        response_latencies = LatencyWindow(config.HEDGE_LATENCY_WINDOW)
+    try:
+        yield client
+    finally:
+        http_client, page_cache, result_count_store, search_job_store = saved
+        rate_limiter, rate_controller, response_latencies = saved_pacing
+        if mode == "record":
+            client.close_cassette() # The shared session stays open
+
+
+# --- Latences des réponses et couverture des requêtes lentes (hedging) ---
+def _percentile(sorted_values, percent):
+    """Percentile (rang le plus proche) d'une liste triée non vide."""
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LatencyWindow:
+    """Latences des dernières réponses de l'API (fenêtre glissante de size valeurs), partagées par toutes les recherches."""
+
+    def __init__(self, size):
+        self._latencies = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percent, min_samples=1):
+        """Percentile des latences récentes, ou None s'il y en a moins de min_samples."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies or len(latencies) < min_samples:
+            return None
+        return _percentile(latencies, percent)
+
+
+class SearchLatencyStats:
+    """
+    Latences de queue d'une recherche : durée de chaque page (attente de débit, relances et doublons compris)
+    et nombre de requêtes couvertes par un doublon, dont celles où le doublon a répondu le premier.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.page_durations = []
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+
+    def record_page(self, duration):
+        with self._lock:
+            self.page_durations.append(duration)
+
+    def on_hedge(self, won):
+        with self._lock:
+            self.hedged_requests += 1
+            self.hedge_wins += int(won)
+
+    def summary(self):
+        """Percentiles p50, p95, p99 et maximum des durées de pages (secondes), et compteurs de doublons."""
+        with self._lock:
+            durations = sorted(self.page_durations)
+            summary = {"pages": len(durations), "hedged_requests": self.hedged_requests, "hedge_wins": self.hedge_wins}
+        for name, percent in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+            summary[name] = round(_percentile(durations, percent), 3) if durations else None
+        return summary
+
+
+# Latences récentes de l'API, qui fixent le délai de couverture (config.HEDGE_LATENCY_PERCENTILE).
+response_latencies = LatencyWindow(config.HEDGE_LATENCY_WINDOW)
+# Statistiques de la recherche servie par le thread courant (worker de l'ordonnanceur), pour attribuer les doublons.
+_search_context = threading.local()
+
+
+# --- Helpers partagés par les moteurs de recherche ---
+def _wait_for_rate_limit_slot(cancel_event=None):
+    """Bloque jusqu'à ce qu'une requête puisse partir sans dépasser le débit courant du limiteur."""
+    rate_limiter.acquire(cancel_event)
+
+
+def _send_api_request(url, params, headers, timeout, cancel_event=None):
+    """
+    Attend un créneau du limiteur, envoie le GET et transmet la latence de la réponse au contrôleur
+    de débit. Les 429 sont signalés par l'appelant (rate_controller.on_throttled), qui connaît le
+    délai de backoff de la requête.
+    Une requête plus lente que le délai de couverture (_hedge_delay) est doublée (_hedged_get).
+    Disjoncteur ouvert : CircuitOpenError est levée immédiatement, sans attendre de créneau.
+    Returns:
+        requests.Response or None: None si la recherche a été annulée pendant l'attente du créneau.
+    """
+    circuit_token = True
+    if circuit_breaker is not None:
+        circuit_token = circuit_breaker.allow_request()
+        if not circuit_token:
+            raise CircuitOpenError(f"API indisponible (disjoncteur ouvert) : requête non envoyée, nouvel essai dans {circuit_breaker.retry_in():.0f} s.")
+    _wait_for_rate_limit_slot(cancel_event)
+    if _is_cancelled(cancel_event):
+        if circuit_breaker is not None:
+            circuit_breaker.release_probe(circuit_token)
+        return None
+    hedge_delay = _hedge_delay()
+    if hedge_delay is None:
+        return _timed_get(url, params, headers, timeout, circuit_token)
+    return _hedged_get(url, params, headers, timeout, hedge_delay, cancel_event, circuit_token)
+
+
+def _timed_get(url, params, headers, timeout, circuit_token=True):
+    """
+    GET via le client partagé ; la latence d'une réponse réussie (2xx ou 3xx) est transmise au contrôleur de débit
+    et à response_latencies, un timeout ou une réponse 5xx réduit le débit (les 429 sont traités par l'appelant).
+    L'issue (timeout, toute autre erreur de requests, 5xx ou succès) est transmise au disjoncteur, avec le jeton
+    circuit_token de la requête (voir CircuitBreaker.allow_request).
+    """
+    sent_at = time.monotonic()
+    try:
+        response = http_client.get(url, params=params, headers=headers, timeout=timeout)
+    except requests.exceptions.Timeout:
+        rate_controller.on_timeout()
+        if circuit_breaker is not None:
+            circuit_breaker.record(False, circuit_token)
+        raise
+    except requests.exceptions.RequestException: # Network, chunked encoding, decoding, redirects...
+        if circuit_breaker is not None:
+            circuit_breaker.record(False, circuit_token)
+        raise
+    except BaseException: # Not an answer of the API: a half-open probe must not stay taken
+        if circuit_breaker is not None:
+            circuit_breaker.release_probe(circuit_token)
+        raise
+    if circuit_breaker is not None:
+        circuit_breaker.record(response.status_code < 500, circuit_token)
+    if response.status_code >= 500: # A fast error page must neither raise the rate nor shorten the hedge delay
+        rate_controller.on_server_error()
+    elif response.status_code < 400:
+        latency = time.monotonic() - sent_at
+        rate_controller.on_success(latency)
+        response_latencies.record(latency)
+    return response
+
+
+def _hedge_delay():
+    """Délai après lequel une requête sans réponse est doublée, ou None (couverture désactivée ou latences inconnues)."""
+    if not config.HEDGED_REQUESTS_ENABLED:
+        return None
+    delay = response_latencies.percentile(config.HEDGE_LATENCY_PERCENTILE, min_samples=config.HEDGE_MIN_SAMPLES)
+    return None if delay is None else max(delay, config.HEDGE_MIN_DELAY)
+
+
+# Pool shared by every hedged request: the caller must be free to return before a blocking GET ends
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.HEDGE_MAX_THREADS, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(config.HEDGE_MAX_THREADS)
+
+
+def _submit_hedge_request(get_args, admit=None):
+    """
+    Soumet _timed_get(*get_args) au pool des requêtes couvertes.
+    Returns:
+        concurrent.futures.Future or None: None (rien n'est envoyé) si aucun thread du pool n'est libre
+        ou si admit() refuse la requête.
+    """
+    if not _hedge_slots.acquire(blocking=False):
+        return None
+    if admit is not None and not admit():
+        _hedge_slots.release()
+        return None
+    future = _hedge_executor.submit(_timed_get, *get_args)
+    future.add_done_callback(lambda _: _hedge_slots.release())
+    return future
+
+
+def _admit_hedge():
+    # The duplicate is a request like any other: it needs the breaker's consent, and a half-open probe is never doubled
+    if circuit_breaker is not None:
+        token = circuit_breaker.allow_request()
+        if token is not True:
+            if token:
+                circuit_breaker.release_probe(token)
+            return False
+    return rate_limiter.try_reserve()
+
+
+def _hedged_get(url, params, headers, timeout, hedge_delay, cancel_event=None, circuit_token=True):
+    """
+    Envoie le GET et, sans réponse après hedge_delay secondes, un doublon s'il reste un jeton de débit disponible
+    immédiatement, un thread libre et que le disjoncteur est fermé. La première réponse exploitable (ni exception
+    ni 429) est retournée ; l'autre requête se termine en arrière-plan et sa réponse est ignorée. Si les deux
+    échouent, l'issue de la première est propagée.
+    """
+    primary = _submit_hedge_request((url, params, headers, timeout, circuit_token))
+    if primary is None: # Pool busy: sent without a duplicate
+        return _timed_get(url, params, headers, timeout, circuit_token)
+    done, _ = concurrent.futures.wait([primary], timeout=hedge_delay)
+    if done or _is_cancelled(cancel_event):
+        return primary.result() # Answered within the budget
+    hedge = _submit_hedge_request((url, params, headers, timeout), admit=_admit_hedge)
+    if hedge is None:
+        return primary.result() # No spare token, thread or breaker consent for a duplicate
+    search_stats = getattr(_search_context, "stats", None)
+    pending = [primary, hedge]
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in [f for f in pending if f in done]: # The primary wins a tie
+            pending.remove(future)
+            if future.exception() is None and future.result().status_code != 429:
+                if search_stats is not None:
+                    search_stats.on_hedge(won=future is hedge)
+                return future.result()
+    if search_stats is not None:
+        search_stats.on_hedge(won=False)
+    return primary.result()
+
+
+def _get_page_data(url, params, headers, timeout, cancel_event=None):
+    """
+    Point d'accès unique aux pages de l'API pour les deux récupérateurs de pages (page 1 et suivantes) :
+    la page est lue dans le cache disque si possible (même expirée si le disjoncteur est ouvert), sinon
+    demandée à l'API puis mise en cache.
+    Une requête identique déjà en vol (autre session, autre sous-recherche) n'est pas renvoyée :
+    l'appel attend son résultat (single_flight).
+    Les erreurs HTTP et réseau sont propagées (requests.exceptions) pour la logique de relance de l'appelant.
+    Returns:
+        dict or None: La page décodée (api_models.decode_page), ou None si la recherche a été annulée avant l'envoi.
+    """
+    if page_cache is not None:
+        # While the API is down, an expired page is better than none
+        stale_ok = circuit_breaker is not None and circuit_breaker.state == "open"
+        cached_data = page_cache.get(url, params, stale_ok=stale_ok)
+        if cached_data is not None:
+            return cached_data
+
+    def fetch_from_api():
+        response = _send_api_request(url, params, headers, timeout=timeout, cancel_event=cancel_event)
+        if response is None:
+            return None
+        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
+        try:
+            data = api_models.decode_page(response.content)
+        except ValueError as exc: # Reported like the other invalid responses by the retry logic
+            raise requests.exceptions.InvalidJSONError(f"Réponse JSON invalide : {exc}", response=response) from exc
+        if page_cache is not None:
+            page_cache.put(url, params, data)
+        return data
+
+    return single_flight.do(canonical_request_key(url, params), fetch_from_api, cancel_event=cancel_event)
+
+
+def _build_search_params(api_params_from_app):
+    """Complète les paramètres de l'application (NAF, effectifs) avec les paramètres fixes de /search."""
+    base_api_params_for_search = api_params_from_app.copy()
+    base_api_params_for_search.update({
+        'per_page': config.API_RESULTS_PER_PAGE,
+        'minimal': 'true',
+        'etat_administratif' : 'A',
+        'include' : 'matching_etablissements,finances',
+        'limite_matching_etablissements': config.API_MATCHING_ETABLISSEMENTS_LIMIT
+    })
+    return base_api_params_for_search
+
+
+def _code_param_key(code_type):
+    if code_type == "point":
+        return None # Geographic search (/near_point): the point and radius are query parameters, not codes
+    return "code_commune" if code_type == "commune" else "code_postal"
+
+
+def _near_point_search_params(latitude, longitude, radius_km, api_params_from_app):
+    """Paramètres /near_point : ceux de /search (voir _build_search_params) complétés du point et du rayon."""
+    base_api_params_for_search = _build_search_params(api_params_from_app)
+    base_api_params_for_search.update({"lat": f"{latitude:.6f}", "long": f"{longitude:.6f}", "radius": f"{radius_km:g}"})
+    return base_api_params_for_search
+
+
+def _single_code_params(base_params, code_type, code):
+    params = base_params.copy()
+    params[_code_param_key(code_type)] = code
+    return params
+
+
+def _naf_code_groups(params):
+    """
+    Découpe les codes NAF d'une requête (activite_principale) en groupes d'au plus config.MAX_NAF_CODES_PER_API_CALL
+    codes, pour que chaque URL reste de taille raisonnable. Les codes sont triés : une division reste groupée
+    autant que possible. Les groupes sont disjoints (une entreprise a un seul code NAF).
+    Returns:
+        list[dict]: Les paramètres de chaque groupe ([params] si la liste est assez courte).
+    """
+    naf_codes = sorted(_split_values(params.get("activite_principale")))
+    if len(naf_codes) <= config.MAX_NAF_CODES_PER_API_CALL:
+        return [params]
+    return [
+        dict(params, activite_principale=",".join(naf_codes[start:start + config.MAX_NAF_CODES_PER_API_CALL]))
+        for start in range(0, len(naf_codes), config.MAX_NAF_CODES_PER_API_CALL)
+    ]
+
+
+def _batch_query_params(base_params, localisation_code_batches, code_type):
+    """Paramètres des requêtes planifiées d'une recherche : une requête par lot de codes et par groupe de codes NAF."""
+    api_code_param_key = _code_param_key(code_type)
+    return [
+        dict(naf_group_params, **{api_code_param_key: ",".join(code_batch)})
+        for code_batch in localisation_code_batches
+        for naf_group_params in _naf_code_groups(base_params)
+    ]
+
+
+def _pages_for_results(total_results):
+    """Nombre de pages de config.API_RESULTS_PER_PAGE résultats (au moins une) pour total_results résultats."""
+    return max(1, -(-int(total_results) // config.API_RESULTS_PER_PAGE))
+
+
+def probe_result_counts(params_list, url=None, headers=None, use_stored_counts=True):
+    """
+    Sondes de comptage : estime le volume de chaque requête de params_list sans télécharger ses résultats.
+    Chaque sonde demande la plus petite page possible (per_page=1, sans établissements ni finances) ;
+    les sondes partent en parallèle sous le budget de débit commun. Les comptes obtenus sont enregistrés
+    dans result_count_store, et les comptes déjà connus (use_stored_counts) ne sont pas redemandés.
+    Args:
+        params_list (list[dict]): Paramètres /search des requêtes à sonder (pagination ignorée).
+    Returns:
+        list[dict or None]: Pour chaque requête, {"total_results", "total_pages"} (total_pages pour des pages
+                            de config.API_RESULTS_PER_PAGE résultats), ou None si la sonde a échoué.
+    """
+    url = url or f"{config.API_BASE_URL}/search"
+    headers = headers or {'accept': 'application/json'}
+    counts = [None] * len(params_list)
+    if use_stored_counts and result_count_store is not None:
+        counts = result_count_store.get_many(url, params_list)
+    unknown_indexes = [idx for idx, count in enumerate(counts) if count is None]
+
+    def probe(params):
+        probe_params = {name: value for name, value in params.items() if name not in ("include", "limite_matching_etablissements")}
+        probe_params.update({"per_page": 1, "minimal": "true"})
+        result = fetch_first_page(url, probe_params, headers, max_retries=config.MAX_RETRIES_ON_429)
+        return result["total_results"] if result["success"] else None
+
+    if unknown_indexes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(config.SEARCH_MAX_WORKERS, len(unknown_indexes))) as executor:
+            probed_counts = list(executor.map(probe, [params_list[idx] for idx in unknown_indexes]))
+        for idx, probed_count in zip(unknown_indexes, probed_counts):
+            counts[idx] = probed_count
+        if result_count_store is not None:
+            result_count_store.put_many(url, [
+                (params_list[idx], probed_count)
+                for idx, probed_count in zip(unknown_indexes, probed_counts) if probed_count is not None
+            ])
+    return [
+        None if count is None else {"total_results": count, "total_pages": _pages_for_results(count)}
+        for count in counts
+    ]
+
+
+def _pack_codes(codes, estimated_counts, capacity, max_codes_per_call):
+    """
+    Rangement "first fit decreasing" : chaque code, du plus dense au moins dense, rejoint le premier lot
+    où il tient (somme des comptes <= capacity, au plus max_codes_per_call codes), sinon ouvre un lot.
+    Un code plus grand que capacity reste seul dans son lot.
+    Returns:
+        list[list[str]]: Les lots, chacun dans l'ordre d'origine de ses codes, ordonnés par premier code.
+    """
+    bins = [] # [estimated load, [code indexes]]
+    for code_idx in sorted(range(len(codes)), key=lambda idx: -estimated_counts[idx]):
+        for code_bin in bins:
+            if code_bin[0] + estimated_counts[code_idx] <= capacity and len(code_bin[1]) < max_codes_per_call:
+                code_bin[0] += estimated_counts[code_idx]
+                code_bin[1].append(code_idx)
+                break
+        else:
+            bins.append([estimated_counts[code_idx], [code_idx]])
+    ordered_bins = sorted(sorted(code_bin[1]) for code_bin in bins)
+    return [[codes[code_idx] for code_idx in code_bin] for code_bin in ordered_bins]
+
+
+def estimate_search_cost(list_localisation_codes, api_params_from_app, code_type="commune", url=None, headers=None, probe_unknown=None):
+    """
+    Estime le coût d'une recherche avant de la lancer, et planifie ses lots de codes de localisation.
+    Le nombre de résultats de chaque code vient du stockage des comptes (recherches et sondes précédentes).
+    Les codes inconnus sont sondés (probe_result_counts) si probe_unknown (par défaut
+    config.BATCH_PLANNER_PROBE_UNKNOWN), ou si le stockage connaît déjà une partie des codes : une recherche
+    à froid n'envoie aucune sonde. Sinon, ils sont estimés de sorte qu'un lot en regroupe MAX_CODES_PER_API_CALL
+    (le découpage fixe historique) ; la page 1 de chaque lot donne son volume, un lot trop large est découpé
+    par l'ordonnanceur et les comptes par code des lots récupérés alimentent le stockage.
+    Returns:
+        dict: "batches" (lots de codes, voir plan_localisation_batches), "total_results_estimated" (borne haute,
+              codes connus uniquement), "unknown_codes" (codes sans compte), "requests_estimated" (pages à
+              télécharger, au moins une par lot) et "seconds_estimated" (au débit courant du limiteur).
+    """
+    url = url or f"{config.API_BASE_URL}/search"
+    base_params = _build_search_params(api_params_from_app)
+    if probe_unknown is None:
+        probe_unknown = config.BATCH_PLANNER_PROBE_UNKNOWN
+    # A long NAF code list is sent in several groups (_naf_code_groups): a code's count is the sum over its groups
+    naf_groups = _naf_code_groups(base_params)
+    single_code_params = [
+        _single_code_params(naf_group_params, code_type, code) for code in list_localisation_codes for naf_group_params in naf_groups
+    ]
+    if result_count_store is not None:
+        group_counts = result_count_store.get_many(url, single_code_params)
+    else:
+        group_counts = [None] * len(single_code_params)
+    # Probing a cold store would cost one request per code, more than the coarse batches it replaces
+    partially_known = any(count is not None for count in group_counts)
+    if None in group_counts and (probe_unknown or partially_known):
+        group_counts = [None if probe is None else probe["total_results"] for probe in probe_result_counts(single_code_params, url, headers)]
+    counts = []
+    for code_idx in range(len(list_localisation_codes)):
+        code_group_counts = group_counts[code_idx * len(naf_groups):(code_idx + 1) * len(naf_groups)]
+        counts.append(None if None in code_group_counts else sum(code_group_counts))
+
+    capacity = int(config.API_MAX_TOTAL_RESULTS * config.BATCH_PLANNER_FILL_RATIO)
+    unknown_code_estimate = capacity // MAX_CODES_PER_API_CALL
+    estimated_counts = [unknown_code_estimate if count is None else count for count in counts]
+    batches = _pack_codes(list_localisation_codes, estimated_counts, capacity, config.BATCH_PLANNER_MAX_CODES_PER_CALL)
+
+    known_counts = dict(zip(list_localisation_codes, counts))
+    requests_estimated = sum(
+        _pages_for_results(sum(known_counts[code] or 0 for code in batch)) for batch in batches
+    )
+    return {
+        "batches": batches,
+        "total_results_estimated": sum(count for count in counts if count is not None),
+        "unknown_codes": sum(1 for count in counts if count is None),
+        "requests_estimated": requests_estimated,
+        "seconds_estimated": requests_estimated / rate_limiter.rate,
+    }
+
+
+def format_search_estimate(search_estimate):
+    """Résumé de estimate_search_cost pour les messages de progression (vide sans estimation ou si aucun compte n'est connu)."""
+    if search_estimate is None or search_estimate["unknown_codes"] == len([code for batch in search_estimate["batches"] for code in batch]):
+        return ""
+    summary = (
+        f", ~{search_estimate['total_results_estimated']} résultats, ~{search_estimate['requests_estimated']} pages,"
+        f" ~{search_estimate['seconds_estimated']:.0f} s"
+    )
+    if search_estimate["unknown_codes"]:
+        summary += f" hors {search_estimate['unknown_codes']} codes sans estimation"
+    return summary
+
+
+def plan_localisation_batches(list_localisation_codes, base_params, code_type="commune", url=None, headers=None):
+    """
+    Planifie les lots de codes de localisation d'une recherche pour minimiser le nombre total de requêtes :
+    chaque appel coûte au moins une page, donc moins il y a de lots, moins il y a de pages, tant qu'aucun
+    lot ne dépasse config.API_MAX_PAGES (au-delà, ses résultats seraient tronqués).
+    Les comptes par code sont obtenus comme pour estimate_search_cost.
+    Returns:
+        list[list[str]]: Les lots de codes, dans l'ordre de la liste d'origine.
+    """
+    return estimate_search_cost(list_localisation_codes, base_params, code_type, url, headers)["batches"]
+
+
+def _split_values(param_value):
+    return [value.strip() for value in str(param_value or "").split(",") if value.strip()]
+
+
+def _halves(values):
+    middle = len(values) // 2
+    return [values[:middle], values[middle:]]
+
+
+def _naf_codes_for_section(section_letter):
+    data_utils.get_naf_lookup() # Loads NAF.csv on first use
+    return data_utils.get_codes_for_section(section_letter)
+
+
+def split_oversized_query(params, code_type="commune"):
+    """
+    Découpe en deux sous-requêtes disjointes une requête dont les résultats dépassent config.API_MAX_TOTAL_RESULTS.
+    Critère découpé, dans l'ordre : codes de localisation, sections NAF, divisions NAF (une section est remplacée
+    par la liste de ses codes NAF, d'après NAF.csv), codes NAF, puis tranches d'effectifs.
+    Chaque critère est coupé en deux moitiés : un nouveau découpage n'a lieu que si une moitié dépasse encore la limite.
+    Returns:
+        list[dict]: Les paramètres des sous-requêtes, ou une liste vide si la requête ne peut plus être découpée.
+    """
+    def split_on(param_key, value_groups):
+        return [dict(params, **{param_key: ",".join(values)}) for values in value_groups]
+
+    localisation_key = _code_param_key(code_type)
+    localisation_codes = _split_values(params.get(localisation_key))
+    if len(localisation_codes) > 1:
+        return split_on(localisation_key, _halves(localisation_codes))
+
+    sections = _split_values(params.get("section_activite_principale"))
+    if len(sections) > 1:
+        return split_on("section_activite_principale", _halves(sections))
+    if len(sections) == 1:
+        section_naf_codes = _naf_codes_for_section(sections[0])
+        if section_naf_codes:
+            params_by_codes = {name: value for name, value in params.items() if name != "section_activite_principale"}
+            params_by_codes["activite_principale"] = ",".join(section_naf_codes)
+            return split_oversized_query(params_by_codes, code_type)
+
+    naf_codes = _split_values(params.get("activite_principale"))
+    naf_codes_by_division = {}
+    for naf_code in naf_codes:
+        naf_codes_by_division.setdefault(naf_code[:2], []).append(naf_code)
+    divisions = list(naf_codes_by_division.values())
+    if len(divisions) > 1:
+        return split_on("activite_principale", [
+            [naf_code for division in division_half for naf_code in division] for division_half in _halves(divisions)
+        ])
+    if len(naf_codes) > 1:
+        return split_on("activite_principale", _halves(naf_codes))
+
+    effectif_tranches = _split_values(params.get("tranche_effectif_salarie"))
+    if len(effectif_tranches) > 1:
+        return split_on("tranche_effectif_salarie", _halves(effectif_tranches))
+    return []
+
+
+def _count_entreprises_per_code(entreprises, codes, code_type, counts=None):
+    """
+    Compte, pour chaque code de localisation de codes, les entreprises ayant un établissement correspondant
+    dans ce code. Les comptes s'ajoutent à counts s'il est fourni (comptage page par page).
+    """
+    counts = counts if counts is not None else dict.fromkeys(codes, 0)
+    etab_code_field = "commune" if code_type == "commune" else "code_postal"
+    for entreprise in entreprises:
+        for code in {etab.get(etab_code_field) for etab in entreprise.get("matching_etablissements") or []}:
+            if code in counts:
+                counts[code] += 1
+    return counts
+
+
+def _store_localisation_counts(url, query_params, code_type, counts_per_code):
+    """
+    Enregistre les comptes par code d'une requête entièrement récupérée (voir _count_entreprises_per_code) :
+    ces comptes gratuits alimentent le planificateur des recherches suivantes.
+    """
+    if result_count_store is None:
+        return
+    result_count_store.put_many(url, [
+        (_single_code_params(query_params, code_type, code), count) for code, count in counts_per_code.items()
+    ])
+
+
+class SirenMergeIndex:
+    """
+    Index de fusion des objets "entreprise" par SIREN, alimentable en ligne (page par page) : conserve une
+    entreprise fusionnée par SIREN et l'ensemble des SIRET déjà vus pour ce SIREN, si bien que chaque ajout
+    coûte O(nombre d'établissements ajoutés), quel que soit le nombre d'établissements déjà fusionnés.
+    Partagé par les recherches normales, en flux et décomposées.
+    """
+
+    def __init__(self, keep_entreprises=True):
+        """
+        Args:
+            keep_entreprises (bool): Si False, seuls les SIREN et SIRET vus sont conservés (suffisant pour
+                                     dédupliquer un flux, voir add()) ; entreprises() est alors vide.
+        """
+        self.keep_entreprises = keep_entreprises
+        self._entreprises_by_key = {} # siren (or a generated key when missing) -> merged entreprise, first-seen order
+        self._sirets_by_siren = {}
+        self._without_siren_count = 0
+
+    def __len__(self):
+        """Nombre d'entreprises uniques vues (SIREN distincts, plus les entreprises sans SIREN)."""
+        return len(self._sirets_by_siren) + self._without_siren_count
+
+    def add(self, entreprise):
+        """
+        Fusionne une entreprise dans l'index ; ses établissements sans SIRET ou déjà vus sont ignorés.
+        Returns:
+            dict | None: La part nouvelle de l'entreprise : elle-même pour un SIREN inconnu, une copie ne
+                         contenant que les nouveaux établissements pour un SIREN connu, None si rien n'est nouveau.
+        """
+        siren = entreprise.get("siren")
+        matching_etablissements = entreprise.get("matching_etablissements") or []
+        if not siren: # Rare for valid data: kept as is, under a unique key
+            self._without_siren_count += 1
+            if self.keep_entreprises:
+                self._entreprises_by_key[f"no_siren_{self._without_siren_count}"] = entreprise
+            return entreprise
+        seen_sirets = self._sirets_by_siren.get(siren)
+        if seen_sirets is None:
+            entreprise["matching_etablissements"] = matching_etablissements
+            self._sirets_by_siren[siren] = {etab.get("siret") for etab in matching_etablissements if etab.get("siret")}
+            if self.keep_entreprises:
+                # The merged object grows with later pages: store a copy of the list, not the caller's
+                self._entreprises_by_key[siren] = api_models.with_etablissements(entreprise, list(matching_etablissements))
+            return entreprise
+        new_etabs = []
+        for etab in matching_etablissements:
+            siret = etab.get("siret")
+            if siret and siret not in seen_sirets:
+                seen_sirets.add(siret)
+                new_etabs.append(etab)
+        if not new_etabs:
+            return None
+        if self.keep_entreprises:
+            self._entreprises_by_key[siren]["matching_etablissements"].extend(new_etabs)
+        return api_models.with_etablissements(entreprise, new_etabs)
+
+    def add_many(self, entreprises):
+        """Fusionne une liste d'entreprises (une page) et retourne la liste de leurs parts nouvelles (voir add())."""
+        new_parts = []
+        for entreprise in entreprises:
+            new_part = self.add(entreprise)
+            if new_part is not None:
+                new_parts.append(new_part)
+        return new_parts
+
+    def entreprises(self):
+        """Retourne les entreprises fusionnées, dans l'ordre de première apparition."""
+        return list(self._entreprises_by_key.values())
+
+
+def deduplicate_entreprises_by_siren(entreprises):
+    """
+    Déduplique les objets "entreprise" par SIREN en fusionnant leurs 'matching_etablissements'
+    (un établissement n'est ajouté qu'une fois par SIRET).
+    Returns:
+        list: Les entreprises uniques, dans l'ordre de première apparition.
+    """
+    merge_index = SirenMergeIndex()
+    merge_index.add_many(entreprises)
+    return merge_index.entreprises()
+
+
+def _retry_after_delay(response, current_retry_delay):
+    """
+    Durée d'attente avant de relancer une requête refusée en 429.
+    Utilise l'en-tête Retry-After (secondes ou date HTTP) s'il est présent, sinon le délai de backoff courant.
+    """
+    retry_after_header = response.headers.get("Retry-After")
+    wait_duration = current_retry_delay
+    header_used = False
+    if retry_after_header:
+        try: wait_duration = float(retry_after_header); header_used = True
+        except ValueError:
+            # Attempt to parse HTTP-date format for Retry-After
+            try:
+                retry_date = dt.datetime.strptime(retry_after_header, '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=dt.timezone.utc)
+                now_utc = dt.datetime.now(dt.timezone.utc)
+                wait_duration = (retry_date - now_utc).total_seconds()
+                if wait_duration < 0: wait_duration = 0
+                header_used = True
+            except ValueError: pass
+    return max(wait_duration + 0.1, current_retry_delay if not header_used else 0)
+
+
+def _is_cancelled(cancel_event):
+    return cancel_event is not None and cancel_event.is_set()
+
+
+def _sleep_before_retry(wait_duration, cancel_event):
+    """Attend avant une nouvelle tentative ; l'attente est écourtée si la recherche est annulée."""
+    if cancel_event is not None:
+        cancel_event.wait(wait_duration)
+    else:
+        time.sleep(wait_duration)
+
+
+# --- Événements de progression ---
+# Les moteurs de recherche n'affichent rien : ils signalent leur avancement par des événements (dictionnaires,
+# clé "type") passés à un rappel on_event(event) optionnel. Sans rappel, ils s'exécutent sans interface
+# (workers, benchmarks, traitements par lots) ; app.py passe l'adaptateur streamlit_progress.StreamlitSearchProgress.
+#   "search_planning" : codes_count, code_type
+#   "search_started"  : codes_count, code_type, total_batches, estimate (estimate_search_cost, None à la reprise),
+#                       resumed_pages (pages déjà enregistrées d'un job repris, sinon None)
+#   "query_started"   : label, params (page 1 d'un lot ou d'une sous-requête soumise)
+#   "page_fetched"    : label, page, success
+#   "progress"        : completed_queries, total_queries, completed_pages, total_pages, raw_results
+#   "throttled"       : page, retry_after (réponse 429 ; émis depuis les threads du pool)
+#   "error"           : level ("error" ou "warning"), message
+#   "search_finished" : outcome ("completed", "incomplete" si des pages ont échoué, "failed" si le premier lot
+#                       échoue, "too_large", "interrupted"), raw_results, latency (SearchLatencyStats.summary :
+#                       percentiles des durées de pages et requêtes doublées)
+#   "completion_started"  : entreprises (entreprises à la limite de limite_matching_etablissements, redemandées seules)
+#   "completion_finished" : entreprises, requests, failed_requests
+#   "results_merged"  : unique_entreprises
+#   "circuit"         : state ("closed", "open", "half_open"), retry_in (voir CircuitBreaker ; émis à chaque changement)
+def _emit(on_event, event_type, **fields):
+    if on_event is not None:
+        on_event(dict(fields, type=event_type))
+
+
+def _emit_circuit_change(on_event, last_state):
+    """Émet un événement "circuit" si l'état du disjoncteur diffère de last_state ; retourne l'état courant."""
+    if circuit_breaker is None:
+        return last_state
+    state = circuit_breaker.state
+    if state != last_state:
+        _emit(on_event, "circuit", state=state, retry_in=round(circuit_breaker.retry_in(), 1))
+    return state
+
+
 # --- Fonctions API ---
-def fetch_first_page(url, params, headers):
-    """Récupère la première page de résultats de l'API."""
+def fetch_first_page(url, params, headers, max_retries=0, cancel_event=None, on_event=None):
+    """
+    Récupère la première page de résultats de l'API.
+    Args:
+        max_retries (int): Nombre de nouvelles tentatives après un 429 ou un timeout (0 = un seul essai).
+        cancel_event (threading.Event): Si fourni et positionné, aucune nouvelle tentative n'est envoyée.
+        on_event (callable): Reçoit un événement "throttled" à chaque réponse 429.
+    """
     # Ensure 'page' parameter is set to 1 for the first page request.
     params_page1 = params.copy()
     params_page1['page'] = 1
     # print(f"{dt.datetime.now()} - DEBUG - Fetching first page. URL: {url}, Params: {params_page1}")
+    current_retry_delay = config.INITIAL_RETRY_DELAY
+    for attempt in range(max_retries + 1):
+        if _is_cancelled(cancel_event):
+            return {"success": False, "error_message": "Recherche annulée (page 1).", "cancelled": True}
+        result = _fetch_first_page_attempt(url, params_page1, headers, cancel_event)
+        retryable = result.pop("retryable", False)
+        throttled_response = result.pop("throttled_response", None)
+        if result["success"] or not retryable or attempt >= max_retries:
+            return result
+        if throttled_response is not None:
+            # Retry-After applies to the whole pool: the next attempt waits for it in the rate limiter
+            wait_duration = _retry_after_delay(throttled_response, current_retry_delay)
+            _emit(on_event, "throttled", page=1, retry_after=wait_duration)
+            rate_controller.on_throttled(wait_duration)
+        else:
+            _sleep_before_retry(current_retry_delay, cancel_event)
+        current_retry_delay *= 2
+    return result
+
+
+def _fetch_first_page_attempt(url, params_page1, headers, cancel_event=None):
+    """
+    Un seul essai de récupération de la page 1.
+    En cas d'échec relançable (429 ou timeout), le résultat porte 'retryable': True,
+    et la réponse 429 dans 'throttled_response' pour lire son en-tête Retry-After.
+    """
     try:
-        response = requests.get(url, params=params_page1, headers=headers, timeout=30)
-        # print(f"{dt.datetime.now()} - DEBUG - First page response status code: {response.status_code}")
-        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        data = response.json()
+        data = _get_page_data(url, params_page1, headers, timeout=30, cancel_event=cancel_event)
+        if data is None:
+            return {"success": False, "error_message": "Recherche annulée (page 1).", "cancelled": True}
         results_count = len(data.get('results', []))
         total_pages = data.get('total_pages', 1)
         total_results = data.get('total_results', results_count)
@@ -47,7 +1861,7 @@ def fetch_first_page(url, params, headers):
     except requests.exceptions.Timeout as e:
         error_msg = "Délai d'attente dépassé lors de la connexion à l'API (page 1)."
         # print(f"{dt.datetime.now()} - ERROR - First page fetch error: {error_msg} - {e}")
-        return {"success": False, "error_message": error_msg}
+        return {"success": False, "error_message": error_msg, "retryable": True}
     except requests.exceptions.HTTPError as e:
         error_message = f"Erreur API (page 1): {e.response.status_code} {e.response.reason}"
         try:
@@ -60,13 +1874,376 @@ def fetch_first_page(url, params, headers):
         except Exception:
              error_message += f"\nContenu brut (premiers 200 caractères): {e.response.text[:200]}..."
         # print(f"{dt.datetime.now()} - ERROR - First page fetch HTTPError: {error_message}")
+        if e.response.status_code == 429:
+            return {"success": False, "error_message": error_message, "retryable": True, "throttled_response": e.response}
         return {"success": False, "error_message": error_message}
     except requests.exceptions.RequestException as e:
         error_msg = f"Erreur réseau (page 1): {e}"
         # print(f"{dt.datetime.now()} - ERROR - First page fetch RequestException: {error_msg}")
         return {"success": False, "error_message": error_msg}
 
-def rechercher_entreprises_par_localisation_et_criteres(list_localisation_codes, api_params_from_app, force_full_fetch=False, code_type="commune"):
+def open_search_job(url, base_api_params_for_search, list_localisation_codes, force_full_fetch, code_type):
+    """
+    Ouvre le job persistant d'une recherche (voir SearchJobStore) : le dernier job inachevé de la même
+    recherche est repris. Retourne None si config.SEARCH_JOBS_ENABLED est False.
+    """
+    if search_job_store is None:
+        return None
+    return search_job_store.open({
+        "url": url,
+        "api_params": base_api_params_for_search,
+        "localisation_codes": list(list_localisation_codes),
+        "code_type": code_type,
+        "force_full_fetch": force_full_fetch,
+    })
+
+
+def _query_area_label(params, code_type):
+    """Zone d'une requête pour les messages d'erreur : ses codes de localisation, ou le point et le rayon."""
+    if code_type == "point":
+        return f"Rayon {params['radius']} km autour de {params['lat']}, {params['long']}"
+    return f"Codes {code_type}: {params[_code_param_key(code_type)][:30]}..."
+
+
+def _timed_page_fetch(latency_stats, fetch_function, *args, **kwargs):
+    """Exécute un récupérateur de page dans un worker en mesurant sa durée pour les latences de la recherche."""
+    _search_context.stats = latency_stats
+    started_at = time.monotonic()
+    try:
+        return fetch_function(*args, **kwargs)
+    finally:
+        latency_stats.record_page(time.monotonic() - started_at)
+        _search_context.stats = None
+
+
+_SEARCH_COMPLETED = object() # Return value of _iter_search_pages when the search ran to the end
+
+
+def _matching_limit(params):
+    return int(params.get("limite_matching_etablissements") or config.API_MATCHING_ETABLISSEMENTS_LIMIT)
+
+
+def _record_truncated_entreprises(entreprises, query_params, truncated_queries):
+    """Note (SIREN -> paramètres) les entreprises dont les établissements correspondants atteignent la limite de query_params."""
+    limit = _matching_limit(query_params)
+    for entreprise in entreprises:
+        if entreprise.get("siren") and len(entreprise.get("matching_etablissements") or []) >= limit:
+            truncated_queries.setdefault(entreprise["siren"], []).append(query_params)
+
+
+def _complete_truncated_entreprises(truncated_queries, code_type, url, headers, executor, latency_stats, cancel_event, on_event=None):
+    """
+    Complétion des grandes entreprises (config.COMPLETE_LARGE_ENTREPRISES), dernière étape de _iter_search_pages :
+    une entreprise dont les établissements correspondants ont atteint limite_matching_etablissements dans une requête
+    est redemandée seule (q=SIREN) sur la zone de cette requête. Une réponse encore à la limite est coupée en deux
+    moitiés de codes de localisation, jusqu'à ce que chaque appel reste sous la limite. Les appels passent par
+    fetch_first_page (limiteur de débit, cache des pages dont la clé contient le SIREN, disjoncteur) sur le pool
+    de la recherche.
+    Génère, à chaque retour d'appels, la liste des versions partielles des entreprises, à fusionner par SIREN.
+    Returns:
+        int: Nombre d'appels en échec (valeur de StopIteration).
+    """
+    api_code_param_key = _code_param_key(code_type)
+    future_to_query = {}
+    submitted_keys = set()
+    completed_calls = 0
+    failed_calls = 0
+
+    def submit(siren, params):
+        completion_params = {name: value for name, value in params.items() if name != "page"}
+        completion_params["q"] = siren
+        request_key = canonical_request_key(url, completion_params)
+        if request_key in submitted_keys: # Same company truncated in overlapping queries
+            return
+        submitted_keys.add(request_key)
+        future = executor.submit(
+            _timed_page_fetch, latency_stats, fetch_first_page, url, completion_params, headers,
+            max_retries=config.MAX_RETRIES_ON_429, cancel_event=cancel_event, on_event=on_event
+        )
+        future_to_query[future] = (siren, completion_params)
+
+    _emit(on_event, "completion_started", entreprises=len(truncated_queries))
+    for siren, queries in truncated_queries.items():
+        for query_params in queries:
+            submit(siren, query_params)
+
+    while future_to_query:
+        done_futures, _ = concurrent.futures.wait(future_to_query, return_when=concurrent.futures.FIRST_COMPLETED)
+        completed_entreprises = []
+        for future in done_futures:
+            siren, params = future_to_query.pop(future)
+            completed_calls += 1
+            try:
+                result_data = future.result()
+            except Exception as exc:
+                result_data = {"success": False, "error_message": str(exc)}
+            if not result_data["success"]:
+                failed_calls += 1
+                _emit(on_event, "error", level="warning", message=f"Complétion de l'entreprise {siren} : {result_data['error_message']}")
+                continue
+            # q is a full-text search: only the requested company is kept
+            entreprises = [entreprise for entreprise in result_data["results"] if entreprise.get("siren") == siren]
+            completed_entreprises.extend(entreprises)
+            limit = _matching_limit(params)
+            if not any(len(entreprise.get("matching_etablissements") or []) >= limit for entreprise in entreprises):
+                continue
+            localisation_codes = _split_values(params.get(api_code_param_key)) if api_code_param_key else []
+            if len(localisation_codes) > 1:
+                for codes_half in _halves(localisation_codes):
+                    submit(siren, dict(params, **{api_code_param_key: ",".join(codes_half)}))
+            else:
+                _emit(on_event, "error", level="warning", message=f"Entreprise {siren} : plus de {limit} établissements correspondants ({_query_area_label(params, code_type)}) ; seuls les {limit} premiers sont récupérés.")
+        if completed_entreprises:
+            yield completed_entreprises
+    _emit(on_event, "completion_finished", entreprises=len(truncated_queries), requests=completed_calls, failed_requests=failed_calls)
+    return failed_calls
+
+
+def _iter_search_pages(list_localisation_codes, base_api_params_for_search, force_full_fetch, code_type, url, headers, on_event=None, job=None,
+                       max_workers=None, cancel_event=None):
+    """
+    Cœur de l'ordonnanceur global, partagé par rechercher_entreprises_par_localisation_et_criteres,
+    iter_entreprises_par_localisation et rechercher_entreprises_async : génère la liste brute des entreprises
+    de chaque page dès son arrivée, avec max_workers workers (par défaut config.SEARCH_MAX_WORKERS).
+    Fermer le générateur avant la fin abandonne les pages restantes et attend les requêtes en vol ; lever
+    cancel_event (threading.Event, facultatif) depuis un autre thread arrête aussitôt l'envoi des requêtes.
+    Avec un job (SearchJob), le plan de lots et les pages déjà enregistrés sont réutilisés (un nouveau job reprend
+    les lots de la dernière recherche identique si le cache de pages est actif, pour en relire les pages), et chaque page
+    récupérée est enregistrée. L'avancement est signalé par des événements on_event (voir _emit).
+    Returns:
+        _SEARCH_COMPLETED (valeur de StopIteration), ou la valeur d'arrêt anticipé de la recherche : None si
+        le premier lot échoue, dictionnaire "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN" si un lot est trop large.
+    """
+    # Planned queries: one per batch of localisation codes and per group of NAF codes (_batch_query_params)
+    if code_type != "point" and job is not None and job.plan.get("batches") is None and page_cache is not None:
+        # An identical earlier search keeps its batches: re-packing them with the per-code counts it stored
+        # would change every page cache key and download its cached pages again
+        previous_batches = job.previous_batches()
+        if previous_batches is not None:
+            job.set_batches(previous_batches)
+    if code_type == "point":
+        # Geographic search: a single area, only a long NAF code list makes several queries
+        params_per_batch = _naf_code_groups(base_api_params_for_search)
+        total_batches = len(params_per_batch)
+        resumed_pages = len(job.completed_pages()) if job is not None else 0
+        _emit(on_event, "search_started", codes_count=0, code_type=code_type, total_batches=total_batches, estimate=None,
+              resumed_pages=resumed_pages or None)
+    elif job is not None and job.plan.get("batches") is not None:
+        # A resumed job keeps its batches: its stored pages belong to these queries
+        params_per_batch = _batch_query_params(base_api_params_for_search, job.plan["batches"], code_type)
+        total_batches = len(params_per_batch)
+        _emit(on_event, "search_started", codes_count=len(list_localisation_codes), code_type=code_type,
+              total_batches=total_batches, estimate=None, resumed_pages=len(job.completed_pages()) if job.resumed else None)
+    else:
+        _emit(on_event, "search_planning", codes_count=len(list_localisation_codes), code_type=code_type)
+        search_estimate = estimate_search_cost(list_localisation_codes, base_api_params_for_search, code_type, url, headers)
+        if job is not None:
+            job.set_batches(search_estimate["batches"])
+        params_per_batch = _batch_query_params(base_api_params_for_search, search_estimate["batches"], code_type)
+        total_batches = len(params_per_batch)
+        _emit(on_event, "search_started", codes_count=len(list_localisation_codes), code_type=code_type,
+              total_batches=total_batches, estimate=search_estimate, resumed_pages=None)
+
+    api_code_param_key = _code_param_key(code_type)
+
+    # === Ordonnanceur global ===
+    # Une seule file de tâches (requête, page) servie par un nombre fixe de workers pour toute la recherche :
+    # les pages 1 de tous les lots sont soumises d'emblée, et les pages suivantes d'une requête sont ajoutées
+    # dès que sa page 1 revient. Le budget de débit reste ainsi utilisé jusqu'à la fin de la recherche,
+    # sans attendre la page la plus lente de chaque lot avant de passer au suivant.
+    # Les requêtes sont les lots planifiés (indices 0 à total_batches - 1), puis les sous-requêtes issues du
+    # découpage automatique des requêtes trop larges (config.AUTO_SPLIT_ENABLED), ajoutées à la suite.
+    # La progression est globale (événements "progress") : les requêtes avancent simultanément.
+    query_params = list(params_per_batch)
+    if cancel_event is None:
+        cancel_event = threading.Event() # Set on exit so that queued and retrying tasks stop sending requests
+
+    def query_label(query_idx):
+        if query_idx < total_batches:
+            return f"Lot {query_idx+1}"
+        return f"Sous-requête {query_idx - total_batches + 1}"
+
+    def submit_page(query_idx, page_num, fetch_function, *args, **kwargs):
+        stored_result = job.stored_page(query_params[query_idx], page_num) if job is not None else None
+        if stored_result is not None: # Already fetched by an earlier run of this job
+            future = concurrent.futures.Future()
+            future.set_result(stored_result)
+        else:
+            future = executor.submit(_timed_page_fetch, latency_stats, fetch_function, *args, **kwargs)
+        future_to_task[future] = (query_idx, page_num)
+
+    def submit_page1(query_idx):
+        _emit(on_event, "query_started", label=query_label(query_idx), params=query_params[query_idx])
+        submit_page(
+            query_idx, 1, fetch_first_page, url, query_params[query_idx], headers,
+            max_retries=config.MAX_RETRIES_ON_429, cancel_event=cancel_event, on_event=on_event
+        )
+
+    def count_query_results(query_idx, entreprises):
+        if query_code_counts.get(query_idx) is not None:
+            _count_entreprises_per_code(entreprises, None, code_type, counts=query_code_counts[query_idx])
+
+    def record_query_counts(query_idx):
+        # Per-code counts of a query fetched in full feed the batch planner of later searches
+        if query_code_counts.get(query_idx) is not None:
+            _store_localisation_counts(url, query_params[query_idx], code_type, query_code_counts[query_idx])
+        query_code_counts.pop(query_idx, None)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or config.SEARCH_MAX_WORKERS)
+    future_to_task = {}
+    latency_stats = SearchLatencyStats()
+    for batch_idx in range(total_batches):
+        submit_page1(batch_idx)
+
+    page1_outcomes = {} # query_idx -> "ok", "failed", "split" or "too_large"
+    too_large_page1_results = {} # batch_idx -> page 1 result of a batch exceeding API_MAX_PAGES
+    pages_remaining_per_query = {} # query_idx -> number of follow-up pages not yet returned
+    query_code_counts = {} # query_idx -> per-code counts of a query fetched in full so far, None once a page is missing
+    truncated_queries = {} # siren -> params of the queries where its matching establishments reached the limit
+    raw_results_count = 0
+    completed_queries = 0
+    total_tasks_known = total_batches
+    completed_tasks = 0
+    failed_pages = 0
+    finished_outcome = "interrupted" # Until the scheduler runs to the end or exits early
+    circuit_state = _emit_circuit_change(on_event, "closed")
+    try:
+        while future_to_task:
+            done_futures, _ = concurrent.futures.wait(future_to_task, return_when=concurrent.futures.FIRST_COMPLETED)
+            pages_ready = [] # Raw results of the pages returned in this round, yielded once all are scheduled
+            for future in done_futures:
+                query_idx, page_num = future_to_task.pop(future)
+                query_id_for_msg = query_label(query_idx)
+                params_for_current_query = query_params[query_idx]
+                completed_tasks += 1
+                try:
+                    result_data = future.result()
+                except Exception as exc:
+                    result_data = None
+                    _emit(on_event, "error", level="error", message=f'{query_id_for_msg}, Page {page_num} a généré une exception: {exc}')
+                _emit(on_event, "page_fetched", label=query_id_for_msg, page=page_num, success=(
+                    result_data is not None and (result_data.get("success") or result_data.get("status") == "success")
+                ))
+
+                if page_num == 1:
+                    # === Page 1 d'une requête : la découper ou planifier ses pages suivantes ===
+                    if result_data is None or not result_data["success"]:
+                        if result_data is not None:
+                            _emit(on_event, "error", level="error", message=f"{query_id_for_msg} ({_query_area_label(params_for_current_query, code_type)}): Erreur page 1 - {result_data['error_message']}")
+                        page1_outcomes[query_idx] = "failed"
+                        failed_pages += 1
+                        completed_queries += 1
+                        continue
+
+                    if job is not None:
+                        job.record_page(params_for_current_query, 1, result_data)
+                    results_page1_query = result_data['results']
+                    total_pages_query = result_data['total_pages']
+                    total_results_query = result_data['total_results']
+
+                    if total_pages_query >= config.API_MAX_PAGES:
+                        if config.AUTO_SPLIT_ENABLED:
+                            sub_queries = split_oversized_query(params_for_current_query, code_type)
+                            if sub_queries:
+                                # The sub-queries cover the same results: only their pages are fetched.
+                                page1_outcomes[query_idx] = "split"
+                                completed_queries += 1
+                                for sub_query_params in sub_queries:
+                                    query_params.append(sub_query_params)
+                                    submit_page1(len(query_params) - 1)
+                                total_tasks_known += len(sub_queries)
+                                continue
+                            _emit(on_event, "error", level="warning", message=f"{query_id_for_msg}: plus de {config.API_MAX_TOTAL_RESULTS} résultats pour une requête qui ne peut plus être découpée (un code, un code NAF, une tranche d'effectifs) ; seuls les {config.API_MAX_TOTAL_RESULTS} premiers sont récupérés.")
+                        elif not force_full_fetch:
+                            # Too large for a direct fetch: no follow-up pages, decision taken below.
+                            page1_outcomes[query_idx] = "too_large"
+                            too_large_page1_results[query_idx] = result_data
+                            completed_queries += 1
+                            continue
+
+                    page1_outcomes[query_idx] = "ok"
+                    pages_ready.append(results_page1_query)
+                    _record_truncated_entreprises(results_page1_query, params_for_current_query, truncated_queries)
+                    pages_to_target_for_fetching_query = min(total_pages_query, config.API_MAX_PAGES)
+                    if total_pages_query <= config.API_MAX_PAGES and api_code_param_key is not None:
+                        query_code_counts[query_idx] = dict.fromkeys(_split_values(params_for_current_query[api_code_param_key]), 0)
+                        count_query_results(query_idx, results_page1_query)
+                    if (not results_page1_query and total_results_query == 0) or pages_to_target_for_fetching_query < 2:
+                        completed_queries += 1
+                        record_query_counts(query_idx)
+                    else:
+                        pages_remaining_per_query[query_idx] = pages_to_target_for_fetching_query - 1
+                        total_tasks_known += pages_to_target_for_fetching_query - 1
+                        for page in range(2, pages_to_target_for_fetching_query + 1):
+                            submit_page(
+                                query_idx, page, fetch_page_with_retry, page, params_for_current_query, url, headers,
+                                cancel_event=cancel_event, on_event=on_event
+                            )
+                else:
+                    # === Page suivante d'une requête ===
+                    if result_data is not None and result_data["status"] == "success":
+                        if job is not None:
+                            job.record_page(params_for_current_query, page_num, result_data)
+                        pages_ready.append(result_data["results"])
+                        _record_truncated_entreprises(result_data["results"], params_for_current_query, truncated_queries)
+                        count_query_results(query_idx, result_data["results"])
+                    else:
+                        if result_data is not None:
+                            _emit(on_event, "error", level="error", message=f"{query_id_for_msg}: {result_data['message']}") # Error of a specific page
+                        query_code_counts[query_idx] = None
+                        failed_pages += 1
+                    pages_remaining_per_query[query_idx] -= 1
+                    if pages_remaining_per_query[query_idx] == 0:
+                        completed_queries += 1
+                        record_query_counts(query_idx)
+
+            # Early exits of an initial (non-forced) search are resolved in batch order, as the former
+            # sequential loop did, so that the outcome does not depend on which page 1 answers first:
+            # a failure of the first batch wins, then the first batch (in order) that is too large.
+            if not force_full_fetch:
+                if page1_outcomes.get(0) == "failed":
+                    finished_outcome = "failed"
+                    return None # Indicates critical failure on first batch of initial search
+                for ordered_batch_idx in range(total_batches):
+                    outcome = page1_outcomes.get(ordered_batch_idx)
+                    if outcome is None:
+                        break # An earlier batch is still pending: wait for it before deciding
+                    if outcome == "too_large":
+                        too_large_result = too_large_page1_results[ordered_batch_idx]
+                        finished_outcome = "too_large"
+                        return {
+                            "status_code": "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN",
+                            "page1_results": too_large_result['results'],
+                            "total_pages_estimated": too_large_result['total_pages'],
+                            "total_results_estimated": too_large_result['total_results'],
+                            "original_query_params": query_params[ordered_batch_idx].copy()
+                        }
+
+            raw_results_count += sum(len(page_results) for page_results in pages_ready)
+            _emit(on_event, "progress", completed_queries=completed_queries, total_queries=len(query_params),
+                  completed_pages=completed_tasks, total_pages=total_tasks_known, raw_results=raw_results_count)
+            circuit_state = _emit_circuit_change(on_event, circuit_state)
+            for page_results in pages_ready:
+                yield page_results
+        if truncated_queries and config.COMPLETE_LARGE_ENTREPRISES:
+            # Lazy completion: only the companies that hit the limit are fetched again, once the search is done
+            failed_pages += yield from _complete_truncated_entreprises(
+                truncated_queries, code_type, url, headers, executor, latency_stats, cancel_event, on_event=on_event
+            )
+        finished_outcome = "completed" if failed_pages == 0 else "incomplete"
+    finally:
+        # On early exit (or when the consumer closes the generator), queued pages are dropped and in-flight
+        # tasks send no further attempt; waiting for them guarantees no request of this search outlives the call.
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        rate_controller.save()
+        if job is not None:
+            job.finish(finished_outcome if finished_outcome in ("completed", "incomplete") else "interrupted")
+        _emit(on_event, "search_finished", outcome=finished_outcome, raw_results=raw_results_count, latency=latency_stats.summary())
+    return _SEARCH_COMPLETED
+
+
+def rechercher_entreprises_par_localisation_et_criteres(list_localisation_codes, api_params_from_app, force_full_fetch=False, code_type="commune", on_event=None):
     """
     Recherche les entreprises via l'API /search en utilisant les codes de localisation (communes ou postaux) et autres critères.
     Itère sur les codes de localisation par lots.
@@ -77,8 +2254,12 @@ def rechercher_entreprises_par_localisation_et_criteres(list_localisation_codes,
                                     et 'tranche_effectif_salarie'.
         force_full_fetch (bool): Si True, tente de récupérer toutes les pages jusqu'à config.API_MAX_PAGES
                                  pour chaque lot de codes. Si False et que le premier lot est trop grand,
-                                 retourne un statut spécial.
+                                 retourne un statut spécial. Avec config.AUTO_SPLIT_ENABLED, un lot trop grand
+                                 est toujours découpé en sous-requêtes (split_oversized_query) et récupéré en entier.
         code_type (str): Type de code fourni dans list_localisation_codes. "commune" ou "postal".
+        on_event (callable): Reçoit les événements de progression (voir _emit) ; None pour une exécution sans interface.
+    La recherche est enregistrée comme job (config.SEARCH_JOBS_ENABLED) : relancée après une interruption,
+    elle ne redemande que les pages manquantes.
     Returns:
         list or dict: Liste d'objets "entreprise" si succès, ou un dictionnaire avec status_code
                       "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN" si la recherche initiale est trop large.
@@ -91,221 +2272,155 @@ def rechercher_entreprises_par_localisation_et_criteres(list_localisation_codes,
     # - 'activite_principale' or 'section_activite_principale'
     # - 'tranche_effectif_salarie' (comma-separated string of codes)
     
-    base_api_params_for_search = api_params_from_app.copy() 
-    base_api_params_for_search.update({
-        'per_page': 25,
-        'minimal': 'true',
-        'etat_administratif' : 'A',
-        'include' : 'matching_etablissements,finances',
-        'limite_matching_etablissements': 100 
-    })
+    base_api_params_for_search = _build_search_params(api_params_from_app)
     headers = {'accept': 'application/json'}
-    
-    all_entreprises_global = [] # Stores "entreprise" objects from all successful calls
-    # all_processed_sirets_global = set() # To deduplicate establishments across all calls - not used here, deduplication happens on entreprise objects by SIREN later
-
-    # Clear the request timestamps deque only for a new, non-forced search operation.
-    # For breakdown calls (force_full_fetch=True), app.py should manage clearing it once before the batch.
-    if not force_full_fetch:
-        with rate_limit_lock:
-            request_timestamps.clear()
-            # print(f"{dt.datetime.now()} - DEBUG - Request timestamps deque cleared for new search.")
 
     if not list_localisation_codes:
-        st.warning(f"Aucun code de localisation ({code_type}) fourni pour la recherche.")
+        _emit(on_event, "error", level="warning", message=f"Aucun code de localisation ({code_type}) fourni pour la recherche.")
         return []
 
-    localisation_code_batches = [
-        list_localisation_codes[i:i + MAX_CODES_PER_API_CALL]
-        for i in range(0, len(list_localisation_codes), MAX_CODES_PER_API_CALL)
-    ]
-    total_batches = len(localisation_code_batches)
-
-    progress_bar = st.progress(0)
-    status_text_global = st.empty() # For global status updates
-    status_text_global.text(f"Initialisation de la recherche sur {len(list_localisation_codes)} codes {code_type} ({total_batches} lots)...")
-
-    api_code_param_key = "code_commune" if code_type == "commune" else "code_postal"
-
-    for batch_idx, code_batch in enumerate(localisation_code_batches):
-        current_codes_str = ",".join(code_batch)
-        status_text_global.text(f"Lot {batch_idx + 1}/{total_batches}: Codes {code_type} {current_codes_str[:50]}...")
-
-        params_for_current_batch = base_api_params_for_search.copy()
-        params_for_current_batch[api_code_param_key] = current_codes_str
-
-        # This st.status is for the current batch of codes
-        batch_status_message = f"Recherche pour codes {code_type}: {current_codes_str[:30]}..."
-        with st.status(batch_status_message, expanded=(total_batches == 1)) as status_batch: # Expand if only one batch
-            # === Étape 1: Récupérer la première page pour CE LOT DE CODES ===
-            status_batch.update(label=f"Lot {batch_idx+1}, Page 1: Récupération...")
-            page1_result_batch = fetch_first_page(url, params_for_current_batch, headers)
-
-            if not page1_result_batch["success"]:
-                error_msg_batch = f"Lot {batch_idx+1} (Codes {code_type}: {current_codes_str[:30]}...): Erreur page 1 - {page1_result_batch['error_message']}"
-                status_batch.update(label=error_msg_batch, state="error")
-                # st.error(error_msg_batch) # Also show as main error
-                progress_bar.progress((batch_idx + 1) / total_batches)
-                # If the first batch fails for a non-forced fetch, we might want to stop and report.
-                # For forced fetch (breakdown), we continue to try other batches.
-                if batch_idx == 0 and not force_full_fetch:
-                    return None # Indicates critical failure on first batch of initial search
-                continue # Try next batch if this isn't the first batch of an initial search
+    job = open_search_job(url, base_api_params_for_search, list_localisation_codes, force_full_fetch, code_type)
+    search_pages = _iter_search_pages(
+        list_localisation_codes, base_api_params_for_search, force_full_fetch, code_type, url, headers, on_event=on_event, job=job
+    )
+    return _merge_search_pages(search_pages, on_event)
 
-            results_page1_batch = page1_result_batch['results']
-            total_pages_batch = page1_result_batch['total_pages']
-            total_results_batch = page1_result_batch['total_results']
-            
-            status_batch.update(label=f"Lot {batch_idx+1}, Page 1: {len(results_page1_batch)} résultats. Total estimé pour lot: {total_results_batch} sur {total_pages_batch} pages.")
 
-            if not results_page1_batch and total_results_batch == 0:
-                status_batch.update(label=f"Lot {batch_idx+1}: Aucun résultat.", state="complete")
-                progress_bar.progress((batch_idx + 1) / total_batches)
-                continue
-            
-            all_entreprises_global.extend(results_page1_batch)
-
-            # Handle "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN"
-            # Trigger if *any batch* of an *initial (non-forced)* call is too large.
-            if not force_full_fetch and total_pages_batch >= config.API_MAX_PAGES:
-                status_batch.update(label=f"Lot {batch_idx+1}: Recherche trop large ({total_results_batch} résultats). Suggestion d'affinage.", state="complete")
-                status_text_global.empty() # Clear global text
-                progress_bar.empty()
-                return {
-                    "status_code": "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN",
-                    "page1_results": results_page1_batch,
-                    "total_pages_estimated": total_pages_batch,
-                    "total_results_estimated": total_results_batch,
-                    "original_query_params": params_for_current_batch.copy()
-                }
-
-            pages_to_target_for_fetching_batch = min(total_pages_batch, config.API_MAX_PAGES)
-
-            if pages_to_target_for_fetching_batch >= 2:
-                pages_a_recuperer_batch = list(range(2, pages_to_target_for_fetching_batch + 1))
-                total_pages_to_process_batch = len(pages_a_recuperer_batch)
-                status_batch.update(label=f"Lot {batch_idx+1}: Récupération parallèle des pages 2 à {pages_to_target_for_fetching_batch}...")
-                
-                # Local fetch_page_with_retry for this batch's context
-                def fetch_page_with_retry_local(page_num_local, current_batch_params_local, batch_identifier_str):
-                    params_page_local = current_batch_params_local.copy()
-                    params_page_local['page'] = page_num_local
-                    current_retry_delay_local = config.INITIAL_RETRY_DELAY
-                    for attempt_local in range(config.MAX_RETRIES_ON_429 + 1):
-                        try:
-                            with rate_limit_lock:
-                                now = time.time()
-                                while request_timestamps and request_timestamps[0] <= now - 1.0:
-                                    request_timestamps.popleft()
-                                if len(request_timestamps) >= config.MAX_REQUESTS_PER_SECOND:
-                                    time_since_oldest_in_window = now - request_timestamps[0]
-                                    wait_time = 1.0 - time_since_oldest_in_window + config.MIN_DELAY_BETWEEN_REQUESTS
-                                    if wait_time > 0: time.sleep(wait_time)
-                                request_timestamps.append(time.time())
-
-                            response_local = requests.get(url, params=params_page_local, headers=headers, timeout=20)
-                            response_local.raise_for_status()
-                            data_local = response_local.json()
-                            return {"status": "success", "message": "", "results": data_local.get('results', [])}
-                        except requests.exceptions.HTTPError as e_local:
-                            if e_local.response.status_code == 429:
-                                if attempt_local >= config.MAX_RETRIES_ON_429:
-                                    return {"status": "error", "message": f"Page {page_num_local} ({batch_identifier_str}): Échec final 429", "results": []}
-                                # Simplified retry logic for brevity, use original logic from global fetch_page_with_retry
-                                retry_after_header = e_local.response.headers.get("Retry-After")
-                                wait_duration = current_retry_delay_local
-                                if retry_after_header:
-                                    try: wait_duration = float(retry_after_header)
-                                    except ValueError: pass # Could parse HTTP-date here
-                                time.sleep(max(wait_duration, current_retry_delay_local) + 0.1)
-                                current_retry_delay_local *= 1.5 # Less aggressive backoff
-                                continue
-                            else:
-                                return {"status": "error", "message": f"Page {page_num_local} ({batch_identifier_str}): Erreur HTTP {e_local.response.status_code}", "results": []}
-                        except requests.exceptions.Timeout:
-                            if attempt_local >= config.MAX_RETRIES_ON_429:
-                                return {"status": "error", "message": f"Page {page_num_local} ({batch_identifier_str}): Timeout final", "results": []}
-                            time.sleep(current_retry_delay_local)
-                            current_retry_delay_local *= 2
-                            continue
-                        except requests.exceptions.RequestException as e_local:
-                            return {"status": "error", "message": f"Page {page_num_local} ({batch_identifier_str}): Erreur réseau {e_local}", "results": []}
-                    return {"status": "error", "message": f"Page {page_num_local} ({batch_identifier_str}): Échec inattendu après toutes les tentatives.", "results": []}
-
-                results_paralleles_batch = []
-                with concurrent.futures.ThreadPoolExecutor(max_workers=config.MAX_REQUESTS_PER_SECOND) as executor: # Max workers tied to rate limit
-                    batch_id_for_msg = f"Lot {batch_idx+1}"
-                    future_to_page_batch = {
-                        executor.submit(fetch_page_with_retry_local, page, params_for_current_batch, batch_id_for_msg): page 
-                        for page in pages_a_recuperer_batch
-                    }
-                    processed_pages_count_batch = 0
-                    for future_batch in concurrent.futures.as_completed(future_to_page_batch):
-                        page_num_batch = future_to_page_batch[future_batch]
-                        processed_pages_count_batch += 1
-                        try:
-                            result_data_batch = future_batch.result()
-                            if result_data_batch["status"] == "success":
-                                if result_data_batch["results"]:
-                                    results_paralleles_batch.extend(result_data_batch["results"])
-                                status_batch.update(label=f"Lot {batch_idx+1}: {processed_pages_count_batch}/{total_pages_to_process_batch} pages traitées (Page {page_num_batch} OK).")
-                            elif result_data_batch["status"] == "error":
-                                st.error(result_data_batch['message']) # Show error for specific page
-                                status_batch.update(label=f"Lot {batch_idx+1}: {processed_pages_count_batch}/{total_pages_to_process_batch} pages (Erreur page {page_num_batch}).")
-                        except Exception as exc_batch:
-                            st.error(f'Lot {batch_idx+1}, Page {page_num_batch} a généré une exception: {exc_batch}')
-                            status_batch.update(label=f"Lot {batch_idx+1}: {processed_pages_count_batch}/{total_pages_to_process_batch} pages (Exception page {page_num_batch}).")
-                
-                all_entreprises_global.extend(results_paralleles_batch)
-            status_batch.update(label=f"Lot {batch_idx+1} terminé. {total_results_batch if total_results_batch else 0} résultats estimés, {pages_to_target_for_fetching_batch} pages ciblées.", state="complete")
-        progress_bar.progress((batch_idx + 1) / total_batches)
-
-    status_text_global.text(f"Recherche terminée sur {len(list_localisation_codes)} codes {code_type}. Traitement des {len(all_entreprises_global)} résultats bruts...")
-    progress_bar.empty()
-
-    # Deduplicate 'entreprise' objects by SIREN, merging 'matching_etablissements'
-    unique_entreprises_by_siren = {}
-    for entreprise_obj in all_entreprises_global:
-        siren = entreprise_obj.get("siren")
-        if siren:
-            if siren not in unique_entreprises_by_siren:
-                # Ensure matching_etablissements is a list, even if None or empty initially
-                entreprise_obj["matching_etablissements"] = entreprise_obj.get("matching_etablissements") or []
-                unique_entreprises_by_siren[siren] = entreprise_obj
-            else:
-                # Merge matching_etablissements
-                existing_etabs_sirets = {
-                    etab.get("siret") for etab in unique_entreprises_by_siren[siren].get("matching_etablissements", []) if etab.get("siret")
-                }
-                new_etabs_to_add = [
-                    new_etab for new_etab in entreprise_obj.get("matching_etablissements", [])
-                    if new_etab.get("siret") and new_etab.get("siret") not in existing_etabs_sirets
-                ]
-                if new_etabs_to_add:
-                    unique_entreprises_by_siren[siren]["matching_etablissements"].extend(new_etabs_to_add)
-        else: # No SIREN, add it using a unique key if it's truly an "entreprise" object without SIREN
-             # This case should be rare for valid data.
-            unique_key_no_siren = f"no_siren_{len(unique_entreprises_by_siren)}"
-            unique_entreprises_by_siren[unique_key_no_siren] = entreprise_obj
-
-    deduplicated_entreprise_list = list(unique_entreprises_by_siren.values())
+def rechercher_entreprises_autour_du_point(latitude, longitude, radius_km, api_params_from_app, force_full_fetch=False, on_event=None):
+    """
+    Recherche géographique native : interroge /near_point avec le point et le rayon, au lieu de découper la zone
+    en codes postaux. Seuls les établissements situés dans le rayon sont renvoyés, sans télécharger les codes
+    postaux qui débordent du cercle. Mêmes critères (api_params_from_app), pagination, limitation de débit,
+    découpage automatique, jobs et événements que rechercher_entreprises_par_localisation_et_criteres.
+    Le rayon est limité à config.NEAR_POINT_MAX_RADIUS_KM (limite de l'API).
+    Returns:
+        list or dict: Comme rechercher_entreprises_par_localisation_et_criteres.
+    """
+    url = f"{config.API_BASE_URL}/near_point"
+    headers = {'accept': 'application/json'}
+    base_api_params_for_search = _near_point_search_params(latitude, longitude, _near_point_radius(radius_km, on_event), api_params_from_app)
+    job = open_search_job(url, base_api_params_for_search, [], force_full_fetch, "point")
+    search_pages = _iter_search_pages([], base_api_params_for_search, force_full_fetch, "point", url, headers, on_event=on_event, job=job)
+    return _merge_search_pages(search_pages, on_event)
+
+
+def _near_point_radius(radius_km, on_event):
+    if radius_km > config.NEAR_POINT_MAX_RADIUS_KM:
+        _emit(on_event, "error", level="warning", message=f"Rayon ramené à {config.NEAR_POINT_MAX_RADIUS_KM} km, le maximum accepté par l'API.")
+        return config.NEAR_POINT_MAX_RADIUS_KM
+    return radius_km
+
+
+def _merge_search_pages(search_pages, on_event):
+    """Fusionne par SIREN les pages de _iter_search_pages ; retourne la liste dédupliquée ou la valeur d'arrêt anticipé."""
+    merge_index = SirenMergeIndex() # Merges "entreprise" objects by SIREN as pages arrive
+    while True:
+        try:
+            page_results = next(search_pages)
+        except StopIteration as search_end:
+            search_outcome = search_end.value
+            break
+        merge_index.add_many(page_results)
+    if search_outcome is not _SEARCH_COMPLETED:
+        return search_outcome
+
+    deduplicated_entreprise_list = merge_index.entreprises()
     # print(f"{dt.datetime.now()} - INFO - Deduplicated 'entreprise' items by SIREN: {len(deduplicated_entreprise_list)}")
-    status_text_global.text(f"Traitement final de {len(deduplicated_entreprise_list)} entreprises uniques (par SIREN).")
+    _emit(on_event, "results_merged", unique_entreprises=len(deduplicated_entreprise_list))
     
     return deduplicated_entreprise_list
 
 
-# The global fetch_page_with_retry is kept for reference or if needed by other parts,
-# but the new main search function uses a localized version for clarity with batch parameters.
-def fetch_page_with_retry(page_num, base_params_for_retry, url_for_retry, headers_for_retry):
+
+
+class SearchInterrupted(Exception):
+    """
+    Levée par iter_entreprises_par_localisation quand la recherche s'arrête avant la fin.
+    search_result porte la valeur qu'aurait retournée rechercher_entreprises_par_localisation_et_criteres
+    (None si le premier lot échoue, dictionnaire "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN" si la recherche est trop large).
+    """
+
+    def __init__(self, search_result):
+        super().__init__("Recherche interrompue avant la fin")
+        self.search_result = search_result
+
+
+def iter_entreprises_par_localisation(list_localisation_codes, api_params_from_app, force_full_fetch=False, code_type="commune", on_event=None):
+    """
+    Variante en flux de rechercher_entreprises_par_localisation_et_criteres (mêmes arguments) : génère, page par
+    page et dès leur arrivée, des listes d'entreprises dédupliquées par SIREN. Le traitement en aval (DataFrame,
+    ERM, carte) peut ainsi commencer pendant que les pages suivantes sont récupérées, et la mémoire n'a pas à
+    contenir toutes les entreprises brutes de la recherche.
+    Une entreprise déjà générée ne réapparaît que si une page apporte de nouveaux établissements (SIRET) :
+    elle est alors générée à nouveau sous forme de copie ne contenant que ces établissements, de sorte que
+    chaque établissement n'est généré qu'une fois. Seuls les SIREN et SIRET déjà vus sont conservés.
+    Interrompre l'itération (break, close) annule les pages restantes. on_event : voir _emit.
+    Raises:
+        SearchInterrupted: Si la recherche s'arrête avant la fin (voir SearchInterrupted.search_result).
+    """
+    if not list_localisation_codes:
+        _emit(on_event, "error", level="warning", message=f"Aucun code de localisation ({code_type}) fourni pour la recherche.")
+        return
+
+    url = f"{config.API_BASE_URL}/search"
+    headers = {'accept': 'application/json'}
+    base_api_params_for_search = _build_search_params(api_params_from_app)
+    job = open_search_job(url, base_api_params_for_search, list_localisation_codes, force_full_fetch, code_type)
+    search_pages = _iter_search_pages(
+        list_localisation_codes, base_api_params_for_search, force_full_fetch, code_type, url, headers, on_event=on_event, job=job
+    )
+    yield from _stream_search_pages(search_pages, on_event)
+
+
+def iter_entreprises_autour_du_point(latitude, longitude, radius_km, api_params_from_app, force_full_fetch=False, on_event=None):
+    """
+    Variante en flux de rechercher_entreprises_autour_du_point, comme iter_entreprises_par_localisation
+    (mêmes listes dédupliquées générées page par page).
+    Raises:
+        SearchInterrupted: Si la recherche s'arrête avant la fin (voir SearchInterrupted.search_result).
+    """
+    url = f"{config.API_BASE_URL}/near_point"
+    headers = {'accept': 'application/json'}
+    base_api_params_for_search = _near_point_search_params(latitude, longitude, _near_point_radius(radius_km, on_event), api_params_from_app)
+    job = open_search_job(url, base_api_params_for_search, [], force_full_fetch, "point")
+    search_pages = _iter_search_pages([], base_api_params_for_search, force_full_fetch, "point", url, headers, on_event=on_event, job=job)
+    yield from _stream_search_pages(search_pages, on_event)
+
+
+def _stream_search_pages(search_pages, on_event):
+    """Génère les entreprises nouvelles de chaque page de _iter_search_pages (voir iter_entreprises_par_localisation)."""
+    merge_index = SirenMergeIndex(keep_entreprises=False)
+
+    try:
+        while True:
+            try:
+                page_results = next(search_pages)
+            except StopIteration as search_end:
+                search_outcome = search_end.value
+                break
+            chunk = merge_index.add_many(page_results)
+            if chunk:
+                yield chunk
+    finally:
+        search_pages.close() # Stops the scheduler if the consumer stopped early
+    if search_outcome is not _SEARCH_COMPLETED:
+        raise SearchInterrupted(search_outcome)
+    _emit(on_event, "results_merged", unique_entreprises=len(merge_index))
+
+
+# Used by the global scheduler for every page after page 1.
+def fetch_page_with_retry(page_num, base_params_for_retry, url_for_retry, headers_for_retry, cancel_event=None, on_event=None):
             """
             Fetches a single page from the API with retry logic for 429 (Too Many Requests) and timeouts.
-            Implements rate limiting using a shared deque of timestamps.
+            Implements rate limiting using the shared token bucket (rate_limiter).
             Args:
                 page_num (int): The page number to fetch.
                 base_params_for_retry (dict): Base parameters for the API call (excluding 'page').
                 url_for_retry (str): The API endpoint URL.
                 headers_for_retry (dict): Headers for the API call.
+                cancel_event (threading.Event): If set, no further attempt is sent and the
+                                                result status is "cancelled".
+                on_event (callable): Receives a "throttled" event for every 429 response.
             """
             # print(f"{dt.datetime.now()} - DEBUG - [Page {page_num}] Starting fetch.")
             params_page = base_params_for_retry.copy()
@@ -313,28 +2428,15 @@ def fetch_page_with_retry(page_num, base_params_for_retry, url_for_retry, header
             current_retry_delay = config.INITIAL_RETRY_DELAY
             for attempt in range(config.MAX_RETRIES_ON_429 + 1):
                 # print(f"{dt.datetime.now()} - DEBUG - [Page {page_num}] Attempt {attempt + 1}/{config.MAX_RETRIES_ON_429 + 1}.")
+                if _is_cancelled(cancel_event):
+                    return {"status": "cancelled", "message": f"Page {page_num}: Recherche annulée.", "results": []}
                 try:
-                    # --- Rate Limiting Logic ---
-                    # Uses a thread-safe lock and a deque to track request timestamps.
-                    # Ensures that the number of requests per second does not exceed MAX_REQUESTS_PER_SECOND.
-                    with rate_limit_lock:
-                        now = time.time()
-                        # Remove timestamps older than 1 second from the window
-                        while request_timestamps and request_timestamps[0] <= now - 1.0:
-                            request_timestamps.popleft()
-                        if len(request_timestamps) >= config.MAX_REQUESTS_PER_SECOND:
-                            time_since_oldest_in_window = now - request_timestamps[0]
-                            wait_time = 1.0 - time_since_oldest_in_window + config.MIN_DELAY_BETWEEN_REQUESTS
-                            if wait_time > 0:
-                                # print(f"{dt.datetime.now()} - DEBUG - [Page {page_num}] Rate limiting: sleeping for {wait_time:.2f}s.")
-                                time.sleep(wait_time)
-                        request_timestamps.append(time.time())
-
-                    # --- API Call ---
-                    response = requests.get(url_for_retry, params=params_page, headers=headers_for_retry, timeout=20)
-                    # print(f"{dt.datetime.now()} - DEBUG - [Page {page_num}] Response status code: {response.status_code}")
-                    response.raise_for_status()
-                    data = response.json()
+                    # --- Rate Limiting Logic + API Call ---
+                    # Reserves a token from the shared token bucket (sleeping outside its lock if needed),
+                    # then reports the response latency to the adaptive rate controller.
+                    data = _get_page_data(url_for_retry, params_page, headers_for_retry, timeout=20, cancel_event=cancel_event)
+                    if data is None:
+                        return {"status": "cancelled", "message": f"Page {page_num}: Recherche annulée.", "results": []}
                     # print(f"{dt.datetime.now()} - DEBUG - [Page {page_num}] Fetch successful. Results: {len(data.get('results', []))}")
                     return {"status": "success", "message": "", "results": data.get('results', [])}
 
@@ -344,23 +2446,11 @@ def fetch_page_with_retry(page_num, base_params_for_retry, url_for_retry, header
                             error_msg = f"Page {page_num}: Échec final après {config.MAX_RETRIES_ON_429 + 1} tentatives (429 Too Many Requests)."
                             # print(f"{dt.datetime.now()} - ERROR - [Page {page_num}] {error_msg}")
                             return {"status": "error", "message": error_msg, "results": []}
-                        retry_after_header = e.response.headers.get("Retry-After")
-                        wait_duration = current_retry_delay
-                        header_used = False
-                        if retry_after_header:
-                            try: wait_duration = float(retry_after_header); header_used = True
-                            except ValueError:
-                                # Attempt to parse HTTP-date format for Retry-After
-                                try:
-                                    retry_date = dt.datetime.strptime(retry_after_header, '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=dt.timezone.utc)
-                                    now_utc = dt.datetime.now(dt.timezone.utc)
-                                    wait_duration = (retry_date - now_utc).total_seconds()
-                                    if wait_duration < 0: wait_duration = 0
-                                    header_used = True
-                                except ValueError: pass
-                        wait_duration = max(wait_duration + 0.1, current_retry_delay if not header_used else 0)
-                        # print(f"{dt.datetime.now()} - WARNING - [Page {page_num}] HTTP 429 (Too Many Requests). Attempt {attempt + 1}. Waiting {wait_duration:.2f}s. Header used: {header_used}")
-                        time.sleep(wait_duration)
+                        wait_duration = _retry_after_delay(e.response, current_retry_delay)
+                        # print(f"{dt.datetime.now()} - WARNING - [Page {page_num}] HTTP 429 (Too Many Requests). Attempt {attempt + 1}. Waiting {wait_duration:.2f}s.")
+                        # The pause covers the whole pool; the retry waits for it in the rate limiter
+                        _emit(on_event, "throttled", page=page_num, retry_after=wait_duration)
+                        rate_controller.on_throttled(wait_duration)
                         current_retry_delay *= 2 # Exponential backoff for subsequent retries
                         continue
                     else:
@@ -373,7 +2463,7 @@ def fetch_page_with_retry(page_num, base_params_for_retry, url_for_retry, header
                          # print(f"{dt.datetime.now()} - ERROR - [Page {page_num}] {error_msg}")
                          return {"status": "error", "message": error_msg, "results": []}
                     # print(f"{dt.datetime.now()} - WARNING - [Page {page_num}] Timeout. Attempt {attempt + 1}. Waiting {current_retry_delay:.2f}s.")
-                    time.sleep(current_retry_delay)
+                    _sleep_before_retry(current_retry_delay, cancel_event)
                     current_retry_delay *= 2
                     continue
                 except requests.exceptions.RequestException as e:
@@ -383,3 +2473,68 @@ def fetch_page_with_retry(page_num, base_params_for_retry, url_for_retry, header
             error_msg_final = f"Page {page_num}: Échec inattendu après toutes les tentatives."
             # print(f"{dt.datetime.now()} - ERROR - [Page {page_num}] {error_msg_final}")
             return {"status": "error", "message": error_msg_final, "results": []}
+
+
+# --- Variante asynchrone ---
+def _pages_until(search_pages, stop_event):
+    """
+    Relaie les pages de _iter_search_pages jusqu'à ce que stop_event (son cancel_event) soit levé, puis ferme
+    l'ordonnanceur.
+    """
+    try:
+        while not stop_event.is_set():
+            try:
+                page_results = next(search_pages)
+            except StopIteration as search_end:
+                return search_end.value
+            yield page_results
+        return None
+    finally:
+        search_pages.close() # Drops the remaining pages and waits for the in-flight ones
+
+
+async def rechercher_entreprises_async(list_localisation_codes, api_params_from_app, force_full_fetch=False, code_type="commune", max_concurrency=None, on_event=None):
+    """
+    Enveloppe asynchrone de rechercher_entreprises_par_localisation_et_criteres, pour un appelant qui tourne dans
+    une boucle d'événements. Ce n'est pas un moteur asyncio : la coroutine exécute, via asyncio.to_thread,
+    l'ordonnanceur global à threads (_iter_search_pages : lots, découpage automatique, complétion des grandes
+    entreprises, jobs, issue finale), sans bloquer la boucle ; les requêtes HTTP restent envoyées par ses workers.
+    Args:
+        list_localisation_codes, api_params_from_app, force_full_fetch, code_type:
+            Identiques à rechercher_entreprises_par_localisation_et_criteres.
+        max_concurrency (int): Nombre de workers de l'ordonnanceur (par défaut config.SEARCH_MAX_WORKERS).
+        on_event (callable): Voir _emit ; les événements sont remis sur la boucle d'événements de l'appelant.
+    Annuler la coroutine arrête la recherche ; l'annulation n'est propagée qu'une fois les requêtes en vol terminées.
+    Returns:
+        list or dict or None: Même contrat que rechercher_entreprises_par_localisation_et_criteres.
+    """
+    url = f"{config.API_BASE_URL}/search"
+    headers = {'accept': 'application/json'}
+    base_api_params_for_search = _build_search_params(api_params_from_app)
+    loop = asyncio.get_running_loop()
+
+    def loop_on_event(event):
+        loop.call_soon_threadsafe(on_event, event)
+
+    event_relay = loop_on_event if on_event is not None else None
+    if not list_localisation_codes:
+        _emit(on_event, "error", level="warning", message=f"Aucun code de localisation ({code_type}) fourni pour la recherche.")
+        return []
+
+    stop_event = threading.Event()
+
+    def run_search():
+        job = open_search_job(url, base_api_params_for_search, list_localisation_codes, force_full_fetch, code_type)
+        search_pages = _iter_search_pages(
+            list_localisation_codes, base_api_params_for_search, force_full_fetch, code_type, url, headers,
+            on_event=event_relay, job=job, max_workers=max_concurrency, cancel_event=stop_event,
+        )
+        return _merge_search_pages(_pages_until(search_pages, stop_event), event_relay)
+
+    search = asyncio.ensure_future(asyncio.to_thread(run_search))
+    try:
+        return await asyncio.shield(search)
+    except asyncio.CancelledError:
+        stop_event.set()
+        await asyncio.wait([search]) # No request of this search outlives the coroutine
+        raise
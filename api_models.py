@@ -0,0 +1,175 @@
+"""
+Décodage typé des pages /search et /near_point de l'API Recherche d'entreprises.
+
+Les réponses sont lues avec orjson s'il est installé (sinon avec le module json), puis chaque résultat devient
+un objet Entreprise à slots dont les établissements correspondants sont des objets Etablissement. Seuls les
+champs lus par le pipeline (fusion par SIREN, comptage par code de localisation, data_utils.traitement_reponse_api)
+sont conservés ; les autres, et les finances des exercices antérieurs au dernier, sont écartés au décodage.
+
+Les objets se lisent comme les dictionnaires de l'API (record.get("siren"), record["siret"]) : le code écrit
+pour les réponses brutes fonctionne sur les deux, et une page mise en cache sous forme de dictionnaires
+est convertie de la même façon à sa relecture.
+"""
+import dataclasses
+import json
+
+try:
+    import orjson
+except ImportError: # Optional speed-up: the standard json module decodes the same pages
+    orjson = None
+
+
+class _ApiRecord:
+    """Accès de type dictionnaire aux champs d'un objet décodé (un champ absent ou null vaut default)."""
+
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def to_dict(self):
+        """Champs renseignés, sous la forme d'un dictionnaire de l'API (sérialisation JSON)."""
+        return {field.name: _to_json_value(value) for field in dataclasses.fields(self)
+                if (value := getattr(self, field.name)) is not None}
+
+
+@dataclasses.dataclass(slots=True)
+class Etablissement(_ApiRecord):
+    """Établissement correspondant (matching_etablissements) réduit aux champs utilisés."""
+
+    siret: str = None
+    etat_administratif: str = None
+    tranche_effectif_salarie: str = None
+    annee_tranche_effectif_salarie: str = None
+    activite_principale: str = None
+    adresse: str = None
+    code_postal: str = None
+    commune: str = None
+    libelle_commune: str = None
+    latitude: str = None
+    longitude: str = None
+    est_siege: bool = None
+    liste_enseignes: list = None
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(*map(data.get, _ETABLISSEMENT_FIELDS))
+
+
+_ETABLISSEMENT_FIELDS = tuple(field.name for field in dataclasses.fields(Etablissement))
+
+
+@dataclasses.dataclass(slots=True)
+class Entreprise(_ApiRecord):
+    """Résultat de recherche (unité légale) réduit aux champs utilisés et à ses établissements correspondants."""
+
+    siren: str = None
+    nom_complet: str = None
+    nom_raison_sociale: str = None
+    date_creation: str = None
+    nombre_etablissements_ouverts: int = None
+    activite_principale: str = None
+    tranche_effectif_salarie: str = None
+    finances: dict = None # Latest financial year only: {annee: {"ca": ..., "resultat_net": ...}}
+    matching_etablissements: list = None
+
+    @classmethod
+    def from_api(cls, data):
+        matching_etablissements = data.get("matching_etablissements")
+        return cls(
+            data.get("siren"),
+            data.get("nom_complet"),
+            data.get("nom_raison_sociale"),
+            data.get("date_creation"),
+            data.get("nombre_etablissements_ouverts"),
+            data.get("activite_principale"),
+            data.get("tranche_effectif_salarie"),
+            _latest_finances(data.get("finances")),
+            None if matching_etablissements is None else [
+                etab if isinstance(etab, Etablissement) else Etablissement.from_api(etab)
+                for etab in matching_etablissements
+            ],
+        )
+
+    def with_etablissements(self, matching_etablissements):
+        """Copie de l'entreprise avec d'autres établissements correspondants (voir api_client.SirenMergeIndex)."""
+        return Entreprise(
+            self.siren, self.nom_complet, self.nom_raison_sociale, self.date_creation,
+            self.nombre_etablissements_ouverts, self.activite_principale, self.tranche_effectif_salarie,
+            self.finances, matching_etablissements,
+        )
+
+
+def _latest_finances(finances):
+    # data_utils.traitement_reponse_api only reads the most recent year
+    if not isinstance(finances, dict):
+        return None
+    years = [year for year in finances if year.isdigit()]
+    if not years:
+        return None
+    latest_year = max(years)
+    return {latest_year: finances[latest_year]}
+
+
+def _to_json_value(value):
+    if isinstance(value, _ApiRecord):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_to_json_value(item) for item in value]
+    return value
+
+
+def with_etablissements(entreprise, matching_etablissements):
+    """Copie d'une entreprise (objet Entreprise ou dictionnaire brut) avec d'autres établissements correspondants."""
+    if isinstance(entreprise, Entreprise):
+        return entreprise.with_etablissements(matching_etablissements)
+    return dict(entreprise, matching_etablissements=matching_etablissements)
+
+
+def loads(content):
+    """Décode un document JSON (bytes ou str) avec orjson si disponible."""
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+def dumps(data):
+    """Encode en JSON compact (bytes UTF-8) une page décodée par decode_page ou un dictionnaire."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_to_json_value)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=_to_json_value).encode("utf-8")
+
+
+def page_from_json(data):
+    """
+    Convertit les résultats ("results") d'une page déjà décodée en objets Entreprise ; les autres clés
+    (total_results, total_pages, page...) sont conservées telles quelles.
+    """
+    if isinstance(data, dict) and isinstance(data.get("results"), list):
+        data["results"] = [
+            entreprise if isinstance(entreprise, Entreprise) else Entreprise.from_api(entreprise)
+            for entreprise in data["results"]
+        ]
+    return data
+
+
+def decode_page(content):
+    """
+    Décode le corps JSON d'une page de résultats (réponse HTTP, page en cache ou page d'une recherche reprise).
+    Returns:
+        dict: La page, ses résultats en objets Entreprise.
+    Raises:
+        ValueError: Le corps n'est pas du JSON valide (orjson.JSONDecodeError et json.JSONDecodeError en dérivent).
+    """
+    return page_from_json(loads(content))
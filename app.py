@@ -11,6 +11,7 @@ import config
 import data_utils
 import geo_utils
 import llm_utils
+import streamlit_progress
 
 # --- SCRIPT START LOG ---
 # print(f"{datetime.datetime.now()} - INFO - app.py script started.") # Optional: uncomment for runtime debugging
@@ -357,6 +358,13 @@ with col_gauche:
             step=0.5,
             format="%.1f",
         )
+        search_mode_input = st.radio(
+            "Mode de recherche géographique",
+            options=["codes_postaux", "rayon"],
+            format_func=lambda mode: "Codes postaux du rayon" if mode == "codes_postaux" else "Rayon exact (recherche géographique de l'API)",
+            help="« Codes postaux du rayon » interroge tous les codes postaux des communes du rayon, zones débordant du cercle comprises. "
+                 "« Rayon exact » interroge directement l'API autour du point : seuls les établissements situés dans le rayon sont téléchargés.",
+        )
 
     # --- SECTION POUR L'ASSISTANT IA ---
     st.subheader("💡 Assistant IA pour définir les critères de recherche")
@@ -663,7 +671,6 @@ if lancer_recherche:
 
     if has_selected_sections:
         sections_for_api = sorted(list(st.session_state.selected_naf_letters))
-        final_api_params["section_activite_principale"] = ",".join(sections_for_api)
         
         section_descs = [f"{s} ({config.naf_sections_details.get(s, {}).get('description', 'Section')})" for s in sections_for_api]
         if len(section_descs) == 1:
@@ -672,16 +679,19 @@ if lancer_recherche:
             naf_criteria_message_part = f"les sections NAF : {', '.join(section_descs)}"
         
         if has_selected_specific_codes:
-            # Specific codes will be used for client-side filtering
-            codes_to_filter_client_side = sorted(list(st.session_state.selected_specific_naf_codes))
-            if codes_to_filter_client_side: # Ensure there are actually codes to filter by
-                if len(codes_to_filter_client_side) == 1:
-                    naf_criteria_message_part += f", qui sera affiné par le code NAF spécifique : {codes_to_filter_client_side[0]}"
-                else:
-                    display_codes_specific = codes_to_filter_client_side
-                    if len(display_codes_specific) > 3:
-                        display_codes_specific = display_codes_specific[:3] + ["..."]
-                    naf_criteria_message_part += f", qui sera affiné par {len(codes_to_filter_client_side)} codes NAF spécifiques (ex: {', '.join(display_codes_specific)})"
+            # Specific codes are sent to the API (activite_principale) instead of downloading whole sections;
+            # api_client spreads a long list over several calls
+            specific_codes_for_api = sorted(list(st.session_state.selected_specific_naf_codes))
+            final_api_params["activite_principale"] = ",".join(specific_codes_for_api)
+            if len(specific_codes_for_api) == 1:
+                naf_criteria_message_part += f", limitée au code NAF spécifique : {specific_codes_for_api[0]}"
+            else:
+                display_codes_specific = specific_codes_for_api
+                if len(display_codes_specific) > 3:
+                    display_codes_specific = display_codes_specific[:3] + ["..."]
+                naf_criteria_message_part += f", limitée à {len(specific_codes_for_api)} codes NAF spécifiques (ex: {', '.join(display_codes_specific)})"
+        else:
+            final_api_params["section_activite_principale"] = ",".join(sections_for_api)
     else: # No sections selected
         st.error("⚠️ Veuillez sélectionner au moins une section NAF.")
         st.stop()
@@ -704,16 +714,20 @@ if lancer_recherche:
             st.stop()
         lat_centre, lon_centre = coordonnees
 
-        # Get POSTAL codes in radius
-        st.write(f"Recherche des codes postaux dans un rayon de {radius_input:.1f} km autour de l'adresse...")
-        postal_codes_in_radius = geo_utils.get_communes_in_radius_cached(lat_centre, lon_centre, radius_input) # This now returns postal codes
-        print(f"{datetime.datetime.now()} - DEBUG - Postal codes in radius: {postal_codes_in_radius}")
-        
-        if not postal_codes_in_radius:
-            st.warning(f"Aucun code postal trouvé pour les communes dans un rayon de {radius_input:.1f} km autour de l'adresse spécifiée. Essayez un rayon plus large ou une autre adresse.")
-            st.stop()
-        
-        st.write(f"{len(postal_codes_in_radius)} codes postaux trouvés dans le rayon. Lancement de la recherche d'entreprises pour ces codes postaux...")
+        if search_mode_input == "rayon":
+            postal_codes_in_radius = None # The API searches around the point itself
+            st.write(f"Recherche des entreprises dans un rayon de {radius_input:.1f} km autour de l'adresse (recherche géographique de l'API)...")
+        else:
+            # Get POSTAL codes in radius
+            st.write(f"Recherche des codes postaux dans un rayon de {radius_input:.1f} km autour de l'adresse...")
+            postal_codes_in_radius = geo_utils.get_communes_in_radius_cached(lat_centre, lon_centre, radius_input) # This now returns postal codes
+            print(f"{datetime.datetime.now()} - DEBUG - Postal codes in radius: {postal_codes_in_radius}")
+            
+            if not postal_codes_in_radius:
+                st.warning(f"Aucun code postal trouvé pour les communes dans un rayon de {radius_input:.1f} km autour de l'adresse spécifiée. Essayez un rayon plus large ou une autre adresse.")
+                st.stop()
+            
+            st.write(f"{len(postal_codes_in_radius)} codes postaux trouvés dans le rayon. Lancement de la recherche d'entreprises pour ces codes postaux...")
 
         # Prepare API params for the client function
         # `final_api_params` currently holds NAF criteria. Add effectifs.
@@ -726,13 +740,40 @@ if lancer_recherche:
 
         print(f"{datetime.datetime.now()} - DEBUG - Calling API client with postal_codes: {postal_codes_in_radius}, api_params: {final_api_params}")
         # 2. Lancer la recherche API
-        # The api_client function will use st.status internally
-        api_response = api_client.rechercher_entreprises_par_localisation_et_criteres(
-            postal_codes_in_radius,
-            final_api_params, # Contains NAF and effectifs
-            force_full_fetch=False,
-            code_type="postal"
-        )
+        # Companies are streamed page by page: each chunk is turned into rows while the next pages are fetched
+        api_response = None # Set only when the search stops early (see api_client.SearchInterrupted)
+        search_completed = False
+        df_chunks = []
+        entreprises_recues = False # Emptiness check only: a company re-yielded with new establishments is not counted twice
+        if postal_codes_in_radius is None:
+            # No postal codes to break the search down by: oversized queries are split by NAF/effectifs or capped
+            entreprises_stream = api_client.iter_entreprises_autour_du_point(
+                lat_centre, lon_centre, radius_input,
+                final_api_params, # Contains NAF and effectifs
+                force_full_fetch=True,
+                on_event=streamlit_progress.StreamlitSearchProgress()
+            )
+        else:
+            entreprises_stream = api_client.iter_entreprises_par_localisation(
+                postal_codes_in_radius,
+                final_api_params, # Contains NAF and effectifs
+                force_full_fetch=False,
+                code_type="postal",
+                on_event=streamlit_progress.StreamlitSearchProgress()
+            )
+        try:
+            for entreprises_chunk in entreprises_stream:
+                entreprises_recues = entreprises_recues or bool(entreprises_chunk)
+                df_chunk = data_utils.traitement_reponse_api( # This function filters by effectifs again, which is fine as a safeguard
+                    entreprises_chunk, st.session_state.selected_effectifs_codes
+                )
+                # Postal areas overflow the circle: drop establishments outside the radius before any later stage
+                df_chunk = data_utils.filtrer_par_rayon(df_chunk, lat_centre, lon_centre, radius_input)
+                if not df_chunk.empty:
+                    df_chunks.append(df_chunk)
+            search_completed = True
+        except api_client.SearchInterrupted as search_interrupted:
+            api_response = search_interrupted.search_result
 
         if isinstance(api_response, dict) and api_response.get("status_code") == "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN":
             # print(f"{datetime.datetime.now()} - DEBUG - Lancer recherche: API response needs user confirmation/breakdown.")
@@ -750,14 +791,11 @@ if lancer_recherche:
             st.session_state.show_breakdown_options = True
             st.rerun() # Rerun to show breakdown options UI
 
-        elif isinstance(api_response, list): # Normal successful search (not too large, or already processed)
-            # print(f"{datetime.datetime.now()} - DEBUG - Lancer recherche: API response is a list (normal search).")
-            entreprises_trouvees_list = api_response # Renamed to avoid conflict
-            df_resultats = data_utils.traitement_reponse_api( # This function filters by effectifs again, which is fine as a safeguard
-                entreprises_trouvees_list, st.session_state.selected_effectifs_codes
-            )
+        elif search_completed: # Normal successful search (not too large, or already processed)
+            # print(f"{datetime.datetime.now()} - DEBUG - Lancer recherche: search stream completed (normal search).")
+            df_resultats = pd.concat(df_chunks, ignore_index=True) if df_chunks else pd.DataFrame()
 
-            # --- Client-side filtering by specific NAF codes if selected ---
+            # --- Specific NAF codes: the API filters on the company's code, keep establishments with a selected code ---
             if has_selected_specific_codes and not df_resultats.empty:
                 codes_to_filter_client_side = sorted(list(st.session_state.selected_specific_naf_codes))
                 if codes_to_filter_client_side: 
@@ -766,9 +804,7 @@ if lancer_recherche:
                         df_resultats = df_resultats[df_resultats['code_naf_etablissement'].isin(codes_to_filter_client_side)]
                         filtered_count = len(df_resultats)
                         if original_count > 0 and filtered_count < original_count :
-                             st.info(f"Résultats initiaux ({original_count}) basés sur les sections NAF ont été affinés à {filtered_count} établissements en utilisant les codes NAF spécifiques sélectionnés.")
-                        elif original_count > 0 and filtered_count == 0 and original_count > filtered_count: # Ensure message only if filtering actually happened and resulted in zero
-                            st.info(f"Aucun des {original_count} établissements trouvés pour les sections NAF ne correspond aux codes NAF spécifiques sélectionnés.")
+                             st.info(f"{original_count - filtered_count} établissement(s) dont l'activité propre ne correspond pas aux codes NAF spécifiques sélectionnés ont été écartés ({filtered_count} conservés).")
                         # If filtered_count == original_count, no message needed as filtering had no effect.
                     else:
                         st.warning("Impossible d'affiner par codes NAF spécifiques : colonne 'code_naf_etablissement' manquante dans les résultats.")
@@ -798,9 +834,9 @@ if lancer_recherche:
                 st.session_state.past_searches.insert(0, new_search_entry)
 
 
-            if not entreprises_trouvees_list: # API returned empty list
+            if not entreprises_recues: # API returned no company
                  st.info("Aucune entreprise trouvée pour les critères spécifiés après la recherche complète.")
-            elif df_resultats.empty and entreprises_trouvees_list: # API had results, but filtering by effectifs yielded none
+            elif df_resultats.empty: # API had results, but filtering by effectifs yielded none
                  st.info("Des entreprises ont été trouvées pour les critères NAF/géographiques, mais aucune ne correspond aux tranches d'effectifs sélectionnées.")
 
             # --- Ajout automatique des nouvelles entreprises à l'ERM en session ---
@@ -895,16 +931,12 @@ if st.session_state.get("breakdown_search_pending", False):
     localisation_codes_for_breakdown = context["localisation_codes"]
     code_type_for_breakdown = context["code_type"]
 
-    all_breakdown_results_list = []
+    # Merges companies by SIREN as each NAF subset returns, instead of deduplicating everything at the end
+    breakdown_merge_index = api_client.SirenMergeIndex()
 
     # Add page 1 results from the initial broad query
     if context["page1_results"]:
-        sirens_of_companies_added_from_initial_page1 = set()
-        for company_item_initial_p1 in context["page1_results"]:
-            siren_company_initial_p1 = company_item_initial_p1.get("siren")
-            company_had_new_etab_initial_p1 = False
-            # Simplified: just add the company object. Deduplication by SIREN will happen at the end.
-            all_breakdown_results_list.append(company_item_initial_p1)
+        breakdown_merge_index.add_many(context["page1_results"])
     # print(f"{datetime.datetime.now()} - DEBUG - Breakdown: Added {len(context.get('page1_results', []))} results from initial page 1 of first batch.")
     
     # Determine NAF criteria to iterate for breakdown (same as before, but based on params of the first batch)
@@ -925,7 +957,7 @@ if st.session_state.get("breakdown_search_pending", False):
             for val in individual_naf_values:
                 naf_criteria_to_iterate.append({naf_param_key_used: val.strip()})
         else: # Single NAF value initially, or became single after some processing
-            naf_criteria_to_iterate.append({naf_param_key_used: naf_values_string})
+            naf_criteria_to_iterate.append({naf_param_key_used: naf_values_string_original})
     else: # No NAF filter in original query, or it was empty.
           # We'll run the original query with force_full_fetch=True.
           # This means no NAF key will be in naf_criterion_map for this iteration.
@@ -933,11 +965,6 @@ if st.session_state.get("breakdown_search_pending", False):
 
     with results_container: # Display progress within the results container
         st.info(f"Lancement de la recherche décomposée par critère NAF sur {len(localisation_codes_for_breakdown)} codes {code_type_for_breakdown} ({len(naf_criteria_to_iterate)} sous-ensemble(s) NAF)...")
-        
-        # Clear rate limit timestamps once before the batch of breakdown calls
-        with api_client.rate_limit_lock:
-            api_client.request_timestamps.clear()
-            # print(f"{datetime.datetime.now()} - DEBUG - Request timestamps deque cleared for breakdown search batch.")
 
         for i, naf_criterion_map_for_subset in enumerate(naf_criteria_to_iterate):
             # Params for this NAF subset, to be applied to ALL communes
@@ -966,14 +993,15 @@ if st.session_state.get("breakdown_search_pending", False):
                 localisation_codes_for_breakdown,
                 current_subset_api_params_for_client, # NAF + effectifs for this NAF subset
                 force_full_fetch=True,
-                code_type=code_type_for_breakdown
+                code_type=code_type_for_breakdown,
+                on_event=streamlit_progress.StreamlitSearchProgress()
             )
 
             # The `rechercher_entreprises_par_communes_et_criteres` returns a list of "entreprise" objects
             # or the "NEEDS_BREAKDOWN" dict if the *first batch of its internal commune loop* was too large.
             # Since `force_full_fetch=True` here, it should always return a list (or None for critical error).
             if isinstance(subset_results_list, list):
-                all_breakdown_results_list.extend(subset_results_list)
+                breakdown_merge_index.add_many(subset_results_list)
                 # print(f"{datetime.datetime.now()} - DEBUG - Breakdown by NAF: Added {len(subset_results_list)} items from NAF subset {desc_critere_naf}.")
             elif isinstance(subset_results_list, dict) and subset_results_list.get("status_code") == "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN":
                 # This is an edge case: a NAF-specific query, across multiple communes, where the *first commune batch* was still too large,
@@ -981,43 +1009,25 @@ if st.session_state.get("breakdown_search_pending", False):
                 # We should take its page1_results for this NAF subset.
                 st.warning(f"La sous-recherche NAF {desc_critere_naf} pour le premier lot de communes était encore très volumineuse (même avec force_full_fetch). Seuls les premiers résultats de ce lot sont inclus pour ce critère NAF.")
                 if subset_results_list.get("page1_results"):
-                    all_breakdown_results_list.extend(subset_results_list.get("page1_results"))
+                    breakdown_merge_index.add_many(subset_results_list.get("page1_results"))
             elif subset_results_list is None: # Critical error from API client for this NAF subset
                 st.error(f"Erreur critique lors de la sous-recherche NAF pour {desc_critere_naf}.")
         
         st.markdown("--- \n**Fin de la recherche décomposée par NAF.**")
         st.session_state.breakdown_search_pending = False
-        # print(f"{datetime.datetime.now()} - DEBUG - Breakdown by NAF: Completed. Total items before final deduplication: {len(all_breakdown_results_list)}")
+        # print(f"{datetime.datetime.now()} - DEBUG - Breakdown by NAF: Completed. Unique companies: {len(breakdown_merge_index)}")
         
-        if all_breakdown_results_list:
-            # Deduplicate `all_breakdown_results_list` by SIREN, merging matching_etablissements
-            unique_entreprises_by_siren_bd = {}
-            for entreprise_obj_bd in all_breakdown_results_list:
-                siren_bd = entreprise_obj_bd.get("siren")
-                if siren_bd:
-                    if siren_bd not in unique_entreprises_by_siren_bd:
-                        entreprise_obj_bd["matching_etablissements"] = entreprise_obj_bd.get("matching_etablissements") or []
-                        unique_entreprises_by_siren_bd[siren_bd] = entreprise_obj_bd
-                    else: # Merge matching_etablissements
-                        existing_etabs_sirets_bd = {
-                            etab_bd.get("siret") for etab_bd in unique_entreprises_by_siren_bd[siren_bd].get("matching_etablissements", []) if etab_bd.get("siret")
-                        }
-                        new_etabs_to_add_bd = [
-                            new_etab_bd for new_etab_bd in entreprise_obj_bd.get("matching_etablissements", [])
-                            if new_etab_bd.get("siret") and new_etab_bd.get("siret") not in existing_etabs_sirets_bd
-                        ]
-                        if new_etabs_to_add_bd:
-                            unique_entreprises_by_siren_bd[siren_bd]["matching_etablissements"].extend(new_etabs_to_add_bd)
-                else: # Should be rare
-                    unique_entreprises_by_siren_bd[f"no_siren_{len(unique_entreprises_by_siren_bd)}"] = entreprise_obj_bd
-            
-            deduplicated_entreprise_list_bd = list(unique_entreprises_by_siren_bd.values())
+        if len(breakdown_merge_index):
+            deduplicated_entreprise_list_bd = breakdown_merge_index.entreprises()
             # print(f"{datetime.datetime.now()} - DEBUG - Breakdown by NAF: Deduplicated 'entreprise' items: {len(deduplicated_entreprise_list_bd)}")
 
             df_final_results = data_utils.traitement_reponse_api(
                 deduplicated_entreprise_list_bd, 
                 st.session_state.selected_effectifs_codes # This is now mostly for data transformation, not primary filtering
             )
+            df_final_results = data_utils.filtrer_par_rayon(
+                df_final_results, *context["user_lat_lon"], context["user_radius"]
+            )
 
             # --- Client-side filtering for breakdown results by specific NAF codes ---
             if not df_final_results.empty and st.session_state.selected_specific_naf_codes:
@@ -1588,7 +1598,7 @@ else:  # df_entreprises_erm is not empty
     # "Effectif Numérique" n'est pas affiché directement mais utilisé pour formater "Nb salariés établissement".
     display_order_base = [
         "SIRET", "Dénomination - Enseigne", 
-        "Activité NAF/APE Etablissement", "Adresse établissement", "Commune",
+        "Activité NAF/APE Etablissement", "Adresse établissement", "Commune", "Distance (km)",
         "Nb salariés établissement", # Colonne formatée
         "Est siège social", "Date de création Entreprise"
         # "Chiffre d'Affaires Entreprise", "Résultat Net Entreprise", "Année Finances Entreprise" # Removed for brevity
@@ -1614,6 +1624,7 @@ else:  # df_entreprises_erm is not empty
         "Google Maps": st.column_config.LinkColumn("Google Maps", display_text="📍 Google Maps"),
         "Emploi": st.column_config.LinkColumn("Emploi", display_text="🔗 Emploi"),
         "Est siège social": st.column_config.CheckboxColumn(disabled=True),
+        "Distance (km)": st.column_config.NumberColumn(label="Distance", format="%.1f km", disabled=True),
         "Date de création Entreprise": st.column_config.DateColumn(format="DD/MM/YYYY", disabled=True),
         "Chiffre d'Affaires Entreprise": st.column_config.NumberColumn(label="CA Ent.", format="%d €", disabled=True),
         "Nb salariés établissement": st.column_config.TextColumn(label="Nb salariés établissement"), # Displays the new combined string
@@ -1636,7 +1647,7 @@ try:
 
     excel_column_order_core = [
         "SIRET", "Dénomination - Enseigne", "LinkedIn", "Google Maps", "Emploi",
-        "Activité NAF/APE Etablissement", "Adresse établissement", "Commune",
+        "Activité NAF/APE Etablissement", "Adresse établissement", "Commune", "Distance (km)",
         "Nb salariés établissement", # This will be the formatted version
         "Est siège social", "Date de création Entreprise",
         # "Chiffre d'Affaires Entreprise", "Résultat Net Entreprise", "Année Finances Entreprise" # Removed for brevity
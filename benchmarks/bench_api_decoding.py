@@ -0,0 +1,147 @@
+"""
+Benchmark du décodage des pages /search : temps de décodage et mémoire des résultats conservés, pour
+10 000 entreprises, avec
+  - json (dictionnaires)      : response.json(), l'ancien décodage ;
+  - orjson (dictionnaires)    : le même résultat, décodé par orjson (s'il est installé) ;
+  - api_models.decode_page    : objets Entreprise/Etablissement à slots réduits aux champs utilisés.
+
+Les pages sont celles du faux serveur (fake_api_server.FakeDataset), complétées des champs que renvoie
+l'API réelle avec minimal=true et include=matching_etablissements,finances (dates, listes d'identifiants,
+plusieurs exercices de finances...) ; --cassette mesure plutôt les pages /search d'une cassette enregistrée
+(search_cli.py --record). La mémoire est mesurée dans un processus neuf par décodage : mémoire résidente (RSS)
+gagnée et allocations Python encore vivantes (tracemalloc) une fois toutes les pages décodées.
+
+Usage:
+    python benchmarks/bench_api_decoding.py [--companies 10000] [--repeat 5] [--cassette trafic.jsonl.gz]
+"""
+import argparse
+import gc
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_models  # noqa: E402
+import config  # noqa: E402
+import fake_api_server  # noqa: E402
+
+DECODERS = {
+    "json (dictionnaires)": json.loads,
+    "orjson (dictionnaires)": api_models.orjson.loads if api_models.orjson is not None else None,
+    "api_models.decode_page": api_models.decode_page,
+}
+
+
+def _api_like_entreprise(company, rng_index):
+    # Fields of a real minimal=true answer that the pipeline never reads
+    entreprise = {key: value for key, value in company.items() if key != "etablissements"}
+    entreprise.update({
+        "sigle": None, "nombre_etablissements": len(company["etablissements"]) + rng_index % 3,
+        "categorie_entreprise": "PME", "annee_categorie_entreprise": "2021", "date_fermeture": None,
+        "date_mise_a_jour": "2024-03-01T10:12:33", "date_mise_a_jour_insee": "2024-02-28T04:01:12",
+        "date_mise_a_jour_rne": "2024-01-15T09:30:00", "nature_juridique": "5710",
+        "annee_tranche_effectif_salarie": "2022", "statut_diffusion": "O",
+        "finances": {str(year): {"ca": 10**6 + rng_index * year % 997, "resultat_net": rng_index % 5000} for year in range(2019, 2024)},
+    })
+    entreprise["matching_etablissements"] = [dict(etab, **{
+        "ancien_siege": False, "caractere_employeur": "O", "date_creation": "2001-05-12",
+        "date_debut_activite": "2001-05-12", "date_fermeture": None, "date_mise_a_jour": "2024-03-01T10:12:33",
+        "epci": "200054781", "geo_id": f"{etab['commune']}_B047_0012", "liste_finess": None, "liste_id_bio": None,
+        "liste_idcc": ["1486"], "liste_id_organisme_formation": None, "liste_rge": None, "liste_uai": None,
+        "nom_commercial": None, "region": "11", "statut_diffusion_etablissement": "O",
+    }) for etab in company["etablissements"][:config.API_MATCHING_ETABLISSEMENTS_LIMIT]]
+    return entreprise
+
+
+def _synthetic_pages(n_companies):
+    dataset = fake_api_server.FakeDataset(n_companies)
+    entreprises = [_api_like_entreprise(company, index) for index, company in enumerate(dataset.companies)]
+    per_page = config.API_RESULTS_PER_PAGE
+    return [
+        json.dumps({"results": entreprises[start:start + per_page], "total_results": len(entreprises),
+                    "page": start // per_page + 1, "per_page": per_page}).encode("utf-8")
+        for start in range(0, len(entreprises), per_page)
+    ]
+
+
+def _cassette_pages(path):
+    pages = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("status") == 200 and record["url"].endswith(("/search", "/near_point")):
+                    pages.append(record["body"].encode("utf-8"))
+    return pages
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None # Not Linux: only the tracemalloc figure is reported
+
+
+def _memory_in_fresh_process(args):
+    """Mémoire retenue par les pages décodées : RSS gagnée, ou allocations Python vivantes si trace."""
+    decoder_name, pages, trace = args
+    decode = DECODERS[decoder_name]
+    gc.collect()
+    if trace: # tracemalloc's own bookkeeping inflates the RSS: each figure gets its own process
+        tracemalloc.start()
+        decoded = [decode(body) for body in pages] # Kept alive until measured
+        gc.collect()
+        traced_bytes = tracemalloc.get_traced_memory()[0]
+        del decoded
+        return traced_bytes
+    rss_before = _rss_bytes()
+    decoded = [decode(body) for body in pages] # Kept alive until measured
+    gc.collect()
+    rss_after = _rss_bytes()
+    del decoded
+    return None if rss_before is None else rss_after - rss_before
+
+
+def _memory(decoder_name, pages, trace):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_memory_in_fresh_process, ((decoder_name, pages, trace),))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--companies", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cassette", help="Mesure les pages d'une cassette plutôt que des pages synthétiques")
+    args = parser.parse_args()
+
+    pages = _cassette_pages(args.cassette) if args.cassette else _synthetic_pages(args.companies)
+    n_companies = sum(len(json.loads(body).get("results") or []) for body in pages)
+    scale = 10000 / max(n_companies, 1)
+    print(f"{len(pages)} pages, {n_companies} entreprises, {sum(map(len, pages)) / 1e6:.1f} Mo de JSON ; "
+          f"chiffres ramenés à 10 000 entreprises")
+    print(f"{'Décodage':<26} {'temps (ms)':>11} {'RSS (Mo)':>10} {'objets Python (Mo)':>19}")
+
+    for decoder_name, decode in DECODERS.items():
+        if decode is None:
+            print(f"{decoder_name:<26} {'orjson non installé':>42}")
+            continue
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            decoded = [decode(body) for body in pages]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            del decoded
+        rss, traced = _memory(decoder_name, pages, trace=False), _memory(decoder_name, pages, trace=True)
+        rss_text = "n/a" if rss is None else f"{rss * scale / 1e6:.1f}"
+        print(f"{decoder_name:<26} {best * scale * 1000:>11.1f} {rss_text:>10} {traced * scale / 1e6:>19.1f}")
+
+
+if __name__ == "__main__":
+    main()
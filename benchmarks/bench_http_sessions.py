@@ -0,0 +1,51 @@
+"""
+Benchmark: temps par page avec requests.get (une connexion par appel) contre
+ApiHttpClient (session keep-alive partagée, pool de connexions).
+
+Le faux serveur local (fake_api_server.py, sans latence ni 429) sert /search, ce qui isole
+le coût d'établissement des connexions de la latence réelle de l'API.
+
+Usage:
+    python benchmarks/bench_http_sessions.py [--pages 400] [--workers 6]
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_client  # noqa: E402
+import fake_api_server  # noqa: E402
+
+
+def _run(fetch, url, pages, workers):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda page: fetch(url, params={"code_postal": "75001", "per_page": 25, "page": page}, headers={}, timeout=20).content, range(1, pages + 1)))
+    return (time.perf_counter() - start) / pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=api_client.config.HTTP_POOL_SIZE)
+    args = parser.parse_args()
+
+    with fake_api_server.FakeApiServer() as server:
+        url = f"{server.url}/search"
+        per_page_plain = _run(requests.get, url, args.pages, args.workers)
+        client = api_client.ApiHttpClient(pool_size=args.workers)
+        per_page_pooled = _run(client.get, url, args.pages, args.workers)
+
+    print(f"{args.pages} pages, {args.workers} workers")
+    print(f"requests.get      : {per_page_plain * 1000:.2f} ms/page")
+    print(f"ApiHttpClient.get : {per_page_pooled * 1000:.2f} ms/page")
+    print(f"Gain              : {(1 - per_page_pooled / per_page_plain) * 100:.0f} %")
+
+
+if __name__ == "__main__":
+    main()
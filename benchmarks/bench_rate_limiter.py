@@ -0,0 +1,96 @@
+"""
+Micro-benchmark du limiteur de débit : débit atteint par N threads concurrents
+face à la limite configurée (config.MAX_REQUESTS_PER_SECOND).
+
+Compare api_client.RateLimiter (seau de jetons, attente hors verrou) et sa variante
+FileRateLimiter (état partagé entre processus) à l'ancienne fenêtre glissante qui
+dormait en tenant le verrou. Chaque "requête" simulée dure
+--latency secondes après l'obtention du créneau, comme un appel HTTP.
+
+Usage:
+    python benchmarks/bench_rate_limiter.py [--threads 12] [--duration 5] [--latency 0.3]
+"""
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_client  # noqa: E402
+import config  # noqa: E402
+
+
+class LegacySlidingWindow:
+    """Reproduction de l'ancien limiteur (deque d'horodatages, time.sleep sous le verrou)."""
+
+    def __init__(self):
+        self.timestamps = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            while self.timestamps and self.timestamps[0] <= now - 1.0:
+                self.timestamps.popleft()
+            if len(self.timestamps) >= config.MAX_REQUESTS_PER_SECOND:
+                wait_time = 1.0 - (now - self.timestamps[0]) + config.MIN_DELAY_BETWEEN_REQUESTS
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            self.timestamps.append(time.time())
+
+
+def _measure(limiter, threads, duration, latency):
+    send_times = []
+    send_lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        while time.monotonic() < deadline:
+            limiter.acquire()
+            with send_lock:
+                send_times.append(time.monotonic())
+            time.sleep(latency)  # Simulated HTTP round trip
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    # Throughput over the measurement window, and worst count seen in any sliding second
+    sent_in_window = [t for t in send_times if t < start + duration]
+    worst_second = max(
+        sum(1 for other in sent_in_window if t <= other < t + 1.0) for t in sent_in_window
+    ) if sent_in_window else 0
+    return len(sent_in_window) / duration, worst_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=config.SEARCH_MAX_WORKERS)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.3)
+    args = parser.parse_args()
+
+    limiters = {
+        "Fenêtre glissante (ancienne)": LegacySlidingWindow(),
+        "RateLimiter (seau de jetons)": api_client.RateLimiter(config.MAX_REQUESTS_PER_SECOND, burst=config.RATE_LIMIT_BURST),
+    }
+    if api_client.fcntl is not None:
+        state_file = os.path.join(tempfile.mkdtemp(), "bench_rate_limit.json")
+        limiters["FileRateLimiter (inter-processus)"] = api_client.FileRateLimiter(
+            config.MAX_REQUESTS_PER_SECOND, burst=config.RATE_LIMIT_BURST, state_file=state_file
+        )
+    print(f"Limite configurée : {config.MAX_REQUESTS_PER_SECOND} req/s, {args.threads} threads, latence simulée {args.latency * 1000:.0f} ms")
+    for name, limiter in limiters.items():
+        throughput, worst_second = _measure(limiter, args.threads, args.duration, args.latency)
+        print(f"{name:34s}: {throughput:5.2f} req/s ({throughput / config.MAX_REQUESTS_PER_SECOND * 100:3.0f} % de la limite), max {worst_second} req sur 1 s glissante")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark du traitement des réponses sur du trafic réel : lit une cassette (api_client.cassette,
+search_cli.py --record) et mesure, sur les pages /search enregistrées, la fusion par SIREN,
+data_utils.traitement_reponse_api et la fusion dans l'ERM (data_utils.add_entreprise_records).
+
+Le client HTTP n'intervient pas : les mesures portent sur le traitement des charges utiles réelles,
+identiques d'une exécution et d'une version à l'autre.
+
+Usage:
+    python benchmarks/bench_replay_processing.py trafic.jsonl.gz [--repeat 3]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_client  # noqa: E402
+import config  # noqa: E402
+import data_utils  # noqa: E402
+
+
+def _load_pages(path):
+    """Corps JSON des réponses 200 de /search et tranches d'effectifs demandées."""
+    pages, effectifs = [], set()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("status") != 200 or not record["url"].endswith("/search"):
+                continue
+            pages.append(json.loads(record["body"]))
+            effectifs.update(code for code in str(record["params"].get("tranche_effectif_salarie", "")).split(",") if code)
+    return pages, sorted(effectifs)
+
+
+def _timed(func, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cassette")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages, effectifs = _load_pages(args.cassette)
+    raw_entreprises = [entreprise for page in pages for entreprise in page.get("results", [])]
+    data_utils.get_naf_lookup()
+
+    def merge_by_siren():
+        merge_index = api_client.SirenMergeIndex()
+        merge_index.add_many(raw_entreprises)
+        return merge_index.entreprises()
+
+    merge_s, entreprises = _timed(merge_by_siren, args.repeat)
+    traitement_s, df_resultats = _timed(lambda: data_utils.traitement_reponse_api(entreprises, effectifs), args.repeat)
+    empty_erm = data_utils.ensure_df_schema(pd.DataFrame(), config.ENTREPRISES_ERM_COLS)
+    first_merge_s, df_erm = _timed(lambda: data_utils.add_entreprise_records(empty_erm, df_resultats, config.ENTREPRISES_ERM_COLS), args.repeat)
+    remerge_s, _ = _timed(lambda: data_utils.add_entreprise_records(df_erm, df_resultats, config.ENTREPRISES_ERM_COLS), args.repeat)
+
+    print(f"Cassette : {len(pages)} pages, {len(raw_entreprises)} résultats bruts, effectifs {','.join(effectifs)}")
+    print(f"Fusion par SIREN             : {merge_s * 1000:8.1f} ms ({len(entreprises)} entreprises)")
+    print(f"traitement_reponse_api       : {traitement_s * 1000:8.1f} ms ({len(df_resultats)} établissements)")
+    print(f"ERM, premier ajout           : {first_merge_s * 1000:8.1f} ms")
+    print(f"ERM, même recherche relancée : {remerge_s * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
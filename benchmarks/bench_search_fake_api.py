@@ -0,0 +1,72 @@
+"""
+Benchmark de bout en bout : recherche complète (planification des lots, pages en parallèle, relances)
+contre le faux serveur local (fake_api_server.py), avec latence et 429 injectés.
+
+Mesure la durée, le débit de pages et le nombre de 429 reçus par api_client pour une recherche
+sur tous les codes postaux du jeu de données synthétique. Le cache disque, les comptes stockés et
+les jobs de recherche sont désactivés : chaque exécution interroge réellement le serveur.
+
+Usage:
+    python benchmarks/bench_search_fake_api.py [--companies 20000] [--latency lognormal:0.3:0.5]
+                                               [--rate-429 0.02] [--max-rps 7] [--timeout-rate 0]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_client  # noqa: E402
+import config  # noqa: E402
+import fake_api_server  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--companies", type=int, default=20000)
+    parser.add_argument("--latency", default="lognormal:0.3:0.5")
+    parser.add_argument("--rate-429", type=float, default=0.02)
+    parser.add_argument("--max-rps", type=float, default=config.MAX_REQUESTS_PER_SECOND + 1)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-delay", type=float, default=35.0, help="Plus long que le timeout du client (30 s)")
+    parser.add_argument("--sections", default="C,F,G,J,M")
+    parser.add_argument("--no-hedging", action="store_true", help="Désactive les requêtes couvertes (comparaison)")
+    args = parser.parse_args()
+
+    config.HEDGED_REQUESTS_ENABLED = not args.no_hedging
+    dataset = fake_api_server.FakeDataset(args.companies)
+    api_client.page_cache = None
+    api_client.result_count_store = None
+    api_client.search_job_store = None
+    api_client.rate_controller.state_file = None # Keep the measured rate out of the persisted state
+    events = []
+    with fake_api_server.FakeApiServer(
+        dataset, latency=args.latency, rate_429=args.rate_429, max_rps=args.max_rps or None,
+        timeout_rate=args.timeout_rate, timeout_delay=args.timeout_delay,
+    ) as server:
+        config.API_BASE_URL = server.url
+        start = time.perf_counter()
+        entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(
+            dataset.postal_codes, {"section_activite_principale": args.sections}, force_full_fetch=True,
+            code_type="postal", on_event=events.append,
+        )
+        elapsed = time.perf_counter() - start
+
+    pages = sum(1 for event in events if event["type"] == "page_fetched" and event["success"])
+    throttled = sum(1 for event in events if event["type"] == "throttled")
+    found = len(entreprises) if isinstance(entreprises, list) else entreprises
+    print(f"Serveur : {args.companies} entreprises, latence {args.latency}, 429 {args.rate_429 * 100:.1f} %, max {args.max_rps} req/s")
+    print(f"Entreprises      : {found}")
+    print(f"Durée            : {elapsed:.1f} s")
+    print(f"Pages            : {pages} ({pages / elapsed:.2f} pages/s)")
+    print(f"429 reçus        : {throttled} (client), {server.stats['throttled']} (serveur)")
+    print(f"Requêtes serveur : {server.stats}")
+    print(f"Débit final      : {api_client.rate_limiter.rate:.2f} req/s")
+    latency = next(event["latency"] for event in events if event["type"] == "search_finished")
+    print(f"Durée des pages  : p50 {latency['p50']} s, p95 {latency['p95']} s, p99 {latency['p99']} s, max {latency['max']} s")
+    print(f"Doublons         : {latency['hedged_requests']} requêtes doublées, {latency['hedge_wins']} gagnées par le doublon")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,104 @@
+import os
+import tempfile
+
 import pandas as pd
 
 # --- Constantes API & Rate Limiting ---
 # Defines parameters for interacting with external APIs, focusing on rate limiting.
 MAX_REQUESTS_PER_SECOND = 6
 MIN_DELAY_BETWEEN_REQUESTS = (1.0 / MAX_REQUESTS_PER_SECOND) + 0.02
+# Taille du seau de jetons du limiteur de débit (requêtes pouvant partir d'un coup après une pause).
+# L'API compte les requêtes sur une seconde glissante : avec 1 jeton, une seconde ne voit jamais plus de
+# MAX_REQUESTS_PER_SECOND + 1 requêtes (7 pour 6 req/s, la limite documentée de l'API).
+RATE_LIMIT_BURST = 1
+# "file" : budget de débit partagé par tous les processus et sessions Streamlit de la machine (fichier verrouillé),
+# "memory" : budget propre à chaque processus.
+RATE_LIMIT_BACKEND = "file"
+RATE_LIMIT_STATE_FILE = os.path.join(tempfile.gettempdir(), "recherche_entreprises_rate_limit.json")
 MAX_RETRIES_ON_429 = 3
 INITIAL_RETRY_DELAY = 5
-API_BASE_URL = "https://recherche-entreprises.api.gouv.fr"
+# Contrôle adaptatif du débit (AIMD) : MAX_REQUESTS_PER_SECOND, la limite documentée de l'API, est à la fois
+# le débit de départ et le plafond ; le contrôleur ne travaille qu'en dessous, sans chercher de 429 au-delà.
+# Le débit monte de ADAPTIVE_RATE_INCREASE_STEP req/s par seconde de réponses réussies et est multiplié
+# par ADAPTIVE_RATE_DECREASE_FACTOR sur un 429, un 5xx ou un pic de latence (latence > facteur x moyenne mobile),
+# au plus une fois par ADAPTIVE_RATE_DECREASE_COOLDOWN secondes. Un 429 suspend aussi tout le pool
+# pendant la durée Retry-After. Le débit atteint est enregistré pour les recherches suivantes.
+ADAPTIVE_RATE_MIN = 1.0
+ADAPTIVE_RATE_MAX = float(MAX_REQUESTS_PER_SECOND)
+ADAPTIVE_RATE_INCREASE_STEP = 0.5
+ADAPTIVE_RATE_DECREASE_FACTOR = 0.7
+ADAPTIVE_RATE_LATENCY_SPIKE_FACTOR = 3.0
+ADAPTIVE_RATE_DECREASE_COOLDOWN = 2.0
+ADAPTIVE_RATE_STATE_FILE = os.path.join(tempfile.gettempdir(), "recherche_entreprises_adaptive_rate.json")
+# URL de l'API, remplaçable par la variable d'environnement RECHERCHE_ENTREPRISES_API_URL (ex. fake_api_server.py).
+API_BASE_URL = os.environ.get("RECHERCHE_ENTREPRISES_API_URL", "https://recherche-entreprises.api.gouv.fr")
 API_MAX_TOTAL_RESULTS = 10000 # Documented limit for the API
 API_RESULTS_PER_PAGE = 25 # Standard per_page value used
 API_MAX_PAGES = API_MAX_TOTAL_RESULTS // API_RESULTS_PER_PAGE
+# Nombre de workers de l'ordonnanceur de pages partagé par tous les lots d'une recherche.
+# Débit x latence (loi de Little) : avec ~1 s de latence, 2x le débit permet de rester à la limite.
+SEARCH_MAX_WORKERS = 2 * MAX_REQUESTS_PER_SECOND
+# Nombre de connexions keep-alive conservées par le pool HTTP partagé (une connexion par requête en vol).
+# Égal au nombre de workers : chaque worker peut réutiliser une connexion sans en ouvrir de nouvelle.
+HTTP_POOL_SIZE = SEARCH_MAX_WORKERS
+# Requêtes couvertes (hedging) : une requête sans réponse après le percentile HEDGE_LATENCY_PERCENTILE des
+# HEDGE_LATENCY_WINDOW dernières latences (au moins HEDGE_MIN_DELAY secondes) est doublée, et la première
+# réponse est gardée. Le doublon n'utilise qu'un jeton disponible immédiatement : il ne retarde aucune autre requête.
+HEDGED_REQUESTS_ENABLED = True
+HEDGE_LATENCY_PERCENTILE = 95
+HEDGE_LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20 # Pas de doublon tant que les latences récentes ne sont pas connues
+HEDGE_MIN_DELAY = 0.5
+# Threads partagés par les requêtes couvertes (requête et doublon) ; sans thread libre, la requête part sans doublon.
+HEDGE_MAX_THREADS = 2 * SEARCH_MAX_WORKERS
+# Disjoncteur commun à toutes les requêtes : s'ouvre quand au moins CIRCUIT_BREAKER_ERROR_RATE des
+# CIRCUIT_BREAKER_WINDOW dernières réponses (timeouts, erreurs réseau, 5xx ; au moins CIRCUIT_BREAKER_MIN_CALLS)
+# sont des échecs. Ouvert, il fait échouer les requêtes immédiatement (les pages en cache restent servies,
+# même expirées) ; après CIRCUIT_BREAKER_OPEN_SECONDS, une requête d'essai décide de sa fermeture.
+CIRCUIT_BREAKER_ENABLED = True
+CIRCUIT_BREAKER_WINDOW = 20
+CIRCUIT_BREAKER_MIN_CALLS = 10
+CIRCUIT_BREAKER_ERROR_RATE = 0.5
+CIRCUIT_BREAKER_OPEN_SECONDS = 30
+# Cache disque (SQLite) des pages /search : une recherche répétée ou qui recoupe une recherche récente
+# relit ses pages sur disque au lieu de les redemander à l'API.
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_FILE = os.path.join(tempfile.gettempdir(), "recherche_entreprises_pages.sqlite3")
+PAGE_CACHE_TTL_SECONDS = 24 * 3600 # Les données de l'API sont mises à jour quotidiennement
+PAGE_CACHE_MAX_BYTES = 200 * 1024 * 1024 # Taille maximale des pages compressées, éviction LRU au-delà
+# Planification des lots de codes postaux/communes selon leur densité : les codes sont regroupés en aussi peu
+# d'appels que possible, chaque appel restant sous BATCH_PLANNER_FILL_RATIO x API_MAX_TOTAL_RESULTS résultats
+# (marge pour les comptes qui évoluent). Les comptes par code sont conservés RESULT_COUNT_TTL_SECONDS
+# (dans le fichier du cache de pages). Les codes inconnus sont regroupés par MAX_CODES_PER_API_CALL : la page 1
+# de chaque lot sert de sonde et seuls les lots trop larges sont découpés. Ils sont sondés (une requête per_page=1
+# par code, une seule fois par code et par filtres) quand une partie des codes est déjà connue, ou toujours si
+# BATCH_PLANNER_PROBE_UNKNOWN (une recherche à froid enverrait alors plus de requêtes).
+RESULT_COUNT_STORE_ENABLED = True
+RESULT_COUNT_TTL_SECONDS = 7 * 24 * 3600
+BATCH_PLANNER_PROBE_UNKNOWN = False
+BATCH_PLANNER_FILL_RATIO = 0.9
+BATCH_PLANNER_MAX_CODES_PER_CALL = 50 # Garde des URL de taille raisonnable
+# Codes NAF spécifiques (activite_principale) envoyés par appel : une liste plus longue est répartie sur plusieurs appels.
+MAX_NAF_CODES_PER_API_CALL = 40
+# Établissements correspondants renvoyés par entreprise (limite_matching_etablissements, 100 au plus pour l'API).
+API_MATCHING_ETABLISSEMENTS_LIMIT = 100
+# Complétion des grandes entreprises : une entreprise qui atteint la limite ci-dessus dans une requête est
+# redemandée seule (q=SIREN) en fin de recherche, la zone étant coupée en deux jusqu'à ce que chaque appel
+# reste sous la limite. Les recherches sans grande entreprise n'envoient aucune requête de plus.
+COMPLETE_LARGE_ENTREPRISES = True
+# Recherche géographique native (/near_point) : rayon maximal accepté par l'API, en kilomètres.
+NEAR_POINT_MAX_RADIUS_KM = 50
+# Découpage automatique des requêtes qui atteignent API_MAX_PAGES (limite de 10 000 résultats de l'API) :
+# la requête est coupée en deux par codes de localisation, puis sections NAF, divisions NAF, codes NAF et
+# tranches d'effectifs, récursivement, jusqu'à ce que chaque sous-requête tienne sous la limite.
+# Si False, la recherche s'arrête et demande à l'utilisateur (statut NEEDS_USER_CONFIRMATION_OR_BREAKDOWN).
+AUTO_SPLIT_ENABLED = True
+# Recherches reprenables : chaque recherche enregistre son plan et ses pages dans SEARCH_JOBS_FILE. Relancer
+# une recherche interrompue (session rechargée, onglet fermé, page en échec) ne redemande que les pages manquantes.
+# Les jobs plus anciens que SEARCH_JOBS_MAX_AGE_SECONDS ne sont plus repris et sont supprimés.
+SEARCH_JOBS_ENABLED = True
+SEARCH_JOBS_FILE = os.path.join(tempfile.gettempdir(), "recherche_entreprises_jobs.sqlite3")
+SEARCH_JOBS_MAX_AGE_SECONDS = 24 * 3600 # Au-delà, les données de l'API ont pu changer
 
 
 
@@ -26,6 +115,7 @@ ENTREPRISES_ERM_COLS = [
     "Activité NAF/APE Etablissement",
     "Adresse établissement",
     "Commune",
+    "Distance (km)",       # Distance to the centre of the search that found the establishment
     "Code effectif établissement",
     "Nb salariés établissement",
     "Effectif Numérique",
@@ -49,6 +139,7 @@ ENTREPRISES_ERM_DTYPES = {
     "Activité NAF/APE Etablissement": pd.StringDtype(),
     "Adresse établissement": pd.StringDtype(),
     "Commune": pd.StringDtype(),
+    "Distance (km)": pd.Float64Dtype(),
     "Code effectif établissement": pd.StringDtype(),
     "Nb salariés établissement": pd.StringDtype(),
     "Effectif Numérique": pd.Int64Dtype(),
@@ -389,6 +480,7 @@ COLS_EXPORT_ORDER = [
     "Est siège social",
     "Adresse établissement",
     "Commune",
+    "Distance (km)",
     "Nb salariés établissement",
     "Année nb salariés établissement",
     "Code effectif établissement",
@@ -268,9 +268,9 @@ def traitement_reponse_api(entreprises, selected_effectifs_codes):
                         "resultat_net_entreprise": resultat_net_latest,
                     }
                 )
-    print(
-        f"{dt.datetime.now()} - DEBUG - traitement_reponse_api: Processed SIRENs: {len(processed_sirens)}. Total establishments processed: {num_etablissements_processed}. Matched establishments: {num_etablissements_matched}."
-    )
+    # print(
+    #     f"{dt.datetime.now()} - DEBUG - traitement_reponse_api: Processed SIRENs: {len(processed_sirens)}. Total establishments processed: {num_etablissements_processed}. Matched establishments: {num_etablissements_matched}."
+    # )
     if not all_etablissements_data:
         # print(f"{dt.datetime.now()} - DEBUG - traitement_reponse_api: No establishments matched criteria. Returning empty DataFrame.")
         return pd.DataFrame()
@@ -329,6 +329,46 @@ def traitement_reponse_api(entreprises, selected_effectifs_codes):
     # print(f"{dt.datetime.now()} - DEBUG - traitement_reponse_api: Final DataFrame has {len(final_df_result)} rows.")
     return final_df_result
 
+
+EARTH_RADIUS_KM = 6371.0088 # Mean Earth radius used by the haversine distance
+
+
+def haversine_km(lat_centre, lon_centre, latitudes, longitudes):
+    """
+    Vectorised haversine distance, in km, between a centre point and arrays of coordinates (in degrees).
+    NaN coordinates give a NaN distance.
+    """
+    lat1, lon1 = np.radians(lat_centre), np.radians(lon_centre)
+    lat2 = np.radians(np.asarray(latitudes, dtype=float))
+    lon2 = np.radians(np.asarray(longitudes, dtype=float))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def filtrer_par_rayon(df_resultats, lat_centre, lon_centre, radius_km):
+    """
+    Exact-radius post-filter for the output of traitement_reponse_api.
+    The search goes by postal code, so it also returns establishments of the postal areas overlapping the circle:
+    this drops the establishments farther than radius_km from the centre and adds a "Distance (km)" column
+    (rounded to 0.1 km) placed after "Commune". Establishments without coordinates cannot be placed and are kept,
+    with an empty distance.
+    """
+    if df_resultats is None or df_resultats.empty or "Latitude" not in df_resultats.columns or "Longitude" not in df_resultats.columns:
+        return df_resultats
+    distances = haversine_km(
+        lat_centre, lon_centre,
+        df_resultats["Latitude"].to_numpy(dtype=float, na_value=np.nan),
+        df_resultats["Longitude"].to_numpy(dtype=float, na_value=np.nan),
+    )
+    in_radius = np.isnan(distances) | (distances <= radius_km)
+    df_in_radius = df_resultats[in_radius].copy()
+    df_in_radius.insert(
+        df_in_radius.columns.get_loc("Commune") + 1 if "Commune" in df_in_radius.columns else len(df_in_radius.columns),
+        "Distance (km)",
+        pd.array(np.round(distances[in_radius], 1), dtype=pd.Float64Dtype()),
+    )
+    return df_in_radius
+
 def sanitize_column_name_for_my_maps(name: str) -> str:
     """
     Sanitizes a column name to be compatible with Google My Maps import requirements.
@@ -431,6 +471,7 @@ def generate_erm_excel(df_entreprises_input: pd.DataFrame):
                 "Activité NAF/APE Etablissement",
                 "Commune", # <-- ADDED COMMUNE
                 "Adresse établissement",
+                "Distance (km)",
                 "Nb salariés établissement",
                 "Est siège social",
                 "Date de création Entreprise",
@@ -847,6 +888,7 @@ def generate_user_erm_excel(
                 "Activité NAF/APE Etablissement",
                 "Commune", # <-- ADDED COMMUNE
                 "Adresse établissement",
+                "Distance (km)",
                 "Nb salariés établissement",
                 "Est siège social",
                 "Date de création Entreprise",
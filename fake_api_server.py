@@ -0,0 +1,379 @@
+"""
+Serveur local qui imite l'API Recherche d'entreprises (/search et /near_point) avec des entreprises
+synthétiques, pour mesurer le débit et le comportement de relance de api_client sans solliciter l'API réelle.
+
+- Entreprises indexées par code postal et code commune de leurs établissements ; filtres
+  section_activite_principale, activite_principale, tranche_effectif_salarie, etat_administratif, et q
+  (SIREN seulement) ; limite_matching_etablissements (10 par défaut, comme l'API).
+- Pagination page / per_page (25 au plus) ; au-delà de 10 000 résultats, la page est refusée (400), comme l'API.
+- Injection de défauts : distribution de latence, proportion de 429 (avec Retry-After), débit maximal
+  par seconde (429 au-delà), proportion de réponses bloquées plus longtemps que le timeout du client,
+  proportion de 503 (panne de l'API).
+
+Usage:
+    python fake_api_server.py [--port 8765] [--companies 20000] [--latency lognormal:0.3:0.5]
+                              [--rate-429 0.02] [--max-rps 7] [--timeout-rate 0.001]
+puis, pour y diriger l'application ou search_cli.py :
+    RECHERCHE_ENTREPRISES_API_URL=http://127.0.0.1:8765 streamlit run app.py
+"""
+import argparse
+import functools
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+DEFAULT_POSTAL_CODES = (
+    [f"750{n:02d}" for n in range(1, 21)]
+    + [f"6900{n}" for n in range(1, 10)]
+    + [f"130{n:02d}" for n in range(1, 17)]
+    + ["31000", "31100", "31200", "31300", "31400", "31500", "33000", "33100", "33200", "33300", "33800",
+       "44000", "44100", "44200", "44300", "59000", "59160", "59260", "59800", "67000", "67100", "67200",
+       "34000", "34070", "34080", "34090", "35000", "35200", "35700", "06000", "06100", "06200", "06300"]
+)
+MAX_PER_PAGE = 25
+NEAR_POINT_MAX_RADIUS_KM = 50
+
+
+def commune_for_postal_code(postal_code):
+    """Code commune synthétique d'un code postal (75001 -> 75101, comme les arrondissements de Paris)."""
+    return f"{postal_code[:2]}{100 + int(postal_code[3:]):03d}"
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+class FakeDataset:
+    """
+    Entreprises synthétiques reproductibles (graine seed). Les codes postaux ont des densités très
+    inégales (loi de Zipf), pour exercer le planificateur de lots et le découpage des requêtes trop larges.
+    large_companies entreprises de large_company_size établissements répartis sur tous les codes (chaînes,
+    grands groupes) s'ajoutent aux n_companies entreprises de 1 à 4 établissements.
+    """
+
+    def __init__(self, n_companies=5000, postal_codes=None, seed=0, large_companies=0, large_company_size=250):
+        rng = random.Random(seed)
+        postal_codes = list(postal_codes or DEFAULT_POSTAL_CODES)
+        centers = {}
+        for postal_code in postal_codes:
+            if postal_code.startswith("75"):
+                centers[postal_code] = (48.86 + rng.uniform(-0.03, 0.03), 2.35 + rng.uniform(-0.05, 0.05))
+            else:
+                centers[postal_code] = (rng.uniform(43.0, 50.5), rng.uniform(-1.5, 7.5))
+        weights = [1 / (rank ** 0.8) for rank in range(1, len(postal_codes) + 1)]
+        divisions = sorted(config.NAF_SECTION_MAP)
+        tranches = [code for code in config.effectifs_tranches if code != "NN"]
+
+        self.companies = []
+        self.companies_by_code = {} # code_postal or code_commune -> indexes of companies with an establishment there
+        for index in range(n_companies + large_companies):
+            is_large = index >= n_companies
+            siren = f"{100000000 + index * 7:09d}"
+            naf_code = f"{rng.choice(divisions)}.{rng.randint(0, 99):02d}Z"
+            tranche = rng.choice(tranches)
+            home_postal_code = rng.choices(postal_codes, weights)[0]
+            etablissements = []
+            for etab_index in range(large_company_size if is_large else rng.choice([1, 1, 1, 2, 2, 3, 4])):
+                if is_large:
+                    postal_code = rng.choices(postal_codes, weights)[0]
+                else:
+                    postal_code = home_postal_code if etab_index == 0 or rng.random() < 0.6 else rng.choices(postal_codes, weights)[0]
+                lat, lon = centers[postal_code]
+                etablissements.append({
+                    "siret": f"{siren}{etab_index + 1:05d}",
+                    "adresse": f"{rng.randint(1, 200)} rue de l'Exemple {postal_code}",
+                    "code_postal": postal_code,
+                    "commune": commune_for_postal_code(postal_code),
+                    "libelle_commune": f"Commune {postal_code}",
+                    "latitude": f"{lat + rng.uniform(-0.02, 0.02):.6f}",
+                    "longitude": f"{lon + rng.uniform(-0.03, 0.03):.6f}",
+                    "activite_principale": naf_code,
+                    "tranche_effectif_salarie": tranche,
+                    "annee_tranche_effectif_salarie": "2022",
+                    "est_siege": etab_index == 0,
+                    "etat_administratif": "A" if rng.random() < 0.97 else "F",
+                    "liste_enseignes": [],
+                })
+            company = {
+                "siren": siren,
+                "nom_complet": f"ENTREPRISE {index}",
+                "nom_raison_sociale": f"ENTREPRISE {index}",
+                "date_creation": f"{rng.randint(1970, 2023)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+                "nombre_etablissements_ouverts": sum(etab["etat_administratif"] == "A" for etab in etablissements),
+                "activite_principale": naf_code,
+                "section_activite_principale": config.NAF_SECTION_MAP[naf_code[:2]],
+                "tranche_effectif_salarie": tranche,
+                "etat_administratif": "A",
+                "finances": {"2023": {"ca": rng.randint(10**5, 10**8), "resultat_net": rng.randint(-10**6, 10**7)}},
+                "etablissements": etablissements,
+            }
+            self.companies.append(company)
+            for etab in etablissements:
+                self.companies_by_code.setdefault(etab["code_postal"], set()).add(index)
+                self.companies_by_code.setdefault(etab["commune"], set()).add(index)
+        self.postal_codes = postal_codes
+        self.matching = functools.lru_cache(maxsize=256)(self._matching)
+
+    @staticmethod
+    def _values(params, name):
+        value = params.get(name)
+        return frozenset(v.strip() for v in value.split(",") if v.strip()) if value else None
+
+    def query_key(self, params):
+        """Paramètres qui déterminent l'ensemble des résultats (la pagination exclue)."""
+        names = ("q", "code_postal", "code_commune", "section_activite_principale", "activite_principale",
+                 "tranche_effectif_salarie", "etat_administratif", "lat", "long", "radius")
+        return tuple((name, self._values(params, name)) for name in names)
+
+    def _matching(self, query_key):
+        """Liste triée des (entreprise, établissements correspondants) d'une requête (voir query_key)."""
+        filters = dict(query_key)
+        if filters["lat"] is not None:
+            lat, lon = float(next(iter(filters["lat"]))), float(next(iter(filters["long"])))
+            radius = min(float(next(iter(filters["radius"] or {"5"}))), NEAR_POINT_MAX_RADIUS_KM)
+
+            def etab_matches(etab):
+                return _haversine_km(lat, lon, float(etab["latitude"]), float(etab["longitude"])) <= radius
+            candidates = range(len(self.companies))
+        else:
+            codes = (filters["code_postal"] or frozenset()) | (filters["code_commune"] or frozenset())
+
+            def etab_matches(etab):
+                return etab["code_postal"] in codes or etab["commune"] in codes
+            candidates = sorted(set().union(*(self.companies_by_code.get(code, ()) for code in codes))) if codes else range(len(self.companies))
+
+        results = []
+        for index in candidates:
+            company = self.companies[index]
+            if filters["q"] and company["siren"] not in filters["q"]:
+                continue
+            if filters["section_activite_principale"] and company["section_activite_principale"] not in filters["section_activite_principale"]:
+                continue
+            if filters["activite_principale"] and company["activite_principale"] not in filters["activite_principale"]:
+                continue
+            if filters["tranche_effectif_salarie"] and company["tranche_effectif_salarie"] not in filters["tranche_effectif_salarie"]:
+                continue
+            if filters["etat_administratif"] and company["etat_administratif"] not in filters["etat_administratif"]:
+                continue
+            matching_etabs = [etab for etab in company["etablissements"] if etab_matches(etab)]
+            if matching_etabs:
+                results.append((company, matching_etabs))
+        return results
+
+    def page(self, params):
+        """Réponse JSON (dict) d'une page, ou None si la page dépasse la limite des 10 000 résultats."""
+        per_page = max(1, min(int(params.get("per_page", 10)), MAX_PER_PAGE))
+        page = max(1, int(params.get("page", 1)))
+        if page * per_page > config.API_MAX_TOTAL_RESULTS:
+            return None
+        matching = self.matching(self.query_key(params))
+        limit_etabs = int(params.get("limite_matching_etablissements", 10))
+        results = []
+        for company, matching_etabs in matching[(page - 1) * per_page:page * per_page]:
+            result = {key: value for key, value in company.items() if key != "etablissements"}
+            result["matching_etablissements"] = matching_etabs[:limit_etabs]
+            results.append(result)
+        return {
+            "results": results,
+            "total_results": len(matching),
+            "page": page,
+            "per_page": per_page,
+            "total_pages": -(-len(matching) // per_page),
+        }
+
+
+def parse_latency(spec):
+    """
+    Distribution de latence (secondes) : "0.05" (fixe), "uniform:min:max", "lognormal:mediane:sigma"
+    ou "exp:moyenne". Retourne une fonction rng -> durée.
+    """
+    kind, *args = str(spec).split(":")
+    if not args:
+        return lambda rng: float(kind)
+    values = [float(arg) for arg in args]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"Distribution de latence inconnue : {spec}")
+
+
+class FakeApiServer:
+    """
+    Serveur HTTP/1.1 (keep-alive, un thread par connexion) servant un FakeDataset, avec injection de défauts.
+    S'utilise comme gestionnaire de contexte ; url est la base à utiliser pour config.API_BASE_URL.
+    """
+
+    def __init__(self, dataset=None, host="127.0.0.1", port=0, latency="0", rate_429=0.0, retry_after=1,
+                 max_rps=None, timeout_rate=0.0, timeout_delay=30.0, rate_503=0.0, seed=0):
+        self.dataset = dataset if dataset is not None else FakeDataset(seed=seed)
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.max_rps = max_rps
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.rate_503 = rate_503
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = max_rps or 0
+        self._tokens_updated_at = time.monotonic()
+        self._stopped = threading.Event()
+        self.stats = {"requests": 0, "ok": 0, "throttled": 0, "timeouts": 0, "unavailable": 0, "errors": 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _draw(self):
+        """Tirages d'une requête : latence, 429 aléatoire, blocage (timeout), 503, sous le verrou du générateur."""
+        with self._lock:
+            return (self.latency(self._rng), self._rng.random() < self.rate_429, self._rng.random() < self.timeout_rate,
+                    self._rng.random() < self.rate_503)
+
+    def _over_max_rps(self):
+        # Token bucket of max_rps tokens refilled at max_rps per second, as the real API's limit per IP
+        if not self.max_rps:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_rps, self._tokens + (now - self._tokens_updated_at) * self.max_rps)
+            self._tokens_updated_at = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _send_json(self, status, body, headers=None):
+                payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                server._count("requests")
+                parsed = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(parsed.query))
+                latency, throttled, stalled, unavailable = server._draw()
+                if server._over_max_rps() or throttled:
+                    server._count("throttled")
+                    self._send_json(429, {"erreur": "Trop de requêtes"}, {"Retry-After": str(server.retry_after)})
+                    return
+                if stalled:
+                    server._count("timeouts")
+                    server._stopped.wait(server.timeout_delay) # Longer than the client's timeout
+                elif latency > 0:
+                    time.sleep(latency)
+                if unavailable:
+                    server._count("unavailable")
+                    self._send_json(503, {"erreur": "Service indisponible"})
+                    return
+                if parsed.path == "/near_point":
+                    if "lat" not in params or "long" not in params:
+                        server._count("errors")
+                        self._send_json(400, {"erreur": "Les paramètres lat et long sont obligatoires"})
+                        return
+                elif parsed.path != "/search":
+                    server._count("errors")
+                    self._send_json(404, {"erreur": "Route inconnue"})
+                    return
+                try:
+                    body = server.dataset.page(params)
+                except ValueError as exc:
+                    server._count("errors")
+                    self._send_json(400, {"erreur": f"Paramètre invalide : {exc}"})
+                    return
+                if body is None:
+                    server._count("errors")
+                    self._send_json(400, {"erreur": f"Seuls les {config.API_MAX_TOTAL_RESULTS} premiers résultats sont accessibles"})
+                    return
+                server._count("ok")
+                self._send_json(200, body)
+
+            def log_message(self, format, *args): # Silence per-request logging
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set() # Releases stalled requests
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--companies", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--large-companies", type=int, default=0, help="Entreprises à établissements nombreux (chaînes)")
+    parser.add_argument("--large-company-size", type=int, default=250)
+    parser.add_argument("--latency", default="lognormal:0.3:0.5", help="0.05, uniform:min:max, lognormal:mediane:sigma ou exp:moyenne")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Proportion de réponses 429 aléatoires")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-rps", type=float, default=config.MAX_REQUESTS_PER_SECOND, help="Débit maximal avant 429 (0 : illimité)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Proportion de requêtes bloquées --timeout-delay secondes")
+    parser.add_argument("--timeout-delay", type=float, default=35.0)
+    parser.add_argument("--rate-503", type=float, default=0.0, help="Proportion de réponses 503 (panne de l'API)")
+    args = parser.parse_args()
+
+    dataset = FakeDataset(args.companies, seed=args.seed, large_companies=args.large_companies, large_company_size=args.large_company_size)
+    server = FakeApiServer(
+        dataset, host=args.host, port=args.port, latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after,
+        max_rps=args.max_rps or None, timeout_rate=args.timeout_rate, timeout_delay=args.timeout_delay, rate_503=args.rate_503,
+        seed=args.seed,
+    )
+    print(f"Faux serveur API sur {server.url} ({len(dataset.companies)} entreprises, {len(dataset.postal_codes)} codes postaux)")
+    print(f"RECHERCHE_ENTREPRISES_API_URL={server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f"Statistiques : {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
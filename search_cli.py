@@ -0,0 +1,235 @@
+"""
+Recherche d'entreprises en ligne de commande, sans interface Streamlit : exécute une recherche
+(adresse, rayon, sections/codes NAF, tranches d'effectifs) par ligne d'un fichier CSV ou JSONL,
+et écrit un fichier de résultats (CSV ou Parquet) par ligne, ainsi qu'un rapport de durées.
+
+Chaque ligne suit le parcours de app.py : géocodage (BAN), codes postaux des communes dans le rayon,
+recherche paginée par lots (api_client), puis mise en forme (data_utils.traitement_reponse_api), filtre
+exact sur le rayon (data_utils.filtrer_par_rayon) et filtre par codes NAF spécifiques. Les lignes s'exécutent
+en parallèle et partagent le même budget de débit (api_client.rate_limiter) ; une recherche trop large est
+découpée, jamais soumise à confirmation.
+
+Colonnes (CSV) ou clés (JSONL) :
+    id          Identifiant de la ligne, utilisé pour le nom du fichier de sortie (facultatif, sinon n° de ligne)
+    adresse     Adresse de référence
+    rayon_km    Rayon de recherche en kilomètres
+    sections    Sections NAF (ex. "J,M") ; déduites des codes NAF si absentes
+    codes_naf   Codes NAF spécifiques (ex. "62.01Z,62.02A"), facultatif : envoyés à l'API à la place des sections
+    effectifs   Codes de tranches d'effectifs (ex. "11,12,21")
+    mode        "codes_postaux" (par défaut : codes postaux des communes du rayon) ou "rayon" (recherche
+                géographique de l'API autour du point, sans passer par les codes postaux), facultatif
+Les listes sont séparées par des virgules en CSV, et peuvent être des listes JSON en JSONL.
+
+Usage:
+    python search_cli.py recherches.csv --output-dir resultats [--format csv|parquet] [--workers 4]
+                         [--record trafic.jsonl.gz | --replay trafic.jsonl.gz [--replay-timing original|fast]]
+--record enregistre tout le trafic API dans une cassette ; --replay rejoue une cassette au lieu d'appeler l'API
+(api_client.cassette), pour reproduire une recherche lente ou comparer deux versions du client sur le même trafic.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import importlib.util
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import api_client
+import data_utils
+import geo_utils
+
+REPORT_COLUMNS = [
+    "id", "statut", "message", "codes_postaux", "pages", "reponses_429", "entreprises", "etablissements",
+    "geocodage_s", "communes_s", "recherche_s", "traitement_s", "total_s", "page_p50_s", "page_p95_s", "page_max_s",
+    "requetes_doublees", "fichier",
+]
+SEARCH_MODES = ("codes_postaux", "rayon")
+
+# The commune lookup scans every French commune in Python: rows take turns instead of competing for the GIL,
+# and the first row downloads the communes cache alone.
+_communes_lock = threading.Lock()
+
+
+def _split_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        values = value
+    else:
+        values = str(value).split(",")
+    return [str(v).strip() for v in values if str(v).strip()]
+
+
+def read_search_rows(path):
+    """Lit les recherches d'un fichier .csv ou .jsonl ; chaque ligne devient un dictionnaire normalisé."""
+    if path.lower().endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            raw_rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            raw_rows = list(csv.DictReader(f))
+
+    rows = []
+    for line_number, raw_row in enumerate(raw_rows, start=1):
+        rows.append({
+            "id": str(raw_row.get("id") or line_number),
+            "adresse": (raw_row.get("adresse") or "").strip(),
+            "rayon_km": float(raw_row.get("rayon_km") or 0),
+            "sections": [section.upper() for section in _split_list(raw_row.get("sections"))],
+            "codes_naf": _split_list(raw_row.get("codes_naf")),
+            "effectifs": _split_list(raw_row.get("effectifs")),
+            "mode": (raw_row.get("mode") or "codes_postaux").strip().lower(),
+        })
+    return rows
+
+
+def _output_path(output_dir, row_id, output_format):
+    safe_id = re.sub(r"[^\w.-]+", "_", row_id).strip("_") or "recherche"
+    return os.path.join(output_dir, f"{safe_id}.{output_format}")
+
+
+def run_search_row(row, output_dir, output_format):
+    """
+    Exécute la recherche d'une ligne et écrit ses résultats.
+    Returns:
+        dict: Ligne du rapport (voir REPORT_COLUMNS), statut "ok", "vide" ou "erreur".
+    """
+    report = dict.fromkeys(REPORT_COLUMNS, "")
+    report.update(id=row["id"], pages=0, reponses_429=0)
+    start = time.perf_counter()
+
+    def on_event(event):
+        # Headless run: only counters are kept; errors end up in the report message
+        if event["type"] == "page_fetched":
+            report["pages"] += 1
+        elif event["type"] == "throttled":
+            report["reponses_429"] += 1
+        elif event["type"] == "error" and not report["message"]:
+            report["message"] = event["message"]
+        elif event["type"] == "search_finished" and event.get("latency"):
+            # Tail latency of the search: a slow page holds up its whole query
+            report.update(page_p50_s=event["latency"]["p50"], page_p95_s=event["latency"]["p95"],
+                          page_max_s=event["latency"]["max"], requetes_doublees=event["latency"]["hedged_requests"])
+
+    def finish(status, message=None):
+        report["statut"] = status
+        if message:
+            report["message"] = message
+        report["total_s"] = round(time.perf_counter() - start, 2)
+        return report
+
+    sections = row["sections"] or sorted({data_utils.get_section_for_code(code) for code in row["codes_naf"]} - {None})
+    if not row["adresse"] or row["rayon_km"] <= 0:
+        return finish("erreur", "Adresse ou rayon manquant.")
+    if not sections or not row["effectifs"]:
+        return finish("erreur", "Aucune section NAF ou tranche d'effectifs.")
+    search_mode = row.get("mode", "codes_postaux")
+    if search_mode not in SEARCH_MODES:
+        return finish("erreur", f"Mode de recherche inconnu : {search_mode} (attendu : {', '.join(SEARCH_MODES)}).")
+
+    step_start = time.perf_counter()
+    coordonnees = geo_utils.geocoder_ban_france(row["adresse"])
+    report["geocodage_s"] = round(time.perf_counter() - step_start, 2)
+    if coordonnees is None:
+        return finish("erreur", f"Adresse introuvable : {row['adresse']}")
+
+    if search_mode == "codes_postaux":
+        step_start = time.perf_counter()
+        with _communes_lock:
+            postal_codes = geo_utils.get_communes_in_radius_cached(coordonnees[0], coordonnees[1], row["rayon_km"])
+        report["communes_s"] = round(time.perf_counter() - step_start, 2)
+        report["codes_postaux"] = len(postal_codes)
+        if not postal_codes:
+            return finish("vide", "Aucun code postal dans le rayon.")
+
+    api_params = {"tranche_effectif_salarie": ",".join(row["effectifs"])}
+    if row["codes_naf"]:
+        api_params["activite_principale"] = ",".join(sorted(row["codes_naf"]))
+    else:
+        api_params["section_activite_principale"] = ",".join(sections)
+    step_start = time.perf_counter()
+    if search_mode == "rayon":
+        entreprises = api_client.rechercher_entreprises_autour_du_point(
+            coordonnees[0], coordonnees[1], row["rayon_km"], api_params, force_full_fetch=True, on_event=on_event
+        )
+    else:
+        entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(
+            postal_codes, api_params, force_full_fetch=True, code_type="postal", on_event=on_event
+        )
+    report["recherche_s"] = round(time.perf_counter() - step_start, 2)
+    if not isinstance(entreprises, list):
+        return finish("erreur", report["message"] or "Échec de la recherche.")
+    report["entreprises"] = len(entreprises)
+
+    step_start = time.perf_counter()
+    df_resultats = data_utils.traitement_reponse_api(entreprises, row["effectifs"])
+    df_resultats = data_utils.filtrer_par_rayon(df_resultats, coordonnees[0], coordonnees[1], row["rayon_km"])
+    if row["codes_naf"] and not df_resultats.empty and "code_naf_etablissement" in df_resultats.columns:
+        df_resultats = df_resultats[df_resultats["code_naf_etablissement"].isin(row["codes_naf"])]
+    report["etablissements"] = len(df_resultats)
+    output_path = _output_path(output_dir, row["id"], output_format)
+    if output_format == "parquet":
+        df_resultats.reset_index(drop=True).to_parquet(output_path, index=False)
+    else:
+        df_resultats.to_csv(output_path, index=False, encoding="utf-8-sig")
+    report["traitement_s"] = round(time.perf_counter() - step_start, 2)
+    report["fichier"] = output_path
+    return finish("ok" if len(df_resultats) else "vide")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Fichier .csv ou .jsonl des recherches")
+    parser.add_argument("--output-dir", default="resultats_recherches")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--workers", type=int, default=4, help="Nombre de recherches exécutées en parallèle")
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument("--record", metavar="CASSETTE", help="Enregistre le trafic API dans ce fichier (.jsonl.gz)")
+    cassette_group.add_argument("--replay", metavar="CASSETTE", help="Rejoue le trafic API enregistré dans ce fichier")
+    parser.add_argument("--replay-timing", choices=["original", "fast"], default="original", help="Latences enregistrées ou réponses immédiates")
+    args = parser.parse_args(argv)
+
+    if args.format == "parquet" and not (importlib.util.find_spec("pyarrow") or importlib.util.find_spec("fastparquet")):
+        parser.error("Le format parquet nécessite pyarrow (pip install pyarrow).")
+    rows = read_search_rows(args.input)
+    os.makedirs(args.output_dir, exist_ok=True)
+    data_utils.get_naf_lookup()
+
+    if args.record:
+        traffic = api_client.cassette(args.record, "record")
+    elif args.replay:
+        traffic = api_client.cassette(args.replay, "replay", timing=args.replay_timing)
+    else:
+        traffic = contextlib.nullcontext()
+
+    start = time.perf_counter()
+    reports = []
+    with traffic, concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        future_to_row = {executor.submit(run_search_row, row, args.output_dir, args.format): row for row in rows}
+        for future in concurrent.futures.as_completed(future_to_row):
+            row = future_to_row[future]
+            try:
+                report = future.result()
+            except Exception as exc:
+                report = dict.fromkeys(REPORT_COLUMNS, "")
+                report.update(id=row["id"], statut="erreur", message=f"Exception : {exc}")
+            reports.append(report)
+            print(f"[{len(reports)}/{len(rows)}] {report['id']} : {report['statut']}, {report['etablissements'] or 0} établissements, {report['total_s'] or 0} s {report['message']}")
+
+    if not args.replay: # A replayed run says nothing about the live API's rate
+        api_client.rate_controller.save()
+    report_path = os.path.join(args.output_dir, "rapport_durees.csv")
+    pd.DataFrame(reports, columns=REPORT_COLUMNS).sort_values("id").to_csv(report_path, index=False, encoding="utf-8-sig")
+    stats = api_client.request_stats()
+    print(f"{len(rows)} recherches en {time.perf_counter() - start:.1f} s ({stats['upstream_calls']} appels API). Rapport : {report_path}")
+    return 0 if all(report["statut"] != "erreur" for report in reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
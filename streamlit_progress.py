@@ -0,0 +1,105 @@
+import time
+
+import streamlit as st
+
+import api_client
+
+
+class StreamlitSearchProgress:
+    """
+    Adaptateur Streamlit des événements de recherche de api_client (rappel on_event, voir api_client._emit) :
+    barre de progression et texte d'état globaux, état du disjoncteur, erreurs et avertissements.
+    Une instance par recherche, créée dans le script Streamlit : les éléments sont ajoutés à l'endroit
+    de la page où la recherche est lancée.
+    Streamlit n'affiche que depuis le thread du script : les événements émis par les threads du pool
+    ("throttled") sont seulement comptés, et repris dans le texte de progression suivant.
+    """
+
+    MIN_REFRESH_INTERVAL = 0.1 # Seconds between two progress renders, the engine may report every page
+
+    def __init__(self):
+        self.progress_bar = None
+        self.status_text = None
+        self.circuit_text = None
+        self.throttled_responses = 0
+        self._search_desc = ""
+        self._last_refresh = 0.0
+
+    def __call__(self, event):
+        handler = getattr(self, f"_on_{event['type']}", None)
+        if handler is not None:
+            handler(event)
+
+    def _show_status(self, text):
+        if self.progress_bar is None:
+            self.progress_bar = st.progress(0)
+            self.status_text = st.empty()
+        self.status_text.text(text)
+
+    def _on_search_planning(self, event):
+        self._search_desc = f"{event['codes_count']} codes {event['code_type']}"
+        self._show_status(f"Planification des lots pour {self._search_desc}...")
+
+    def _on_search_started(self, event):
+        if event["code_type"] == "point":
+            self._search_desc = "le rayon autour du point (recherche géographique de l'API)"
+        else:
+            self._search_desc = f"{event['codes_count']} codes {event['code_type']}"
+        if event["resumed_pages"] is not None:
+            self._show_status(f"Reprise de la recherche sur {self._search_desc} ({event['total_batches']} lots, {event['resumed_pages']} pages déjà récupérées)...")
+        else:
+            self._show_status(f"Initialisation de la recherche sur {self._search_desc} ({event['total_batches']} lots{api_client.format_search_estimate(event['estimate'])})...")
+
+    def _on_completion_started(self, event):
+        self._show_status(f"Complétion de {event['entreprises']} grande(s) entreprise(s) dont les établissements dépassent la limite par réponse de l'API...")
+
+    def _on_throttled(self, event):
+        self.throttled_responses += 1
+
+    def _on_progress(self, event):
+        now = time.monotonic()
+        finished = event["completed_pages"] >= event["total_pages"]
+        if not finished and now - self._last_refresh < self.MIN_REFRESH_INTERVAL:
+            return
+        self._last_refresh = now
+        text = f"{event['completed_queries']}/{event['total_queries']} requêtes terminées, {event['completed_pages']}/{event['total_pages']} pages récupérées ({event['raw_results']} résultats bruts)"
+        if self.throttled_responses:
+            text += f", {self.throttled_responses} réponses 429"
+        self._show_status(text + "...")
+        self.progress_bar.progress(min(event["completed_pages"] / event["total_pages"], 1.0))
+
+    def _on_circuit(self, event):
+        if self.circuit_text is None:
+            self.circuit_text = st.empty()
+        if event["state"] == "open":
+            self.circuit_text.warning(f"L'API Recherche d'entreprises ne répond plus : requêtes suspendues, nouvel essai dans {event['retry_in']:.0f} s (pages en cache servies).")
+        elif event["state"] == "half_open":
+            self.circuit_text.info("Test de disponibilité de l'API Recherche d'entreprises...")
+        else:
+            self.circuit_text.empty()
+
+    def _on_error(self, event):
+        if event["level"] == "warning":
+            st.warning(event["message"])
+        else:
+            st.error(event["message"])
+
+    def _on_search_finished(self, event):
+        if self.progress_bar is None:
+            return
+        self.progress_bar.empty()
+        if event["outcome"] in ("completed", "incomplete"):
+            text = f"Recherche terminée sur {self._search_desc}"
+            latency = event.get("latency")
+            if latency and latency["pages"]:
+                text += f" (durée des pages : p95 {latency['p95']:.1f} s, max {latency['max']:.1f} s"
+                if latency["hedged_requests"]:
+                    text += f", {latency['hedged_requests']} requêtes lentes doublées"
+                text += ")"
+            self.status_text.text(f"{text}. Traitement des {event['raw_results']} résultats bruts...")
+        else:
+            self.status_text.empty()
+
+    def _on_results_merged(self, event):
+        if self.status_text is not None:
+            self.status_text.text(f"Traitement final de {event['unique_entreprises']} entreprises uniques (par SIREN).")
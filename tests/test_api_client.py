@@ -1,28 +1,81 @@
+import asyncio
 import collections
+import json
 import os
+import shutil
+import subprocess
 
 # Ensure the path is set up correctly
 import sys
+import tempfile
+import threading
 import time
 import unittest
 from unittest.mock import MagicMock, call, patch
 import concurrent.futures # Import for as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 import api_client  # Module to test
+import api_models
 import config  # For constants
+import fake_api_server
+import streamlit_progress
+
+
+def _json_response(data, status_code=200):
+    """Réponse HTTP simulée dont le corps est data encodé en JSON."""
+    response = MagicMock(spec=requests.Response)
+    response.status_code = status_code
+    response.content = json.dumps(data).encode("utf-8")
+    response.json.return_value = data
+    return response
 
 
 class TestApiClient(unittest.TestCase):
     def setUp(self):
-        # Reset global rate limiting structures for each test
-        api_client.request_timestamps.clear()
-        # If rate_limit_lock needs specific handling, do it here,
-        # but usually, it's fine as long as tests don't run in parallel threads
-        # within the same test method without re-acquiring/releasing.
+        # Use a non-limiting token bucket: these tests exercise retries and scheduling,
+        # not the rate limit itself (covered by the RateLimiter tests).
+        self.original_rate_limiter = api_client.rate_limiter
+        api_client.rate_limiter = api_client.RateLimiter(rate=1000, burst=1000)
+        # Adaptive control stays within the test budget and never persists its rate
+        self.original_rate_controller = api_client.rate_controller
+        api_client.rate_controller = api_client.AdaptiveRateController(
+            api_client.rate_limiter, min_rate=1, max_rate=1000, state_file=None
+        )
+
+        # Every test sees the network mocks, never pages cached on disk
+        self.original_page_cache = api_client.page_cache
+        api_client.page_cache = None
+        self.original_single_flight = api_client.single_flight
+        # Batches follow MAX_CODES_PER_API_CALL: no stored counts, no count probes
+        self.original_result_count_store = api_client.result_count_store
+        api_client.result_count_store = None
+        # Searches are not checkpointed unless a test installs its own job store
+        self.original_search_job_store = api_client.search_job_store
+        api_client.search_job_store = None
+        probe_patcher = patch.object(config, "BATCH_PLANNER_PROBE_UNKNOWN", False)
+        probe_patcher.start()
+        self.addCleanup(probe_patcher.stop)
+        # Oversized searches ask the user unless a test enables automatic splitting
+        split_patcher = patch.object(config, "AUTO_SPLIT_ENABLED", False)
+        split_patcher.start()
+        self.addCleanup(split_patcher.stop)
+        # Slow requests are not duplicated unless a test enables hedging; latencies start from scratch
+        hedge_patcher = patch.object(config, "HEDGED_REQUESTS_ENABLED", False)
+        hedge_patcher.start()
+        self.addCleanup(hedge_patcher.stop)
+        latencies_patcher = patch.object(api_client, "response_latencies", api_client.LatencyWindow(config.HEDGE_LATENCY_WINDOW))
+        latencies_patcher.start()
+        self.addCleanup(latencies_patcher.stop)
+        # Failures provoked by one test must not open a breaker shared with the next ones
+        breaker_patcher = patch.object(api_client, "circuit_breaker", None)
+        breaker_patcher.start()
+        self.addCleanup(breaker_patcher.stop)
+        api_client.single_flight = api_client.SingleFlight()
 
         # It's good practice to patch constants if they might affect test behavior
         # and you want to control them, e.g., MAX_CODES_PER_API_CALL
@@ -30,19 +83,21 @@ class TestApiClient(unittest.TestCase):
         api_client.MAX_CODES_PER_API_CALL = 2  # Smaller for easier batch testing
 
     def tearDown(self):
-        api_client.request_timestamps.clear()
+        api_client.rate_limiter = self.original_rate_limiter
+        api_client.rate_controller = self.original_rate_controller
+        api_client.page_cache = self.original_page_cache
+        api_client.single_flight = self.original_single_flight
+        api_client.result_count_store = self.original_result_count_store
+        api_client.search_job_store = self.original_search_job_store
         api_client.MAX_CODES_PER_API_CALL = self.original_max_codes
 
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_first_page_success(self, mock_get):
-        mock_response = MagicMock()
-        mock_response.json.return_value = {
+        mock_get.return_value = _json_response({
             "results": [{"siren": "123"}],
             "total_pages": 2,
             "total_results": 50,
-        }
-        mock_response.raise_for_status = MagicMock()
-        mock_get.return_value = mock_response
+        })
 
         result = api_client.fetch_first_page(
             "http://fakeapi.com/search", {"param": "value"}, {}
@@ -58,7 +113,7 @@ class TestApiClient(unittest.TestCase):
         self.assertEqual(result["total_results"], 50)
         self.assertIsNone(result["error_message"])
 
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_first_page_timeout(self, mock_get):
         mock_get.side_effect = requests.exceptions.Timeout("Timeout error")
         result = api_client.fetch_first_page("http://fakeapi.com/search", {}, {})
@@ -68,7 +123,7 @@ class TestApiClient(unittest.TestCase):
             "Délai d'attente dépassé lors de la connexion à l'API (page 1).",
         )
 
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_first_page_http_error_with_json_message(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 400
@@ -86,7 +141,7 @@ class TestApiClient(unittest.TestCase):
             "Erreur API (page 1): 400 Bad Request - Invalid parameter",
         )
 
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_first_page_http_error_no_json_message(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 500
@@ -108,7 +163,7 @@ class TestApiClient(unittest.TestCase):
         self.assertTrue(result["error_message"].startswith(expected_error_prefix))
         self.assertTrue(result["error_message"].endswith(expected_error_suffix))
 
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_first_page_request_exception(self, mock_get):
         mock_get.side_effect = requests.exceptions.ConnectionError("Connection failed")
         result = api_client.fetch_first_page("http://fakeapi.com/search", {}, {})
@@ -117,21 +172,48 @@ class TestApiClient(unittest.TestCase):
             result["error_message"], "Erreur réseau (page 1): Connection failed"
         )
 
+    @patch("api_client.time.sleep")
+    @patch("api_client.http_client.get")
+    def test_fetch_first_page_retries_429_when_requested(self, mock_get, mock_sleep):
+        mock_response_429 = MagicMock(spec=requests.Response)
+        mock_response_429.status_code = 429
+        mock_response_429.reason = "Too Many Requests"
+        mock_response_429.headers = {"Retry-After": "2"}
+        mock_response_429.json.return_value = {}
+        mock_response_429.raise_for_status.side_effect = requests.exceptions.HTTPError(
+            response=mock_response_429
+        )
+        mock_response_success = _json_response({"results": [], "total_pages": 1, "total_results": 0})
+        mock_get.side_effect = [mock_response_429, mock_response_success]
+
+        result = api_client.fetch_first_page("url", {}, {}, max_retries=1)
+
+        self.assertTrue(result["success"])
+        self.assertEqual(mock_get.call_count, 2)
+        mock_sleep.assert_called_once()
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 2.1, delta=0.05)  # Retry-After honoured by the pool pause
+
+    @patch("api_client.http_client.get")
+    def test_fetch_first_page_cancelled_sends_nothing(self, mock_get):
+        cancel_event = threading.Event()
+        cancel_event.set()
+        result = api_client.fetch_first_page("url", {}, {}, max_retries=3, cancel_event=cancel_event)
+        self.assertFalse(result["success"])
+        self.assertTrue(result["cancelled"])
+        mock_get.assert_not_called()
+
     @patch("api_client.time.sleep")  # Mock sleep to speed up tests
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_page_with_retry_success_first_try(self, mock_get, mock_sleep):
-        mock_response = MagicMock()
-        mock_response.json.return_value = {"results": [{"id": 1}]}
-        mock_response.raise_for_status = MagicMock()
-        mock_get.return_value = mock_response
+        mock_get.return_value = _json_response({"results": [{"siren": "123"}]})
 
         result = api_client.fetch_page_with_retry(1, {}, "url", {})
         self.assertEqual(result["status"], "success")
-        self.assertEqual(result["results"], [{"id": 1}])
+        self.assertEqual(result["results"], [api_models.Entreprise(siren="123")])
         mock_sleep.assert_not_called()
 
     @patch("api_client.time.sleep")
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_page_with_retry_handles_429(self, mock_get, mock_sleep):
         # Simulate 429 then success
         mock_response_429 = MagicMock(spec=requests.Response)
@@ -141,19 +223,39 @@ class TestApiClient(unittest.TestCase):
             response=mock_response_429
         )
 
-        mock_response_success = MagicMock(spec=requests.Response)
-        mock_response_success.json.return_value = {"results": [{"id": 1}]}
-        mock_response_success.raise_for_status = MagicMock()
+        mock_response_success = _json_response({"results": [{"siren": "123"}]})
 
         mock_get.side_effect = [mock_response_429, mock_response_success]
 
-        result = api_client.fetch_page_with_retry(1, {}, "url", {})
+        events = []
+        result = api_client.fetch_page_with_retry(1, {}, "url", {}, on_event=events.append)
         self.assertEqual(result["status"], "success")
-        self.assertEqual(result["results"], [{"id": 1}])
+        self.assertEqual(result["results"], [api_models.Entreprise(siren="123")])
         mock_sleep.assert_called_once()  # Should have slept after 429
+        self.assertEqual([e["type"] for e in events], ["throttled"])
+        self.assertEqual(api_client.rate_controller.throttled_responses, 1)
+        self.assertLess(api_client.rate_limiter.rate, 1000)  # Multiplicative decrease
+
+    @patch("api_client.http_client.get")
+    def test_fetch_page_429_retry_after_pauses_whole_pool(self, mock_get):
+        mock_response_429 = MagicMock(spec=requests.Response)
+        mock_response_429.status_code = 429
+        mock_response_429.headers = {"Retry-After": "3"}
+        mock_response_429.raise_for_status.side_effect = requests.exceptions.HTTPError(
+            response=mock_response_429
+        )
+        mock_get.return_value = mock_response_429
+        cancel_event = threading.Event()
+        # The retry waits on the cancel event; stop the page once its first attempt got the 429
+        with patch.object(cancel_event, "wait", side_effect=lambda timeout: cancel_event.set()):
+            result = api_client.fetch_page_with_retry(1, {}, "url", {}, cancel_event=cancel_event)
+        self.assertEqual(result["status"], "cancelled")
+        self.assertEqual(mock_get.call_count, 1)
+        # Any other request of the pool now waits for the Retry-After delay too
+        self.assertGreater(api_client.rate_limiter.reserve(), 2.5)
 
     @patch("api_client.time.sleep")
-    @patch("api_client.requests.get")
+    @patch("api_client.http_client.get")
     def test_fetch_page_with_retry_max_retries_429(self, mock_get, mock_sleep):
         mock_response_429 = MagicMock(spec=requests.Response)
         mock_response_429.status_code = 429
@@ -170,29 +272,1034 @@ class TestApiClient(unittest.TestCase):
         self.assertTrue("Échec final après" in result["message"])
         self.assertEqual(mock_sleep.call_count, config.MAX_RETRIES_ON_429)
 
+    # --- Tests for PageCache (SQLite) ---
+
+    def _page_cache(self, **kwargs):
+        options = dict(ttl_seconds=3600, max_bytes=10 * 1024 * 1024)
+        options.update(kwargs)
+        cache = api_client.PageCache(os.path.join(tempfile.mkdtemp(), "pages.sqlite3"), **options)
+        self.addCleanup(shutil.rmtree, os.path.dirname(cache.path), True)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_page_cache_key_ignores_param_and_value_order(self):
+        key = api_client.canonical_request_key
+        self.assertEqual(
+            key("url", {"code_postal": "75002,75001", "section_activite_principale": "J,G", "page": 2}),
+            key("url", {"section_activite_principale": "G,J", "page": 2, "code_postal": "75001,75002"}),
+        )
+        self.assertNotEqual(
+            key("url", {"code_postal": "75001", "page": 1}), key("url", {"code_postal": "75001", "page": 2})
+        )
+        self.assertNotEqual(key("url", {"q": "a,b"}), key("url", {"q": "b,a"}))  # Free text keeps its order
+
+    def test_page_cache_round_trip_and_ttl(self):
+        fake_now = [1000.0]
+        cache = self._page_cache(ttl_seconds=60, clock=lambda: fake_now[0])
+        page = {"results": [{"siren": "123", "nom_complet": "Société Générale é"}], "total_pages": 1}
+        self.assertIsNone(cache.get("url", {"page": 1}))
+        cache.put("url", {"page": 1}, page)
+        self.assertEqual(cache.get("url", {"page": 1}), api_models.page_from_json(page))
+        fake_now[0] += 61
+        self.assertIsNone(cache.get("url", {"page": 1}))  # Expired
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_page_cache_evicts_least_recently_used(self):
+        fake_now = [0.0]
+        page = {"results": [{"siren": f"{i:09d}", "data": os.urandom(16).hex()} for i in range(20)]}
+        cache = self._page_cache(clock=lambda: fake_now[0])
+        cache.put("url", {"page": 0}, page)
+        page_size = cache._connect().execute("SELECT size FROM pages").fetchone()[0]
+        cache.clear()
+        cache.max_bytes = int(page_size * 3.5)  # Room for three pages
+
+        for page_num in range(1, 4):
+            fake_now[0] += 1
+            cache.put("url", {"page": page_num}, page)
+        fake_now[0] += 1
+        cache.get("url", {"page": 1})  # Page 1 becomes the most recently used
+        fake_now[0] += 1
+        cache.put("url", {"page": 4}, page)  # Over the cap: page 2 is the least recently used
+        self.assertIsNotNone(cache.get("url", {"page": 1}))
+        self.assertIsNone(cache.get("url", {"page": 2}))
+        self.assertIsNotNone(cache.get("url", {"page": 4}))
+
+    @patch("api_client.http_client.get")
+    def test_cached_pages_skip_the_network(self, mock_get):
+        api_client.page_cache = self._page_cache()
+        mock_get.return_value = _json_response({"results": [{"siren": "123"}], "total_pages": 2, "total_results": 30})
+
+        first = api_client.fetch_first_page("url", {"code_postal": "75001,75002"}, {})
+        again = api_client.fetch_first_page("url", {"code_postal": "75002,75001"}, {})
+        page2 = api_client.fetch_page_with_retry(2, {"code_postal": "75001,75002"}, "url", {})
+        page2_again = api_client.fetch_page_with_retry(2, {"code_postal": "75001,75002"}, "url", {})
+
+        self.assertEqual(first, again)
+        self.assertEqual(page2, page2_again)
+        self.assertEqual(mock_get.call_count, 2)  # One call per distinct page
+
+    @patch("api_client.http_client.get")
+    def test_failed_pages_are_not_cached(self, mock_get):
+        api_client.page_cache = self._page_cache()
+        mock_get.side_effect = requests.exceptions.RequestException("Connection failed")
+        api_client.fetch_first_page("url", {}, {})
+        mock_get.side_effect = None
+        mock_get.return_value = _json_response({"results": [], "total_pages": 1, "total_results": 0})
+        self.assertTrue(api_client.fetch_first_page("url", {}, {})["success"])
+        self.assertEqual(mock_get.call_count, 2)
+
+    # --- Tests for resumable search jobs ---
+
+    def _search_job_store(self):
+        store = api_client.SearchJobStore(os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"), max_age_seconds=3600)
+        self.addCleanup(shutil.rmtree, os.path.dirname(store.path), True)
+        self.addCleanup(store.close)
+        return store
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_interrupted_search_job_resumes_missing_pages_only(self, mock_fetch_first, mock_fetch_page):
+        api_client.search_job_store = self._search_job_store()
+        mock_fetch_first.return_value = {
+            "success": True, "results": [{"siren": "111", "matching_etablissements": [{"siret": "1110001"}]}],
+            "total_pages": 3, "total_results": 60,
+        }
+        page_3_available = False
+
+        def fake_fetch_page(page_num, params, url, headers, cancel_event=None, on_event=None):
+            if page_num == 3 and not page_3_available:
+                return {"status": "error", "message": "Échec page 3", "results": []}
+            return {"status": "success", "message": "", "results": [{"siren": f"{page_num}00", "matching_etablissements": []}]}
+
+        mock_fetch_page.side_effect = fake_fetch_page
+        first_run = api_client.rechercher_entreprises_par_localisation_et_criteres(["75001"], {"activite_principale": "XYZ"})
+        self.assertEqual(sorted(r["siren"] for r in first_run), ["111", "200"])
+
+        page_3_available = True
+        mock_fetch_first.reset_mock()
+        mock_fetch_page.reset_mock()
+        resumed_run = api_client.rechercher_entreprises_par_localisation_et_criteres(["75001"], {"activite_principale": "XYZ"})
+
+        mock_fetch_first.assert_not_called()
+        self.assertEqual([c.args[0] for c in mock_fetch_page.call_args_list], [3])  # Only the missing page
+        self.assertEqual(sorted(r["siren"] for r in resumed_run), ["111", "200", "300"])
+
+        job = api_client.open_search_job(
+            f"{config.API_BASE_URL}/search", api_client._build_search_params({"activite_principale": "XYZ"}), ["75001"], False, "commune"
+        )
+        self.assertFalse(job.resumed)  # The completed job is not reopened: a new search starts afresh
+
+    def test_search_job_rebuilds_results_from_stored_pages(self):
+        store = self._search_job_store()
+        plan = {"url": "u", "api_params": {}, "localisation_codes": ["75001"], "code_type": "postal", "force_full_fetch": True}
+        job = store.open(plan)
+        job.set_batches([["75001"]])
+        job.record_page({"code_postal": "75001"}, 1, {"success": True, "results": [{"siren": "111", "matching_etablissements": [{"siret": "1"}]}]})
+        job.record_page({"code_postal": "75001"}, 2, {"status": "success", "results": [{"siren": "111", "matching_etablissements": [{"siret": "2"}]}]})
+        job.finish("interrupted")
+
+        reopened = store.open(plan)
+        self.assertTrue(reopened.resumed)
+        self.assertEqual(reopened.job_id, job.job_id)
+        self.assertEqual(reopened.plan["batches"], [["75001"]])
+        self.assertEqual(len(reopened.completed_pages()), 2)
+        self.assertEqual([etab["siret"] for etab in reopened.results()[0]["matching_etablissements"]], ["1", "2"])
+
+    def test_running_search_job_is_not_shared_and_corrupt_pages_are_skipped(self):
+        store = self._search_job_store()
+        plan = {"url": "u", "api_params": {}, "localisation_codes": ["75001"], "code_type": "postal", "force_full_fetch": True}
+        running = store.open(plan)
+        concurrent_search = store.open(plan)
+        self.assertFalse(concurrent_search.resumed)  # The running job belongs to the other search
+        self.assertNotEqual(concurrent_search.job_id, running.job_id)
+
+        running.record_page({"code_postal": "75001"}, 1, {"success": True, "results": [{"siren": "111", "matching_etablissements": [{"siret": "1"}]}]})
+        running.record_page({"code_postal": "75001"}, 2, {"status": "success", "results": [{"siren": "222", "matching_etablissements": []}]})
+        store._connect().execute("UPDATE search_job_pages SET body = ? WHERE page = 2", (b"not zlib",))
+        running.finish("interrupted")
+
+        resumed = store.open(plan)
+        self.assertEqual(resumed.job_id, running.job_id)
+        self.assertEqual(len(resumed.completed_pages()), 2)
+        self.assertEqual([entreprise["siren"] for entreprise in resumed.results()], ["111"])  # The corrupt page is skipped
+        self.assertNotEqual(store.open(plan).job_id, running.job_id)  # Claimed by the resumed search
+
+    # --- Tests for the density-aware batch planner ---
+
+    def _result_count_store(self):
+        store = api_client.ResultCountStore(os.path.join(tempfile.mkdtemp(), "counts.sqlite3"), ttl_seconds=3600)
+        self.addCleanup(shutil.rmtree, os.path.dirname(store.path), True)
+        self.addCleanup(store.close)
+        return store
+
+    def test_planner_without_counts_keeps_fixed_batches(self):
+        codes = ["75001", "75002", "75003", "75004", "75005"]
+        self.assertEqual(
+            api_client.plan_localisation_batches(codes, {}, code_type="postal"),
+            [["75001", "75002"], ["75003", "75004"], ["75005"]],
+        )
+
+    def test_planner_packs_codes_by_known_density(self):
+        api_client.result_count_store = self._result_count_store()
+        base_params = api_client._build_search_params({"section_activite_principale": "J"})
+        counts = {"75008": 8000, "75015": 5000, "23001": 40, "23002": 10, "23003": 0, "75016": 3900}
+        api_client.result_count_store.put_many(
+            f"{config.API_BASE_URL}/search",
+            [(dict(base_params, code_postal=code), count) for code, count in counts.items()],
+        )
+        batches = api_client.plan_localisation_batches(list(counts), base_params, code_type="postal")
+        self.assertEqual(sorted(code for batch in batches for code in batch), sorted(counts))
+        capacity = config.API_MAX_TOTAL_RESULTS * config.BATCH_PLANNER_FILL_RATIO
+        self.assertTrue(all(sum(counts[code] for code in batch) <= capacity for batch in batches))
+        self.assertEqual(len(batches), 2)  # 75015 + 75016 together, rural codes next to 75008
+        self.assertIn(["75015", "75016"], batches)
+
+    @patch("api_client.fetch_first_page")
+    def test_probe_result_counts_uses_smallest_page_and_stores_counts(self, mock_fetch_first):
+        api_client.result_count_store = self._result_count_store()
+        probe_counts = {"75001": 251, "75002": 0}
+        mock_fetch_first.side_effect = lambda url, params, headers, **kwargs: (
+            {"success": True, "results": [{}], "total_pages": probe_counts[params["code_postal"]], "total_results": probe_counts[params["code_postal"]]}
+            if params["code_postal"] in probe_counts else {"success": False, "error_message": "Erreur"}
+        )
+        queries = [
+            api_client._build_search_params({"code_postal": code}) for code in ("75001", "75002", "99999")
+        ]
+        probes = api_client.probe_result_counts(queries)
+        self.assertEqual(probes, [{"total_results": 251, "total_pages": 11}, {"total_results": 0, "total_pages": 1}, None])
+        probe_params = mock_fetch_first.call_args[0][1]
+        self.assertEqual((probe_params["per_page"], probe_params["minimal"]), (1, "true"))
+        self.assertNotIn("include", probe_params)
+
+        mock_fetch_first.reset_mock()
+        self.assertEqual(api_client.probe_result_counts(queries)[:2], probes[:2])
+        self.assertEqual(mock_fetch_first.call_count, 1)  # Only the failed probe is sent again
+
+    def test_estimate_search_cost_from_stored_counts(self):
+        api_client.result_count_store = self._result_count_store()
+        api_params = {"section_activite_principale": "J"}
+        base_params = api_client._build_search_params(api_params)
+        api_client.result_count_store.put_many(
+            f"{config.API_BASE_URL}/search",
+            [(dict(base_params, code_postal="75001"), 100), (dict(base_params, code_postal="75002"), 60)],
+        )
+        api_client.rate_limiter.set_rate(4)
+        estimate = api_client.estimate_search_cost(["75001", "75002", "23000"], api_params, code_type="postal")
+        self.assertEqual(estimate["total_results_estimated"], 160)
+        self.assertEqual(estimate["unknown_codes"], 1)
+        self.assertEqual(estimate["batches"], [["75001", "75002", "23000"]])
+        self.assertEqual(estimate["requests_estimated"], 7)  # 160 results in pages of 25
+        self.assertAlmostEqual(estimate["seconds_estimated"], 7 / 4)
+
+    def test_long_naf_code_lists_are_split_into_groups(self):
+        naf_codes = ["62.02A", "62.01Z", "70.22Z", "71.12B", "62.03Z"]
+        base_params = api_client._build_search_params({"activite_principale": ",".join(naf_codes)})
+        self.assertEqual(api_client._naf_code_groups(base_params), [base_params])  # Short list: a single call
+        with patch.object(config, "MAX_NAF_CODES_PER_API_CALL", 2):
+            groups = api_client._naf_code_groups(base_params)
+            self.assertEqual([group["activite_principale"] for group in groups], ["62.01Z,62.02A", "62.03Z,70.22Z", "71.12B"])
+            batch_params = api_client._batch_query_params(base_params, [["75001", "75002"], ["69001"]], "postal")
+        self.assertEqual(len(batch_params), 6)  # One call per code batch and NAF group
+        self.assertEqual(batch_params[3], dict(groups[0], code_postal="69001"))
+
+    def test_estimate_search_cost_sums_naf_group_counts(self):
+        api_client.result_count_store = self._result_count_store()
+        base_params = api_client._build_search_params({"activite_principale": "62.01Z,62.02A,70.22Z"})
+        with patch.object(config, "MAX_NAF_CODES_PER_API_CALL", 2):
+            group1, group2 = api_client._naf_code_groups(base_params)
+            api_client.result_count_store.put_many(
+                f"{config.API_BASE_URL}/search",
+                [(dict(group1, code_postal="75001"), 30), (dict(group2, code_postal="75001"), 20), (dict(group1, code_postal="75002"), 5)],
+            )
+            estimate = api_client.estimate_search_cost(["75001", "75002"], {"activite_principale": "62.01Z,62.02A,70.22Z"}, code_type="postal")
+        self.assertEqual(estimate["total_results_estimated"], 50)
+        self.assertEqual(estimate["unknown_codes"], 1)  # 75002 has no count for its second group
+
+    def test_planner_keeps_oversized_code_alone(self):
+        batches = api_client._pack_codes(["a", "b", "c"], [20000, 100, 100], capacity=9000, max_codes_per_call=50)
+        self.assertEqual(batches, [["a"], ["b", "c"]])
+
+    @patch("api_client.fetch_first_page")
+    def test_planner_probes_unknown_codes_once(self, mock_fetch_first):
+        api_client.result_count_store = self._result_count_store()
+        probe_counts = {"75001": 9000, "75002": 300, "75003": 200}
+        mock_fetch_first.side_effect = lambda url, params, headers, **kwargs: {
+            "success": True, "results": [], "total_pages": 1, "total_results": probe_counts[params["code_postal"]]
+        }
+        base_params = api_client._build_search_params({"section_activite_principale": "J"})
+        with patch.object(config, "BATCH_PLANNER_PROBE_UNKNOWN", True):
+            batches = api_client.plan_localisation_batches(list(probe_counts), base_params, code_type="postal")
+            self.assertEqual(batches, [["75001"], ["75002", "75003"]])
+            probe_params = mock_fetch_first.call_args[0][1]
+            self.assertEqual(probe_params["per_page"], 1)  # Smallest page, no establishments
+            self.assertNotIn("include", probe_params)
+            # Counts are stored: a later search plans without probing again
+            api_client.plan_localisation_batches(list(probe_counts), base_params, code_type="postal")
+        self.assertEqual(mock_fetch_first.call_count, 3)
+
+    @patch("api_client.fetch_first_page")
+    def test_planner_probes_only_when_counts_are_partially_known(self, mock_fetch_first):
+        api_client.result_count_store = self._result_count_store()
+        mock_fetch_first.side_effect = lambda url, params, headers, **kwargs: {
+            "success": True, "results": [], "total_pages": 1, "total_results": 100
+        }
+        base_params = api_client._build_search_params({"section_activite_principale": "J"})
+        codes = ["75001", "75002", "75003"]
+
+        api_client.plan_localisation_batches(codes, base_params, code_type="postal")
+        mock_fetch_first.assert_not_called()  # Cold store: page 1 of the coarse batches gives the counts
+
+        api_client.result_count_store.put_many(
+            f"{config.API_BASE_URL}/search", [(api_client._single_code_params(base_params, "postal", "75001"), 8950)]
+        )
+        batches = api_client.plan_localisation_batches(codes, base_params, code_type="postal")
+        self.assertEqual(sorted(recorded[0][1]["code_postal"] for recorded in mock_fetch_first.call_args_list), ["75002", "75003"])
+        self.assertEqual(batches, [["75001"], ["75002", "75003"]])
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_rechercher_records_per_code_counts_of_complete_batches(self, mock_fetch_first, mock_fetch_page):
+        api_client.result_count_store = self._result_count_store()
+
+        def entreprise(siren, *codes):
+            return {"siren": siren, "matching_etablissements": [{"siret": f"{siren}{code}", "code_postal": code} for code in codes]}
+
+        mock_fetch_first.return_value = {
+            "success": True, "results": [entreprise("1", "75001"), entreprise("2", "75001", "75002")],
+            "total_pages": 2, "total_results": 3,
+        }
+        mock_fetch_page.return_value = {"status": "success", "message": "", "results": [entreprise("3", "75002")]}
+
+        api_client.rechercher_entreprises_par_localisation_et_criteres(["75001", "75002"], {}, code_type="postal")
+
+        base_params = api_client._build_search_params({})
+        stored = api_client.result_count_store.get_many(
+            f"{config.API_BASE_URL}/search",
+            [dict(base_params, code_postal="75001"), dict(base_params, code_postal="75002")],
+        )
+        self.assertEqual(stored, [2, 2])
+
+    @patch("api_client.http_client.get")
+    def test_identical_search_is_served_from_the_page_cache(self, mock_get):
+        api_client.page_cache = self._page_cache()
+        api_client.result_count_store = self._result_count_store()
+        api_client.search_job_store = self._search_job_store()
+
+        def fake_get(url, params=None, headers=None, timeout=None):
+            codes = params["code_postal"].split(",")
+            results = [{"siren": code, "matching_etablissements": [{"siret": f"{code}1", "code_postal": code}]} for code in codes]
+            return _json_response({"results": results, "total_pages": 1, "total_results": len(results)})
+
+        mock_get.side_effect = fake_get
+        codes = [f"750{idx:02d}" for idx in range(1, 7)]
+        cold = api_client.rechercher_entreprises_par_localisation_et_criteres(codes, {}, code_type="postal")
+        cold_calls = mock_get.call_count
+        self.assertGreater(cold_calls, 1)  # Cold count store: fixed batches
+
+        warm = api_client.rechercher_entreprises_par_localisation_et_criteres(codes, {}, code_type="postal")
+        self.assertEqual(mock_get.call_count, cold_calls)  # Same batches as the first run: every page is cached
+        self.assertEqual(sorted(entreprise["siren"] for entreprise in warm), sorted(entreprise["siren"] for entreprise in cold))
+
+    # --- Tests for automatic query splitting ---
+
+    def test_split_oversized_query_order(self):
+        split = api_client.split_oversized_query
+        self.assertEqual(
+            [q["code_postal"] for q in split({"code_postal": "75001,75002,75003"}, "postal")],
+            ["75001", "75002,75003"],
+        )
+        by_section = split({"code_postal": "75001", "section_activite_principale": "G,J,M"}, "postal")
+        self.assertEqual([q["section_activite_principale"] for q in by_section], ["G", "J,M"])
+
+        # A single section becomes its NAF codes, split by division (58-63 for section J)
+        by_division = split({"code_postal": "75001", "section_activite_principale": "J"}, "postal")
+        self.assertNotIn("section_activite_principale", by_division[0])
+        division_sets = [{code[:2] for code in q["activite_principale"].split(",")} for q in by_division]
+        self.assertEqual(division_sets, [{"58", "59", "60"}, {"61", "62", "63"}])
+
+        by_code = split({"code_postal": "75001", "activite_principale": "62.01Z,62.02A,62.02B"}, "postal")
+        self.assertEqual([q["activite_principale"] for q in by_code], ["62.01Z", "62.02A,62.02B"])
+
+        by_tranche = split({"code_postal": "75001", "activite_principale": "62.01Z", "tranche_effectif_salarie": "01,02"}, "postal")
+        self.assertEqual([q["tranche_effectif_salarie"] for q in by_tranche], ["01", "02"])
+
+        self.assertEqual(split({"code_postal": "75001", "activite_principale": "62.01Z", "tranche_effectif_salarie": "01"}, "postal"), [])
+
+    def _oversized_parent_fakes(self, mock_fetch_first, mock_fetch_page):
+        # "75001,75002" exceeds the cap; each postal code alone fits in 2 pages
+        def fake_fetch_first(url, params, headers, **kwargs):
+            codes = params["code_postal"]
+            if "," in codes:
+                return {"success": True, "results": [{"siren": "parent"}], "total_pages": config.API_MAX_PAGES, "total_results": 10000}
+            return {"success": True, "results": [{"siren": f"{codes}-p1", "matching_etablissements": []}], "total_pages": 2, "total_results": 30}
+
+        mock_fetch_first.side_effect = fake_fetch_first
+        mock_fetch_page.side_effect = lambda page, params, url, headers, **kwargs: {
+            "status": "success", "message": "", "results": [{"siren": f"{params['code_postal']}-p{page}", "matching_etablissements": []}]
+        }
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_rechercher_splits_oversized_batches_automatically(self, mock_fetch_first, mock_fetch_page):
+        self._oversized_parent_fakes(mock_fetch_first, mock_fetch_page)
+        with patch.object(config, "AUTO_SPLIT_ENABLED", True):
+            result = api_client.rechercher_entreprises_par_localisation_et_criteres(["75001", "75002"], {}, code_type="postal")
+
+        self.assertIsInstance(result, list)  # No user confirmation needed
+        sirens = {entreprise["siren"] for entreprise in result}
+        self.assertTrue({"75001-p1", "75001-p2", "75002-p1", "75002-p2"} <= sirens)
+        self.assertEqual(mock_fetch_first.call_count, 3)  # Oversized parent + 2 sub-queries
+        self.assertEqual(mock_fetch_page.call_count, 2)  # Only the leaves' follow-up pages
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_async_search_splits_oversized_batches_automatically(self, mock_fetch_first, mock_fetch_page):
+        self._oversized_parent_fakes(mock_fetch_first, mock_fetch_page)
+        with patch.object(config, "AUTO_SPLIT_ENABLED", True):
+            result = asyncio.run(api_client.rechercher_entreprises_async(["75001", "75002"], {}, code_type="postal"))
+
+        sirens = {entreprise["siren"] for entreprise in result}
+        self.assertTrue({"75001-p1", "75001-p2", "75002-p1", "75002-p2"} <= sirens)
+        self.assertEqual(mock_fetch_first.call_count, 3)
+        self.assertEqual(mock_fetch_page.call_count, 2)
+
+    # --- Tests for SingleFlight ---
+
+    @patch("api_client.http_client.get")
+    def test_identical_in_flight_requests_are_coalesced(self, mock_get):
+        release = threading.Event()
+        mock_response = _json_response({"results": [{"siren": "123", "matching_etablissements": []}]})
+
+        def slow_get(*args, **kwargs):
+            release.wait(5)
+            return mock_response
+
+        mock_get.side_effect = slow_get
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(api_client.fetch_page_with_retry, 2, {"code_postal": codes}, "url", {})
+                for codes in ("75001,75002", "75002,75001", "75001,75002", "75002,75001")
+            ]
+            deadline = time.monotonic() + 5
+            while api_client.single_flight.saved_calls < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)  # Wait until the three followers are waiting on the leader
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(api_client.request_stats()["coalesced_calls_saved"], 3)
+        self.assertEqual(api_client.request_stats()["upstream_calls"], 1)
+        self.assertTrue(all(result["results"] == results[0]["results"] for result in results))
+        # Searches mutate entreprise objects while deduplicating: followers get their own copies
+        self.assertEqual(len({id(result["results"][0]) for result in results}), 4)
+
+    def test_single_flight_shares_leader_exception(self):
+        single_flight = api_client.SingleFlight()
+        leader_started, release = threading.Event(), threading.Event()
+
+        def failing_call():
+            leader_started.set()
+            release.wait(5)
+            raise requests.exceptions.Timeout()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(single_flight.do, "key", failing_call)
+            leader_started.wait(5)
+            follower = executor.submit(single_flight.do, "key", lambda: self.fail("follower must not call"))
+            while single_flight.saved_calls < 1:
+                time.sleep(0.01)
+            release.set()
+            with self.assertRaises(requests.exceptions.Timeout):
+                leader.result()
+            with self.assertRaises(requests.exceptions.Timeout):
+                follower.result()
+
+    def test_single_flight_follower_takes_over_cancelled_leader(self):
+        single_flight = api_client.SingleFlight()
+        leader_started, release = threading.Event(), threading.Event()
+
+        def cancelled_call():
+            leader_started.set()
+            release.wait(5)
+            return None  # The leader's search was cancelled before sending
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(single_flight.do, "key", cancelled_call)
+            leader_started.wait(5)
+            follower = executor.submit(single_flight.do, "key", lambda: {"results": []})
+            while single_flight.saved_calls < 1:
+                time.sleep(0.01)
+            release.set()
+            self.assertIsNone(leader.result())
+            self.assertEqual(follower.result(), {"results": []})
+        self.assertEqual((single_flight.upstream_calls, single_flight.saved_calls), (2, 0))
+
+    def test_single_flight_follower_stops_waiting_when_cancelled(self):
+        single_flight = api_client.SingleFlight()
+        leader_started, release = threading.Event(), threading.Event()
+        cancel_event = threading.Event()
+        cancel_event.set()
+
+        def slow_call():
+            leader_started.set()
+            release.wait(5)
+            return {"results": []}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            leader = executor.submit(single_flight.do, "key", slow_call)
+            leader_started.wait(5)
+            self.assertIsNone(single_flight.do("key", slow_call, cancel_event=cancel_event))
+            release.set()
+            self.assertEqual(leader.result(), {"results": []})
+
+    # --- Tests for RateLimiter (token bucket) ---
+
+    def test_rate_limiter_allows_burst_then_spaces_requests(self):
+        fake_now = [100.0]
+        limiter = api_client.RateLimiter(rate=10, burst=2, clock=lambda: fake_now[0])
+        waits = [limiter.reserve() for _ in range(4)]
+        self.assertEqual(waits[:2], [0.0, 0.0])  # Burst
+        self.assertAlmostEqual(waits[2], 0.1)
+        self.assertAlmostEqual(waits[3], 0.2)  # Reservations queue up at 1/rate intervals
+
+        fake_now[0] += 10  # Long pause: the bucket refills, capped at burst
+        self.assertEqual([limiter.reserve() for _ in range(2)], [0.0, 0.0])
+        self.assertAlmostEqual(limiter.reserve(), 0.1)
+
+    def test_rate_limiter_does_not_sleep_while_holding_lock(self):
+        limiter = api_client.RateLimiter(rate=2, burst=1)
+        limiter.reserve()  # Empty the bucket: the next acquire must sleep ~0.5 s
+        sleeper = threading.Thread(target=limiter.acquire)
+        sleeper.start()
+        time.sleep(0.05)  # Let the other thread reserve and start sleeping
+        start = time.monotonic()
+        wait_time = limiter.reserve()
+        elapsed = time.monotonic() - start
+        sleeper.join()
+        self.assertLess(elapsed, 0.05)  # Reserving did not wait for the sleeping thread
+        self.assertAlmostEqual(wait_time, 1.0, delta=0.1)  # Queued behind the sleeper's slot
+
+    # --- Tests for AdaptiveRateController (AIMD) ---
+
+    def _controller(self, limiter, **kwargs):
+        fake_now = [0.0]
+        options = dict(min_rate=1, max_rate=10, increase_step=0.5, decrease_factor=0.5,
+                       latency_spike_factor=3.0, decrease_cooldown=2.0, state_file=None)
+        options.update(kwargs)
+        controller = api_client.AdaptiveRateController(limiter, clock=lambda: fake_now[0], **options)
+        return controller, fake_now
+
+    def test_adaptive_rate_additive_increase_capped(self):
+        limiter = api_client.RateLimiter(rate=4)
+        controller, _ = self._controller(limiter)
+        for _ in range(8):  # About two seconds of traffic at 4 req/s
+            controller.on_success(0.2)
+        self.assertAlmostEqual(limiter.rate, 5.0, delta=0.1)  # + increase_step per second of traffic
+        for _ in range(1000):
+            controller.on_success(0.2)
+        self.assertEqual(limiter.rate, 10)  # Capped at max_rate
+
+    def test_adaptive_rate_multiplicative_decrease_once_per_cooldown(self):
+        limiter = api_client.RateLimiter(rate=8)
+        controller, fake_now = self._controller(limiter)
+        controller.on_throttled(1.0)
+        controller.on_throttled(1.0)  # In-flight requests of the same burst: no second cut
+        self.assertEqual(limiter.rate, 4)
+        fake_now[0] += 2.5
+        controller.on_throttled(1.0)
+        self.assertEqual(limiter.rate, 2)
+        fake_now[0] += 2.5
+        controller.on_throttled(1.0)
+        self.assertEqual(limiter.rate, 1)  # Never below min_rate
+        self.assertEqual(controller.throttled_responses, 4)
+
+    def test_adaptive_rate_latency_spike_decreases_rate(self):
+        limiter = api_client.RateLimiter(rate=8)
+        controller, _ = self._controller(limiter, max_rate=8)
+        for _ in range(api_client.AdaptiveRateController.LATENCY_WARMUP_SAMPLES):
+            controller.on_success(0.2)
+        self.assertEqual(limiter.rate, 8)
+        controller.on_success(0.3)  # Normal jitter
+        self.assertEqual(limiter.rate, 8)
+        controller.on_success(2.0)  # 10x the average latency
+        self.assertEqual(limiter.rate, 4)
+        self.assertEqual(controller.latency_spikes, 1)
+
+    @patch("api_client.http_client.get")
+    def test_server_errors_do_not_raise_the_rate(self, mock_get):
+        limiter = api_client.RateLimiter(rate=4)
+        controller, _ = self._controller(limiter)
+        mock_get.return_value = _json_response({"message": "Service indisponible"}, status_code=503)
+        with patch.object(api_client, "rate_controller", controller):
+            for _ in range(20):  # A gateway answering fast during an outage
+                api_client._timed_get("url", {}, {}, timeout=1)
+
+        self.assertLess(limiter.rate, 4)
+        self.assertEqual(controller.server_errors, 20)
+        self.assertIsNone(api_client.response_latencies.percentile(50))  # Error latencies do not set the hedge delay
+
+    def test_rate_limiter_pause_delays_all_reservations(self):
+        fake_now = [0.0]
+        limiter = api_client.RateLimiter(rate=10, burst=1, clock=lambda: fake_now[0])
+        limiter.pause(3.0)
+        self.assertAlmostEqual(limiter.reserve(), 3.0)
+        self.assertAlmostEqual(limiter.reserve(), 3.1)  # Spaced at the current rate after the pause
+        limiter.pause(1.0)  # Shorter than the pause in progress: ignored
+        fake_now[0] += 10
+        self.assertEqual(limiter.reserve(), 0.0)
+
+    def test_adaptive_rate_persisted_for_later_searches(self):
+        state_file = self._rate_state_file()
+        limiter = api_client.RateLimiter(rate=6)
+        controller, _ = self._controller(limiter, state_file=state_file)
+        controller.on_throttled(0.0)
+        controller.save()
+
+        later_limiter = api_client.RateLimiter(rate=6)
+        later_controller, _ = self._controller(later_limiter, state_file=state_file)
+        self.assertEqual(later_controller.load(), 3)
+        self.assertEqual(later_limiter.rate, 3)
+
+        with open(state_file, "w") as f:
+            f.write('{"rate": 500}')
+        self.assertEqual(later_controller.load(), 10)  # Clamped to max_rate
+
+    def _rate_state_file(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir, True)
+        return os.path.join(state_dir, "rate_limit.json")
+
+    def test_file_rate_limiter_budget_shared_between_instances(self):
+        state_file = self._rate_state_file()
+        fake_now = [1000.0]
+        session_a = api_client.FileRateLimiter(rate=5, burst=1, state_file=state_file, clock=lambda: fake_now[0])
+        session_b = api_client.FileRateLimiter(rate=5, burst=1, state_file=state_file, clock=lambda: fake_now[0])
+        self.assertEqual(session_a.reserve(), 0.0)
+        self.assertAlmostEqual(session_b.reserve(), 0.2)  # Queued behind session A's request
+        self.assertAlmostEqual(session_a.reserve(), 0.4)
+        fake_now[0] += 5
+        self.assertEqual(session_b.reserve(), 0.0)
+
+    def test_file_rate_limiter_shares_rate_and_pause(self):
+        state_file = self._rate_state_file()
+        fake_now = [1000.0]
+        session_a = api_client.FileRateLimiter(rate=5, burst=1, state_file=state_file, clock=lambda: fake_now[0])
+        session_b = api_client.FileRateLimiter(rate=5, burst=1, state_file=state_file, clock=lambda: fake_now[0])
+        session_a.set_rate(2)
+        session_a.pause(4.0)
+        self.assertEqual(session_b.rate, 2)
+        self.assertAlmostEqual(session_b.reserve(), 4.0)
+        self.assertAlmostEqual(session_b.reserve(), 4.5)
+
+    def test_file_rate_limiter_recovers_from_corrupt_state(self):
+        state_file = self._rate_state_file()
+        with open(state_file, "w") as f:
+            f.write("not json")
+        limiter = api_client.FileRateLimiter(rate=5, burst=1, state_file=state_file)
+        self.assertEqual(limiter.reserve(), 0.0)
+
+    @unittest.skipIf(api_client.fcntl is None, "fcntl not available on this platform")
+    def test_file_rate_limiter_budget_shared_between_processes(self):
+        state_file = self._rate_state_file()
+        script = (
+            "import sys; sys.path.insert(0, sys.argv[1]); import api_client; "
+            "limiter = api_client.FileRateLimiter(rate=10, burst=1, state_file=sys.argv[2]); "
+            "print('ready', flush=True); sys.stdin.readline(); "
+            "print(max(limiter.reserve() for _ in range(3)), flush=True)"
+        )
+        repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-c", script, repo_root, state_file],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+            )
+            for _ in range(2)
+        ]
+        for process in processes:  # Wait for both imports, then start both at once
+            self.assertEqual(process.stdout.readline().strip(), "ready")
+        for process in processes:
+            process.stdin.write("go\n")
+            process.stdin.flush()
+        max_waits = [float(process.communicate(timeout=60)[0].strip()) for process in processes]
+        # 6 reservations at 10 req/s from one shared bucket: the last one waits ~0.5 s.
+        # Two separate budgets would each top out at ~0.2 s.
+        self.assertGreater(max(max_waits), 0.35)
+
+    # --- Tests for ApiHttpClient (pooled keep-alive sessions) ---
+
+    def _start_connection_counting_server(self):
+        """Local HTTP/1.1 server that counts the TCP connections it accepts."""
+        accepted_connections = []
+
+        class CountingHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                accepted_connections.append(self.client_address)  # Once per connection
+                super().setup()
+
+            def do_GET(self):
+                body = b'{"results": [], "total_pages": 1, "total_results": 0}'
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}/search", accepted_connections
+
+    def test_http_client_reuses_connections_across_pages(self):
+        url, accepted_connections = self._start_connection_counting_server()
+        client = api_client.ApiHttpClient(pool_size=2)
+        self.addCleanup(client.close)
+
+        for page in range(1, 11):
+            response = client.get(url, params={"page": page}, headers={}, timeout=5)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(len(accepted_connections), 1)  # 10 pages, a single TCP connection
+
+    def test_http_client_shares_pool_between_threads(self):
+        url, accepted_connections = self._start_connection_counting_server()
+        client = api_client.ApiHttpClient(pool_size=3)
+        self.addCleanup(client.close)
+
+        def fetch_pages(_):
+            for page in range(5):
+                client.get(url, params={"page": page}, headers={}, timeout=5).content
+
+        # Two successive executors, like two searches: connections survive the worker threads.
+        for _ in range(2):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+                list(executor.map(fetch_pages, range(3)))
+
+        self.assertLessEqual(len(accepted_connections), 3)  # Bounded by the pool, not by requests or threads
+
+    def test_http_client_close_releases_connections(self):
+        url, accepted_connections = self._start_connection_counting_server()
+        client = api_client.ApiHttpClient(pool_size=1)
+        client.get(url, timeout=5)
+        client.close()
+        client.get(url, timeout=5)  # A fresh session is created after close()
+        client.close()
+        self.assertEqual(len(accepted_connections), 2)
+
+    def test_cassette_replays_recorded_search_without_server(self):
+        cassette_path = os.path.join(tempfile.mkdtemp(), "trafic.jsonl.gz")
+        codes = ["75001", "75002"]
+        params = {"section_activite_principale": "C,G,J,M", "tranche_effectif_salarie": "11,12,21"}
+        dataset = fake_api_server.FakeDataset(1000, seed=4)
+
+        with patch.object(config, "INITIAL_RETRY_DELAY", 0.01):
+            with fake_api_server.FakeApiServer(dataset, rate_429=0.3, retry_after=0, seed=5) as server, \
+                    patch.object(config, "API_BASE_URL", server.url), \
+                    api_client.cassette(cassette_path, "record") as recorder:
+                recorded = api_client.rechercher_entreprises_par_localisation_et_criteres(codes, params, code_type="postal")
+            # The server is gone: every response, 429s included, now comes from the cassette
+            with patch.object(config, "API_BASE_URL", server.url), \
+                    api_client.cassette(cassette_path, "replay", timing="fast") as replayer:
+                events = []
+                replayed = api_client.rechercher_entreprises_par_localisation_et_criteres(codes, params, code_type="postal", on_event=events.append)
+
+        self.assertEqual(recorder.recorded, server.stats["requests"])
+        self.assertEqual([e["siren"] for e in replayed], [e["siren"] for e in recorded])
+        self.assertEqual((replayer.replayed, replayer.misses), (recorder.recorded, 0))
+        self.assertEqual(sum(event["type"] == "throttled" for event in events), server.stats["throttled"])
+        self.assertIsInstance(api_client.http_client, api_client.ApiHttpClient)  # Restored after the block
+
+    def test_cassette_replay_leaves_shared_rate_budget_and_latencies_alone(self):
+        cassette_path = os.path.join(tempfile.mkdtemp(), "trafic.jsonl.gz")
+        inner = MagicMock()
+        inner.get.return_value = MagicMock(status_code=200, headers={"Content-Type": "application/json"}, text='{"results": []}')
+        recorder = api_client.RecordingHttpClient(inner, cassette_path)
+        for page in range(1, 11):
+            recorder.get("http://api/search", params={"page": page}, timeout=5)
+        recorder.close()
+        api_client.rate_limiter = shared_limiter = api_client.RateLimiter(rate=0.001, burst=1)
+        api_client.rate_controller = shared_controller = api_client.AdaptiveRateController(shared_limiter, min_rate=0.001, max_rate=1, state_file=None)
+        shared_limiter.reserve()  # Shared budget exhausted: a throttled replay would wait for hours
+
+        start = time.monotonic()
+        with api_client.cassette(cassette_path, "replay", timing="fast"):
+            for page in range(1, 11):
+                api_client._send_api_request("http://api/search", {"page": page}, {}, timeout=5)
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIs(api_client.rate_limiter, shared_limiter)
+        self.assertIs(api_client.rate_controller, shared_controller)
+        self.assertEqual(shared_limiter.rate, 0.001)  # No AIMD increase from replayed answers
+        self.assertIsNone(api_client.response_latencies.percentile(50))  # Hedge window not fed
+
+    def test_cassette_replay_timing_and_misses(self):
+        cassette_path = os.path.join(tempfile.mkdtemp(), "trafic.jsonl.gz")
+        inner = MagicMock()
+        inner.get.side_effect = [requests.exceptions.Timeout(), MagicMock(status_code=200, headers={"Content-Type": "application/json"}, text='{"results": []}')]
+        recorder = api_client.RecordingHttpClient(inner, cassette_path)
+        with self.assertRaises(requests.exceptions.Timeout):
+            recorder.get("http://api/search", params={"code_postal": "75001,75002", "page": 1}, timeout=5)
+        recorder.get("http://api/search", params={"page": 1, "code_postal": "75002,75001"}, timeout=5)
+        recorder.close()
+
+        replayer = api_client.ReplayHttpClient(cassette_path, timing="fast")
+        with self.assertRaises(requests.exceptions.Timeout):
+            replayer.get("http://api/search", params={"page": 1, "code_postal": "75001,75002"})
+        response = replayer.get("http://api/search", params={"page": 1, "code_postal": "75001,75002"})
+        self.assertEqual((response.status_code, response.json()), (200, {"results": []}))
+        # Exhausted requests get the last recorded response again; unknown ones are misses
+        self.assertEqual(replayer.get("http://api/search", params={"page": 1, "code_postal": "75001,75002"}).status_code, 200)
+        with self.assertRaises(api_client.CassetteMiss):
+            replayer.get("http://api/search", params={"page": 2, "code_postal": "75001,75002"})
+        self.assertEqual(replayer.misses, 1)
+
+    def test_rate_limiter_try_reserve_only_takes_available_tokens(self):
+        clock = [100.0]
+        limiter = api_client.RateLimiter(rate=1, burst=1, clock=lambda: clock[0])
+        self.assertTrue(limiter.try_reserve())
+        self.assertFalse(limiter.try_reserve())  # Never borrows against the future
+        clock[0] += 1.0
+        limiter.pause(5)
+        self.assertFalse(limiter.try_reserve())
+        clock[0] += 5.0
+        self.assertTrue(limiter.try_reserve())
+        self.assertEqual(limiter.reserve(), 1.0)  # The hedge token was really spent
+
+    def test_latency_window_percentile(self):
+        window = api_client.LatencyWindow(size=100)
+        self.assertIsNone(window.percentile(95))
+        for latency in range(1, 101):
+            window.record(latency / 100)
+        self.assertEqual(window.percentile(95), 0.95)
+        self.assertIsNone(window.percentile(95, min_samples=101))
+        window.record(10.0)  # The oldest value leaves the window
+        self.assertEqual(window.percentile(100), 10.0)
+
+    def _slow_then_fast_get(self, release_slow):
+        calls = []
+
+        def get(url, params=None, headers=None, timeout=None):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                release_slow.wait(5)  # Stuck primary request
+                return MagicMock(status_code=200, name="slow")
+            return MagicMock(status_code=200, name="fast")
+        return get, calls
+
+    def test_hedged_request_returns_first_answer(self):
+        release_slow = threading.Event()
+        self.addCleanup(release_slow.set)
+        get, calls = self._slow_then_fast_get(release_slow)
+        stats = api_client.SearchLatencyStats()
+        api_client._search_context.stats = stats
+        self.addCleanup(setattr, api_client._search_context, "stats", None)
+
+        with patch.object(api_client.http_client, "get", side_effect=get):
+            start = time.monotonic()
+            response = api_client._hedged_get("http://api/search", {"page": 2}, {}, timeout=20, hedge_delay=0.05)
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(calls[1] - calls[0], 0.05)
+        self.assertEqual(response._mock_name, "fast")
+        self.assertEqual((stats.hedged_requests, stats.hedge_wins), (1, 1))
+
+    def test_hedged_request_waits_when_no_token_is_spare(self):
+        release_slow = threading.Event()
+        get, calls = self._slow_then_fast_get(release_slow)
+        api_client.rate_limiter = api_client.RateLimiter(rate=0.001, burst=1)
+        api_client.rate_limiter.reserve()  # Budget exhausted: a duplicate would exceed it
+        threading.Timer(0.2, release_slow.set).start()
+
+        with patch.object(api_client.http_client, "get", side_effect=get):
+            response = api_client._hedged_get("http://api/search", {"page": 2}, {}, timeout=20, hedge_delay=0.05)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(response._mock_name, "slow")
+
+    def test_hedged_request_is_not_doubled_during_half_open_probe(self):
+        release_slow = threading.Event()
+        get, calls = self._slow_then_fast_get(release_slow)
+        clock = [0.0]
+        api_client.circuit_breaker = breaker = api_client.CircuitBreaker(window=1, min_calls=1, error_rate=1, open_seconds=30, clock=lambda: clock[0])
+        breaker.record(False)
+        clock[0] += 30
+        token = breaker.allow_request()  # The probe in flight
+        threading.Timer(0.2, release_slow.set).start()
+
+        with patch.object(api_client.http_client, "get", side_effect=get):
+            response = api_client._hedged_get("http://api/search", {"page": 2}, {}, timeout=20, hedge_delay=0.05, circuit_token=token)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(response._mock_name, "slow")
+        self.assertEqual(breaker.state, "closed")  # The probe's answer closed the circuit
+
+    def test_hedged_requests_reuse_a_bounded_thread_pool(self):
+        threads = set()
+
+        def get(url, params=None, headers=None, timeout=None):
+            threads.add(threading.current_thread().name)
+            return MagicMock(status_code=200)
+
+        with patch.object(api_client.http_client, "get", side_effect=get), \
+                patch.object(api_client, "_hedge_slots", threading.BoundedSemaphore(2)):
+            for page in range(20):
+                api_client._hedged_get("http://api/search", {"page": page}, {}, timeout=20, hedge_delay=1)
+            with api_client._hedge_slots, api_client._hedge_slots:  # Pool busy: sent from the caller's thread
+                api_client._hedged_get("http://api/search", {"page": 21}, {}, timeout=20, hedge_delay=1)
+
+        self.assertLessEqual(len(threads - {threading.current_thread().name}), config.HEDGE_MAX_THREADS)
+        self.assertTrue(all(name.startswith("hedge") for name in threads - {threading.current_thread().name}))
+        self.assertIn(threading.current_thread().name, threads)
+
+    def test_send_api_request_hedges_after_latency_percentile(self):
+        for _ in range(config.HEDGE_MIN_SAMPLES):
+            api_client.response_latencies.record(0.01)
+        with patch.object(config, "HEDGED_REQUESTS_ENABLED", True), patch.object(config, "HEDGE_MIN_DELAY", 0.05), \
+                patch.object(api_client, "_hedged_get", return_value="hedged") as mock_hedged:
+            self.assertEqual(api_client._send_api_request("http://api/search", {}, {}, timeout=20), "hedged")
+        self.assertEqual(mock_hedged.call_args.args[4], 0.05)  # Percentile below the floor
+
+    def test_search_reports_tail_latency(self):
+        dataset = fake_api_server.FakeDataset(500, seed=6)
+        events = []
+        with fake_api_server.FakeApiServer(dataset, latency="uniform:0.01:0.03") as server, \
+                patch.object(config, "API_BASE_URL", server.url):
+            api_client.rechercher_entreprises_par_localisation_et_criteres(
+                ["75001", "75002", "75003"], {"section_activite_principale": "C,G,J,M,N"}, code_type="postal", on_event=events.append
+            )
+        finished, = [event for event in events if event["type"] == "search_finished"]
+        latency = finished["latency"]
+        self.assertEqual(latency["pages"], sum(event["type"] == "page_fetched" for event in events))
+        self.assertTrue(0.01 <= latency["p50"] <= latency["p95"] <= latency["max"])
+        self.assertEqual(latency["hedged_requests"], 0)
+
+    def test_circuit_breaker_opens_probes_and_closes(self):
+        clock = [0.0]
+        breaker = api_client.CircuitBreaker(window=4, min_calls=4, error_rate=0.5, open_seconds=30, clock=lambda: clock[0])
+        for success in (True, True, False):
+            breaker.record(success)
+        self.assertEqual(breaker.state, "closed")
+        breaker.record(False)  # 2 failures out of 4
+        self.assertEqual((breaker.state, breaker.retry_in()), ("open", 30.0))
+        self.assertFalse(breaker.allow_request())
+        breaker.record(True)  # Late answer of a request sent before the opening
+        self.assertEqual(breaker.state, "open")
+
+        clock[0] += 30
+        self.assertEqual(breaker.state, "half_open")
+        probe = breaker.allow_request()
+        self.assertTrue(probe)
+        self.assertFalse(breaker.allow_request())  # A single probe at a time
+        breaker.record(True)  # Late answer of a request sent before the opening: not the probe
+        self.assertEqual(breaker.state, "half_open")
+        breaker.record(False, probe)
+        self.assertEqual((breaker.state, breaker.openings), ("open", 2))
+
+        clock[0] += 30
+        probe = breaker.allow_request()
+        breaker.release_probe(probe)  # Cancelled before sending: the probe is still available
+        probe = breaker.allow_request()
+        self.assertTrue(probe)
+        breaker.record(True, probe)
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(breaker.rejected_requests, 2)
+
+    def test_half_open_probe_failing_with_any_request_error_reopens_circuit(self):
+        clock = [0.0]
+        api_client.circuit_breaker = breaker = api_client.CircuitBreaker(window=1, min_calls=1, error_rate=1, open_seconds=30, clock=lambda: clock[0])
+        breaker.record(False)
+        clock[0] += 30
+
+        with patch.object(api_client.http_client, "get", side_effect=requests.exceptions.ChunkedEncodingError("truncated")):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                api_client._send_api_request("http://api/search", {"page": 1}, {}, timeout=20)
+        self.assertEqual((breaker.state, breaker.openings), ("open", 2))  # Not stuck in half-open
+
+        clock[0] += 30
+        with patch.object(api_client.http_client, "get", side_effect=RuntimeError("bug")):
+            with self.assertRaises(RuntimeError):
+                api_client._send_api_request("http://api/search", {"page": 1}, {}, timeout=20)
+        self.assertTrue(breaker.allow_request())  # Not an API failure: the probe is available again
+
+    def test_open_circuit_fails_fast_without_rate_limit_wait(self):
+        breaker = api_client.CircuitBreaker(window=2, min_calls=2, error_rate=0.5, open_seconds=60)
+        breaker.record(False)
+        breaker.record(False)
+        api_client.circuit_breaker = breaker
+        api_client.rate_limiter = MagicMock()
+
+        with patch.object(api_client.http_client, "get") as mock_get:
+            with self.assertRaises(api_client.CircuitOpenError):
+                api_client._send_api_request("http://api/search", {"page": 1}, {}, timeout=20)
+            result = api_client.fetch_page_with_retry(2, {}, "http://api/search", {})
+
+        mock_get.assert_not_called()
+        api_client.rate_limiter.acquire.assert_not_called()
+        self.assertEqual(result["status"], "error")
+        self.assertIn("disjoncteur", result["message"])
+
+    def test_open_circuit_serves_expired_cached_pages(self):
+        clock = [1000.0]
+        api_client.page_cache = api_client.PageCache(os.path.join(tempfile.mkdtemp(), "pages.sqlite3"), ttl_seconds=60, max_bytes=10**6, clock=lambda: clock[0])
+        self.addCleanup(api_client.page_cache.close)
+        api_client.page_cache.put("http://api/search", {"page": 1}, {"results": [{"siren": "1"}]})
+        clock[0] += 120  # Expired
+        api_client.circuit_breaker = breaker = api_client.CircuitBreaker(window=1, min_calls=1, error_rate=1, open_seconds=60)
+        breaker.record(False)
+
+        data = api_client._get_page_data("http://api/search", {"page": 1}, {}, timeout=20)
+
+        self.assertEqual(data["results"], [api_models.Entreprise(siren="1")])
+        breaker._opened_at = None  # Closed again: expired pages are no longer served
+        with patch.object(api_client.http_client, "get", side_effect=requests.exceptions.ConnectionError("down")):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                api_client._get_page_data("http://api/search", {"page": 1}, {}, timeout=20)
+
+    def test_search_against_dead_upstream_stops_after_breaker_opens(self):
+        api_client.circuit_breaker = api_client.CircuitBreaker(window=10, min_calls=2, error_rate=0.5, open_seconds=60)
+        api_client.MAX_CODES_PER_API_CALL = 1
+        events = []
+        with fake_api_server.FakeApiServer(fake_api_server.FakeDataset(200), rate_503=1.0) as server, \
+                patch.object(config, "API_BASE_URL", server.url), patch.object(config, "SEARCH_MAX_WORKERS", 1):
+            entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(
+                ["75001", "75002", "75003", "75004", "75005", "75006"], {"section_activite_principale": "J"},
+                force_full_fetch=True, code_type="postal", on_event=events.append,
+            )
+
+        self.assertEqual(entreprises, [])
+        self.assertEqual(server.stats["requests"], 2)  # The other four batches failed without being sent
+        circuit_events = [event for event in events if event["type"] == "circuit"]
+        self.assertEqual(circuit_events[0]["state"], "open")
+        self.assertEqual(api_client.request_stats()["circuit_breaker"]["rejected_requests"], 4)
+
     # --- Tests for rechercher_entreprises_par_localisation_et_criteres ---
     # These will be higher-level, mocking out the actual API calls.
 
-    @patch("api_client.st")  # Mock all streamlit calls
     @patch("api_client.fetch_first_page")
     @patch(
         "api_client.concurrent.futures.ThreadPoolExecutor"
     )  # To avoid actual threading
     def test_rechercher_empty_localisation_codes(
-        self, mock_executor, mock_fetch_first, mock_st_glob
+        self, mock_executor, mock_fetch_first
     ):
+        events = []
         result = api_client.rechercher_entreprises_par_localisation_et_criteres(
-            [], {"activite_principale": "123"}, False, "commune"
+            [], {"activite_principale": "123"}, False, "commune", on_event=events.append
         )
         self.assertEqual(result, [])
-        mock_st_glob.warning.assert_called_once()
+        self.assertEqual([(e["type"], e["level"]) for e in events], [("error", "warning")])
         mock_fetch_first.assert_not_called()
 
-    @patch("api_client.st")
+    @patch("api_client.fetch_page_with_retry")
     @patch("api_client.fetch_first_page")
-    @patch("api_client.concurrent.futures.ThreadPoolExecutor")
     def test_rechercher_success_single_batch_page1_only(
-        self, mock_executor, mock_fetch_first, mock_st_glob
+        self, mock_fetch_first, mock_fetch_page
     ):
         mock_fetch_first.return_value = {
             "success": True,
@@ -210,13 +1317,12 @@ class TestApiClient(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]["siren"], "123")
         mock_fetch_first.assert_called_once()
-        mock_executor.assert_not_called()  # No thread pool for 1 page
+        mock_fetch_page.assert_not_called()  # No follow-up page for a 1-page batch
 
-    @patch("api_client.st")
+    @patch("api_client.fetch_page_with_retry")
     @patch("api_client.fetch_first_page")
-    @patch("api_client.concurrent.futures.ThreadPoolExecutor")
     def test_rechercher_success_single_batch_multiple_pages(
-        self, MockThreadPoolExecutor, mock_fetch_first, mock_st_glob    
+        self, mock_fetch_first, mock_fetch_page
     ):
         mock_fetch_first.return_value = {
             "success": True,
@@ -227,50 +1333,137 @@ class TestApiClient(unittest.TestCase):
             "total_results": 2,
             "error_message": None,
         }
-
-        # This is what each call to the local fetcher (via future.result()) should return
-        mock_page2_data = {
+        mock_fetch_page.return_value = {
             "status": "success",
             "message": "",
             "results": [
                 {"siren": "222", "matching_etablissements": [{"siret": "2220001"}]}
             ],
         }
-        
-        mock_executor_instance = MockThreadPoolExecutor.return_value.__enter__.return_value
-        
-        # Mock the future object that submit would return
-        mock_future_page2 = MagicMock()
-        mock_future_page2.result.return_value = mock_page2_data
-        
-        # Make executor.submit return our mock future
-        # This assumes only one other page (page 2) is fetched in this scenario.
-        # If more pages were fetched, submit would be called multiple times.
-        mock_executor_instance.submit.return_value = mock_future_page2
-
-        # To correctly mock as_completed, we need to ensure it yields the futures
-        # that executor.submit created.
-        # We also need to patch concurrent.futures.as_completed itself.
-        with patch('api_client.concurrent.futures.as_completed', return_value=[mock_future_page2]) as mock_as_completed:
-            # The future_to_page_batch mapping in the SUT will map mock_future_page2 to page number 2.
-
-            result = api_client.rechercher_entreprises_par_localisation_et_criteres(
-                ["75001"], {"activite_principale": "XYZ"}, False, "commune"
-            )
+
+        result = api_client.rechercher_entreprises_par_localisation_et_criteres(
+            ["75001"], {"activite_principale": "XYZ"}, False, "commune"
+        )
 
         self.assertEqual(len(result), 2)  # siren 111 from page 1, siren 222 from page 2
         sirens = {r["siren"] for r in result}
         self.assertIn("111", sirens)
         self.assertIn("222", sirens)
         mock_fetch_first.assert_called_once()
-        mock_executor_instance.submit.assert_called_once() # Check that a task was submitted
-        # Check that the arguments to submit were for page 2
-        args_submitted, _ = mock_executor_instance.submit.call_args
-        self.assertEqual(args_submitted[1], 2) # page_num_local should be 2
+        mock_fetch_page.assert_called_once()
+        args_submitted, _ = mock_fetch_page.call_args
+        self.assertEqual(args_submitted[0], 2)  # Only page 2 is scheduled as a follow-up
 
-    @patch("api_client.st")
+    @patch("api_client.fetch_page_with_retry")
     @patch("api_client.fetch_first_page")
-    def test_rechercher_needs_confirmation(self, mock_fetch_first, mock_st_glob):
+    def test_rechercher_schedules_follow_up_pages_without_waiting_for_other_batches(
+        self, mock_fetch_first, mock_fetch_page
+    ):
+        # Batch 1's page 1 is slow: it only returns once batch 2's follow-up pages have
+        # started. A sequential per-batch loop would never fetch them and would time out.
+        batch2_follow_ups_started = threading.Event()
+        slow_page1_returned = threading.Event()
+        follow_ups_started_before_slow_page1 = []
+
+        def fake_first_page(url, params, headers, **kwargs):
+            if params["code_commune"] == "code_b1_1,code_b1_2":
+                batch2_follow_ups_started.wait(timeout=5)
+                slow_page1_returned.set()
+                return {"success": True, "results": [], "total_pages": 0, "total_results": 0}
+            return {
+                "success": True,
+                "results": [{"siren": "222", "matching_etablissements": [{"siret": "2220001"}]}],
+                "total_pages": 3,
+                "total_results": 60,
+            }
+
+        def fake_fetch_page(page_num, params, url, headers, **kwargs):
+            follow_ups_started_before_slow_page1.append(not slow_page1_returned.is_set())
+            batch2_follow_ups_started.set()
+            return {"status": "success", "message": "", "results": []}
+
+        mock_fetch_first.side_effect = fake_first_page
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        result = api_client.rechercher_entreprises_par_localisation_et_criteres(
+            ["code_b1_1", "code_b1_2", "code_b2_1"], {"activite_principale": "XYZ"}, False, "commune"
+        )
+
+        self.assertTrue(batch2_follow_ups_started.is_set())
+        self.assertEqual(mock_fetch_page.call_count, 2)  # Pages 2 and 3 of batch 2
+        self.assertTrue(follow_ups_started_before_slow_page1[0])
+        self.assertEqual([r["siren"] for r in result], ["222"])
+
+    @patch("api_client.fetch_first_page")
+    def test_rechercher_early_exit_resolved_in_batch_order(self, mock_fetch_first):
+        # Batch 2 is too large and answers first; batch 1 fails later. As with the former
+        # sequential loop, the failure of the first batch must win.
+        batch2_answered = threading.Event()
+
+        def fake_first_page(url, params, headers, **kwargs):
+            if params["code_commune"] == "code_b1_1,code_b1_2":
+                batch2_answered.wait(timeout=5)
+                return {"success": False, "error_message": "boom"}
+            batch2_answered.set()
+            return {
+                "success": True,
+                "results": [{"siren": "123"}],
+                "total_pages": config.API_MAX_PAGES,
+                "total_results": config.API_MAX_TOTAL_RESULTS,
+            }
+
+        mock_fetch_first.side_effect = fake_first_page
+        events = []
+        result = api_client.rechercher_entreprises_par_localisation_et_criteres(
+            ["code_b1_1", "code_b1_2", "code_b2_1"], {"activite_principale": "XYZ"}, False, "commune", on_event=events.append
+        )
+        self.assertIsNone(result)
+        self.assertEqual(events[-1]["type"], "search_finished")
+        self.assertEqual(events[-1]["outcome"], "failed")
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_rechercher_early_exit_cancels_and_waits_for_in_flight_pages(
+        self, mock_fetch_first, mock_fetch_page
+    ):
+        # Batch 1 has follow-up pages in flight when batch 2 turns out too large.
+        page_in_flight = threading.Event()
+        cancel_events_seen = []
+        finished_pages = []
+
+        def fake_first_page(url, params, headers, **kwargs):
+            if params["code_commune"] == "code_b2_1":
+                page_in_flight.wait(timeout=5)
+                return {"success": True, "results": [], "total_pages": config.API_MAX_PAGES, "total_results": config.API_MAX_TOTAL_RESULTS}
+            return {"success": True, "results": [], "total_pages": 2, "total_results": 30}
+
+        def fake_fetch_page(page_num, params, url, headers, cancel_event=None, on_event=None):
+            cancel_events_seen.append(cancel_event)
+            page_in_flight.set()
+            cancel_event.wait(timeout=5)  # Behaves like a retry sleep interrupted by cancellation
+            finished_pages.append(page_num)
+            return {"status": "cancelled", "message": "", "results": []}
+
+        mock_fetch_first.side_effect = fake_first_page
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        result = api_client.rechercher_entreprises_par_localisation_et_criteres(
+            ["code_b1_1", "code_b1_2", "code_b2_1"], {"activite_principale": "XYZ"}, False, "commune"
+        )
+
+        self.assertEqual(result["status_code"], "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN")
+        self.assertTrue(cancel_events_seen[0].is_set())
+        self.assertEqual(finished_pages, [2])  # The in-flight page completed before the call returned
+
+    @patch("api_client.fetch_first_page")
+    def test_rechercher_retries_page1(self, mock_fetch_first):
+        mock_fetch_first.return_value = {"success": True, "results": [], "total_pages": 0, "total_results": 0}
+        api_client.rechercher_entreprises_par_localisation_et_criteres(["75001"], {"activite_principale": "XYZ"})
+        _, kwargs = mock_fetch_first.call_args
+        self.assertEqual(kwargs["max_retries"], config.MAX_RETRIES_ON_429)
+
+    @patch("api_client.fetch_first_page")
+    def test_rechercher_needs_confirmation(self, mock_fetch_first):
         mock_fetch_first.return_value = {
             "success": True,
             "results": [{"siren": "123"}],
@@ -286,9 +1479,8 @@ class TestApiClient(unittest.TestCase):
         self.assertEqual(result["status_code"], "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN")
         self.assertEqual(len(result["page1_results"]), 1)
 
-    @patch("api_client.st")
     @patch("api_client.fetch_first_page")
-    def test_rechercher_deduplication_and_merge(self, mock_fetch_first, mock_st_glob):
+    def test_rechercher_deduplication_and_merge(self, mock_fetch_first):
         # Simulate two batches, each returning data for the same SIREN but different etablissements
         # Batch 1 (code1)
         results_batch1 = [
@@ -363,10 +1555,149 @@ class TestApiClient(unittest.TestCase):
             siren_333_data["matching_etablissements"][0]["siret"], "3330001"
         )
 
-    @patch("api_client.st")
+    def test_siren_merge_index_returns_new_parts_only(self):
+        merge_index = api_client.SirenMergeIndex()
+        first = {"siren": "111", "matching_etablissements": [{"siret": "1110001"}]}
+        self.assertIs(merge_index.add(first), first)
+        self.assertIsNone(merge_index.add({"siren": "111", "matching_etablissements": [{"siret": "1110001"}]}))
+        new_part = merge_index.add({"siren": "111", "matching_etablissements": [{"siret": "1110001"}, {"siret": "1110002"}, {"siret": "1110002"}]})
+        self.assertEqual(new_part["matching_etablissements"], [{"siret": "1110002"}])
+        merge_index.add({"nom_complet": "Sans SIREN"})
+
+        self.assertEqual(len(merge_index), 2)
+        merged = merge_index.entreprises()
+        self.assertEqual([etab["siret"] for etab in merged[0]["matching_etablissements"]], ["1110001", "1110002"])
+        self.assertEqual(first["matching_etablissements"], [{"siret": "1110001"}])  # The caller's object is not grown
+
+    @patch("api_client.fetch_first_page")
+    def test_iter_entreprises_yields_each_establishment_once(self, mock_fetch_first):
+        pages_by_batch = {
+            "c1,c2": [
+                {"siren": "111", "matching_etablissements": [{"siret": "1110001"}]},
+                {"siren": "222", "matching_etablissements": [{"siret": "2220001"}]},
+            ],
+            "c3": [
+                {"siren": "111", "matching_etablissements": [{"siret": "1110001"}, {"siret": "1110002"}]},
+                {"siren": "222", "matching_etablissements": [{"siret": "2220001"}]},
+            ],
+        }
+        mock_fetch_first.side_effect = lambda url, params, headers, **kwargs: {
+            "success": True, "results": pages_by_batch[params["code_commune"]], "total_pages": 1, "total_results": 2,
+        }
+
+        chunks = list(api_client.iter_entreprises_par_localisation(["c1", "c2", "c3"], {"activite_principale": "XYZ"}))
+
+        sirets = [etab["siret"] for chunk in chunks for entreprise in chunk for etab in entreprise["matching_etablissements"]]
+        self.assertEqual(sorted(sirets), ["1110001", "1110002", "2220001"])
+        self.assertEqual(len(chunks), 2)  # Company 222 brings nothing new in the second page
+
+    @patch("api_client.fetch_first_page")
+    def test_truncated_entreprises_completed_by_siren(self, mock_fetch_first):
+        etab_codes = {"1110001": "c1", "1110002": "c2", "1110003": "c3", "1110004": "c3"}
+
+        def fake_fetch(url, params, headers, **kwargs):
+            codes = params["code_commune"].split(",")
+            etabs = [{"siret": siret, "commune": code} for siret, code in etab_codes.items() if code in codes]
+            entreprises = [{"siren": "111", "matching_etablissements": etabs[:2]}]  # limite_matching_etablissements=2
+            if "q" not in params:
+                entreprises.append({"siren": "222", "matching_etablissements": [{"siret": "2220001", "commune": "c1"}]})
+            return {"success": True, "results": entreprises, "total_pages": 1, "total_results": len(entreprises)}
+
+        mock_fetch_first.side_effect = fake_fetch
+        with patch.object(config, "API_MATCHING_ETABLISSEMENTS_LIMIT", 2):
+            entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(["c1", "c2", "c3"], {}, force_full_fetch=True)
+            completion_codes = sorted(recorded.args[1]["code_commune"] for recorded in mock_fetch_first.call_args_list if recorded.args[1].get("q") == "111")
+            async_entreprises = asyncio.run(api_client.rechercher_entreprises_async(["c1", "c2", "c3"], {}, force_full_fetch=True))
+
+        for found in (entreprises, async_entreprises):
+            sirets = {entreprise["siren"]: sorted(etab["siret"] for etab in entreprise["matching_etablissements"]) for entreprise in found}
+            self.assertEqual(sirets, {"111": sorted(etab_codes), "222": ["2220001"]})
+        # Batches c1,c2 and c3 both hit the limit for 111; c1,c2 is halved until each call stays under it
+        self.assertEqual(completion_codes, ["c1", "c1,c2", "c2", "c3"])
+
+    @patch("api_client.fetch_first_page")
+    def test_near_point_search_queries_point_and_radius(self, mock_fetch_first):
+        mock_fetch_first.side_effect = lambda url, params, headers, **kwargs: {
+            "success": True, "results": [{"siren": params["activite_principale"][:2], "matching_etablissements": []}],
+            "total_pages": 1, "total_results": 1,
+        }
+        events = []
+        with patch.object(config, "MAX_NAF_CODES_PER_API_CALL", 1):
+            entreprises = api_client.rechercher_entreprises_autour_du_point(
+                48.86, 2.34, 80, {"activite_principale": "62.01Z,70.22Z"}, force_full_fetch=True, on_event=events.append
+            )
+
+        self.assertEqual(sorted(entreprise["siren"] for entreprise in entreprises), ["62", "70"])  # One query per NAF group
+        url, params = mock_fetch_first.call_args.args[:2]
+        self.assertTrue(url.endswith("/near_point"))
+        self.assertEqual((params["lat"], params["long"], params["radius"]), ("48.860000", "2.340000", str(config.NEAR_POINT_MAX_RADIUS_KM)))
+        self.assertNotIn("code_postal", params)
+        self.assertTrue(any(event["type"] == "error" and "Rayon" in event["message"] for event in events))  # Radius capped
+        self.assertFalse(any(event["type"] == "search_planning" for event in events))  # No postal batches to plan
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_near_point_search_job_is_stored_and_resumed(self, mock_fetch_first, mock_fetch_page):
+        api_client.search_job_store = self._search_job_store()
+        mock_fetch_first.return_value = {
+            "success": True, "results": [{"siren": "111", "matching_etablissements": []}], "total_pages": 2, "total_results": 30,
+        }
+        page_2_available = False
+
+        def fake_fetch_page(page_num, params, url, headers, cancel_event=None, on_event=None):
+            if not page_2_available:
+                return {"status": "error", "message": "Échec page 2", "results": []}
+            return {"status": "success", "message": "", "results": [{"siren": "222", "matching_etablissements": []}]}
+
+        mock_fetch_page.side_effect = fake_fetch_page
+        first_run = api_client.rechercher_entreprises_autour_du_point(48.86, 2.34, 5, {"activite_principale": "62.01Z"})
+        self.assertEqual([entreprise["siren"] for entreprise in first_run], ["111"])
+
+        page_2_available = True
+        mock_fetch_first.reset_mock()
+        resumed_run = list(api_client.iter_entreprises_autour_du_point(48.86, 2.34, 5, {"activite_principale": "62.01Z"}))
+
+        mock_fetch_first.assert_not_called()  # Page 1 comes from the interrupted job
+        self.assertEqual(sorted(entreprise["siren"] for chunk in resumed_run for entreprise in chunk), ["111", "222"])
+
+    @patch("api_client.fetch_first_page")
+    def test_iter_entreprises_raises_search_interrupted(self, mock_fetch_first):
+        mock_fetch_first.return_value = {
+            "success": True, "results": [{"siren": "123"}],
+            "total_pages": config.API_MAX_PAGES + 5, "total_results": (config.API_MAX_PAGES + 5) * 25,
+        }
+        with self.assertRaises(api_client.SearchInterrupted) as raised:
+            list(api_client.iter_entreprises_par_localisation(["75001"], {"activite_principale": "XYZ"}))
+        self.assertEqual(raised.exception.search_result["status_code"], "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN")
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_iter_entreprises_close_cancels_remaining_pages(self, mock_fetch_first, mock_fetch_page):
+        cancel_events_seen = []
+        mock_fetch_first.return_value = {
+            "success": True, "results": [{"siren": "111", "matching_etablissements": []}], "total_pages": 3, "total_results": 60,
+        }
+
+        def fake_fetch_page(page_num, params, url, headers, cancel_event=None, on_event=None):
+            cancel_events_seen.append(cancel_event)
+            cancel_event.wait(timeout=5)
+            return {"status": "cancelled", "message": "", "results": []}
+
+        mock_fetch_page.side_effect = fake_fetch_page
+        events = []
+        stream = api_client.iter_entreprises_par_localisation(["75001"], {"activite_principale": "XYZ"}, on_event=events.append)
+        self.assertEqual([e["siren"] for e in next(stream)], ["111"])
+        start = time.monotonic()
+        stream.close()  # Consumer stops after the first chunk
+
+        self.assertLess(time.monotonic() - start, 2)  # In-flight pages were cancelled, not awaited to their end
+        self.assertTrue(all(event.is_set() for event in cancel_events_seen))
+        self.assertEqual(events[-1]["type"], "search_finished")
+        self.assertEqual(events[-1]["outcome"], "interrupted")
+
     @patch("api_client.fetch_first_page")
     def test_rechercher_first_page_fail_initial_search(
-        self, mock_fetch_first, mock_st_glob
+        self, mock_fetch_first
     ):
         mock_fetch_first.return_value = {
             "success": False,
@@ -385,9 +1716,195 @@ class TestApiClient(unittest.TestCase):
         self.assertIsNone(
             result
         )  # Indicates critical failure on first batch of initial search
-        # Error message should be handled by st.status within the function, or st.error
-        # We can check if st.error was called if we mock it specifically on mock_st_glob
-        # For now, assume the function's internal st.status handles it.
+
+    @patch("streamlit_progress.st")
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_streamlit_progress_adapter_renders_search_events(self, mock_fetch_first, mock_fetch_page, mock_st):
+        mock_fetch_first.return_value = {
+            "success": True, "results": [{"siren": "111", "matching_etablissements": []}], "total_pages": 2, "total_results": 30,
+        }
+        mock_fetch_page.return_value = {"status": "error", "message": "Page 2: boom", "results": []}
+
+        progress = streamlit_progress.StreamlitSearchProgress()
+        result = api_client.rechercher_entreprises_par_localisation_et_criteres(["75001"], {"activite_principale": "XYZ"}, on_event=progress)
+
+        self.assertEqual([r["siren"] for r in result], ["111"])
+        mock_st.error.assert_called_once_with("Lot 1: Page 2: boom")
+        mock_st.progress.return_value.progress.assert_called_with(1.0)
+        mock_st.progress.return_value.empty.assert_called_once()
+        mock_st.empty.return_value.text.assert_called_with("Traitement final de 1 entreprises uniques (par SIREN).")
+
+    # --- Tests for rechercher_entreprises_async ---
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_async_search_runs_batches_concurrently_and_deduplicates(
+        self, mock_fetch_first, mock_fetch_page
+    ):
+        # Both page-1 probes must be in flight at the same time to pass the barrier.
+        barrier = threading.Barrier(2, timeout=5)
+        page1_by_codes = {
+            "code_1,code_2": [{"siren": "111", "matching_etablissements": [{"siret": "1110001"}]}],
+            "code_3": [{"siren": "111", "matching_etablissements": [{"siret": "1110002"}]}],
+        }
+
+        def fake_first_page(url, params, headers, **kwargs):
+            barrier.wait()
+            return {
+                "success": True,
+                "results": page1_by_codes[params["code_postal"]],
+                "total_pages": 2 if params["code_postal"] == "code_3" else 1,
+                "total_results": 2,
+                "error_message": None,
+            }
+
+        mock_fetch_first.side_effect = fake_first_page
+        mock_fetch_page.return_value = {
+            "status": "success",
+            "message": "",
+            "results": [{"siren": "222", "matching_etablissements": [{"siret": "2220001"}]}],
+        }
+
+        result = asyncio.run(
+            api_client.rechercher_entreprises_async(
+                ["code_1", "code_2", "code_3"], {"activite_principale": "XYZ"}, False, "postal"
+            )
+        )
+
+        self.assertEqual({r["siren"] for r in result}, {"111", "222"})
+        siren_111 = next(r for r in result if r["siren"] == "111")
+        self.assertEqual(len(siren_111["matching_etablissements"]), 2)
+        mock_fetch_page.assert_called_once()
+        self.assertEqual(mock_fetch_page.call_args[0][0], 2)  # Page 2 of the second batch
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_async_search_needs_confirmation(self, mock_fetch_first, mock_fetch_page):
+        mock_fetch_first.return_value = {
+            "success": True,
+            "results": [{"siren": "123"}],
+            "total_pages": config.API_MAX_PAGES,
+            "total_results": config.API_MAX_TOTAL_RESULTS,
+            "error_message": None,
+        }
+
+        result = asyncio.run(
+            api_client.rechercher_entreprises_async(["75001"], {"activite_principale": "XYZ"}, False, "postal")
+        )
+
+        self.assertEqual(result["status_code"], "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN")
+        mock_fetch_page.assert_not_called()
+
+    @patch("api_client.fetch_first_page")
+    def test_async_search_first_batch_failure_returns_none(self, mock_fetch_first):
+        mock_fetch_first.return_value = {"success": False, "error_message": "boom"}
+        result = asyncio.run(
+            api_client.rechercher_entreprises_async(["75001"], {"activite_principale": "XYZ"})
+        )
+        self.assertIsNone(result)
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_async_search_worker_exception_does_not_fail_search(
+        self, mock_fetch_first, mock_fetch_page
+    ):
+        mock_fetch_first.return_value = {
+            "success": True,
+            "results": [{"siren": "111", "matching_etablissements": []}],
+            "total_pages": 3,
+            "total_results": 60,
+        }
+        mock_fetch_page.side_effect = [
+            KeyError("results"),
+            {"status": "success", "message": "", "results": [{"siren": "222", "matching_etablissements": []}]},
+        ]
+
+        events = []
+        result = asyncio.run(
+            api_client.rechercher_entreprises_async(
+                ["75001"], {"activite_principale": "XYZ"}, False, "postal", max_concurrency=1, on_event=events.append
+            )
+        )
+
+        self.assertEqual({r["siren"] for r in result}, {"111", "222"})
+        errors = [e for e in events if e["type"] == "error"]
+        self.assertEqual(len(errors), 1)  # The failing page is reported, the search goes on
+        self.assertIn("progress", {e["type"] for e in events})
+        # Same outcome as the synchronous engine: a failed page makes the search incomplete
+        self.assertEqual([e["outcome"] for e in events if e["type"] == "search_finished"], ["incomplete"])
+
+    @patch("api_client.fetch_first_page")
+    def test_async_search_early_exit_resolved_in_batch_order(self, mock_fetch_first):
+        batch2_answered = threading.Event()
+
+        def fake_first_page(url, params, headers, **kwargs):
+            if params["code_postal"] == "code_1,code_2":
+                batch2_answered.wait(timeout=5)
+                return {"success": False, "error_message": "boom"}
+            batch2_answered.set()
+            return {"success": True, "results": [], "total_pages": config.API_MAX_PAGES, "total_results": config.API_MAX_TOTAL_RESULTS}
+
+        mock_fetch_first.side_effect = fake_first_page
+        result = asyncio.run(
+            api_client.rechercher_entreprises_async(["code_1", "code_2", "code_3"], {"activite_principale": "XYZ"}, False, "postal")
+        )
+        self.assertIsNone(result)
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_async_search_abort_cancels_and_waits_for_in_flight_pages(
+        self, mock_fetch_first, mock_fetch_page
+    ):
+        page_in_flight = threading.Event()
+        finished_pages = []
+
+        def fake_first_page(url, params, headers, **kwargs):
+            if params["code_postal"] == "code_3":
+                page_in_flight.wait(timeout=5)
+                return {"success": True, "results": [], "total_pages": config.API_MAX_PAGES, "total_results": config.API_MAX_TOTAL_RESULTS}
+            return {"success": True, "results": [], "total_pages": 2, "total_results": 30}
+
+        def fake_fetch_page(page_num, params, url, headers, cancel_event=None, on_event=None):
+            page_in_flight.set()
+            cancel_event.wait(timeout=5)
+            finished_pages.append(page_num)
+            return {"status": "cancelled", "message": "", "results": []}
+
+        mock_fetch_first.side_effect = fake_first_page
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        result = asyncio.run(
+            api_client.rechercher_entreprises_async(["code_1", "code_2", "code_3"], {"activite_principale": "XYZ"}, False, "postal")
+        )
+
+        self.assertEqual(result["status_code"], "NEEDS_USER_CONFIRMATION_OR_BREAKDOWN")
+        self.assertEqual(finished_pages, [2])  # In-flight page finished before the coroutine returned
+
+    @patch("api_client.fetch_page_with_retry")
+    @patch("api_client.fetch_first_page")
+    def test_async_search_cancellation_stops_scheduler(self, mock_fetch_first, mock_fetch_page):
+        page_in_flight = threading.Event()
+        finished_pages = []
+        mock_fetch_first.return_value = {"success": True, "results": [], "total_pages": 3, "total_results": 60}
+
+        def fake_fetch_page(page_num, params, url, headers, cancel_event=None, on_event=None):
+            page_in_flight.set()
+            cancel_event.wait(timeout=5)
+            finished_pages.append(page_num)
+            return {"status": "cancelled", "message": "", "results": []}
+
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        async def cancel_during_search():
+            search = asyncio.ensure_future(api_client.rechercher_entreprises_async(["75001"], {}, False, "postal"))
+            await asyncio.to_thread(page_in_flight.wait, 5)
+            search.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await search
+
+        asyncio.run(cancel_during_search())
+        self.assertEqual(sorted(finished_pages), [2, 3])  # In-flight pages ended before the cancellation propagated
 
 
 if __name__ == "__main__":
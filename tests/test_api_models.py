@@ -0,0 +1,115 @@
+import json
+import os
+
+# Ensure the path is set up correctly
+import sys
+import unittest
+from unittest.mock import patch
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_models  # Module to test
+import data_utils
+
+API_PAGE = {
+    "results": [
+        {
+            "siren": "123456789",
+            "nom_complet": "BOULANGERIE DUPONT",
+            "nom_raison_sociale": "DUPONT SARL",
+            "sigle": None,
+            "date_creation": "2001-05-12",
+            "nombre_etablissements": 3,
+            "nombre_etablissements_ouverts": 2,
+            "activite_principale": "10.71C",
+            "section_activite_principale": "C",
+            "tranche_effectif_salarie": "11",
+            "categorie_entreprise": "PME",
+            "finances": {"2021": {"ca": 1000, "resultat_net": 10}, "2022": {"ca": 1200, "resultat_net": 12}},
+            "matching_etablissements": [
+                {
+                    "siret": "12345678900011",
+                    "etat_administratif": "A",
+                    "tranche_effectif_salarie": "11",
+                    "annee_tranche_effectif_salarie": "2022",
+                    "activite_principale": "10.71C",
+                    "adresse": "1 RUE DU PAIN 75001 PARIS",
+                    "code_postal": "75001",
+                    "commune": "75101",
+                    "libelle_commune": "PARIS",
+                    "latitude": "48.86",
+                    "longitude": "2.34",
+                    "est_siege": True,
+                    "liste_enseignes": ["AU BON PAIN"],
+                    "liste_idcc": ["0843"],
+                    "date_debut_activite": "2001-05-12",
+                },
+                {
+                    "siret": "12345678900029",
+                    "etat_administratif": "A",
+                    "tranche_effectif_salarie": "03",
+                    "adresse": "2 RUE DU PAIN 75002 PARIS",
+                    "code_postal": "75002",
+                    "est_siege": False,
+                    "liste_enseignes": None,
+                },
+            ],
+        },
+        {"siren": "987654321", "nom_complet": None, "nom_raison_sociale": "ACME", "matching_etablissements": []},
+    ],
+    "total_results": 2,
+    "page": 1,
+    "per_page": 25,
+    "total_pages": 1,
+}
+
+
+class TestApiModels(unittest.TestCase):
+    def test_decode_page_keeps_only_used_fields(self):
+        page = api_models.decode_page(json.dumps(API_PAGE).encode("utf-8"))
+
+        self.assertEqual((page["total_results"], page["total_pages"]), (2, 1))
+        entreprise = page["results"][0]
+        self.assertIsInstance(entreprise, api_models.Entreprise)
+        self.assertIsInstance(entreprise["matching_etablissements"][0], api_models.Etablissement)
+        self.assertEqual(entreprise.finances, {"2022": {"ca": 1200, "resultat_net": 12}})  # Latest year only
+        self.assertFalse(hasattr(entreprise, "__dict__"))  # Slotted: no per-object dictionary
+        self.assertNotIn("categorie_entreprise", entreprise.to_dict())
+        self.assertNotIn("liste_idcc", entreprise["matching_etablissements"][0].to_dict())
+
+    def test_records_read_like_api_dictionaries(self):
+        entreprise = api_models.Entreprise.from_api(API_PAGE["results"][1])
+
+        self.assertEqual(entreprise.get("siren"), "987654321")
+        self.assertEqual(entreprise["nom_raison_sociale"], "ACME")
+        self.assertEqual(entreprise.get("nom_complet", ""), "")  # A null field falls back to the default
+        self.assertEqual(entreprise.get("finances", {}), {})
+        self.assertNotIn("finances", entreprise)
+        with self.assertRaises(KeyError):
+            entreprise["categorie_entreprise"]
+        entreprise["matching_etablissements"] = [api_models.Etablissement(siret="1")]
+        copy = api_models.with_etablissements(entreprise, [])
+        self.assertEqual((copy.siren, copy.matching_etablissements), ("987654321", []))
+        self.assertEqual(len(entreprise.matching_etablissements), 1)
+        self.assertEqual(api_models.with_etablissements({"siren": "1"}, []), {"siren": "1", "matching_etablissements": []})
+
+    def test_dumps_round_trip_with_and_without_orjson(self):
+        page = api_models.decode_page(json.dumps(API_PAGE))
+        with patch.object(api_models, "orjson", None):
+            body = api_models.dumps(page)
+            self.assertEqual(api_models.decode_page(body), page)
+        self.assertEqual(api_models.decode_page(api_models.dumps(page)), page)
+
+    def test_traitement_reponse_api_same_frame_from_decoded_page(self):
+        effectifs = ["03", "11"]
+        df_dicts = data_utils.traitement_reponse_api(json.loads(json.dumps(API_PAGE))["results"], effectifs)
+        df_models = data_utils.traitement_reponse_api(api_models.decode_page(json.dumps(API_PAGE))["results"], effectifs)
+
+        pd.testing.assert_frame_equal(df_models, df_dicts)
+        self.assertEqual(len(df_models), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+
+# Ensure the path is set up correctly
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import data_utils  # Module to test
+
+
+class TestDataUtils(unittest.TestCase):
+    def test_haversine_km_matches_known_distance(self):
+        # Paris (Notre-Dame) to Lyon (Bellecour): about 392 km
+        distances = data_utils.haversine_km(48.8530, 2.3499, [48.8530, 45.7578], [2.3499, 4.8320])
+        self.assertAlmostEqual(distances[0], 0.0)
+        self.assertAlmostEqual(distances[1], 392, delta=2)
+        self.assertTrue(np.isnan(data_utils.haversine_km(48.85, 2.35, [np.nan], [2.35])[0]))
+
+    def test_filtrer_par_rayon_drops_far_establishments_and_adds_distance(self):
+        df_resultats = pd.DataFrame({
+            "SIRET": ["1", "2", "3", "4"],
+            "Commune": ["Paris", "Paris", "Versailles", "Inconnue"],
+            "Adresse établissement": ["a", "b", "c", "d"],
+            "Latitude": [48.8530, 48.8600, 48.8049, np.nan],
+            "Longitude": [2.3499, 2.3499, 2.1204, np.nan],
+        })
+
+        df_in_radius = data_utils.filtrer_par_rayon(df_resultats, 48.8530, 2.3499, 5)
+
+        self.assertEqual(list(df_in_radius["SIRET"]), ["1", "2", "4"])  # Versailles is ~17 km away, no coordinates is kept
+        self.assertEqual(list(df_in_radius.columns).index("Distance (km)"), list(df_in_radius.columns).index("Commune") + 1)
+        self.assertEqual(df_in_radius["Distance (km)"].iloc[1], 0.8)
+        self.assertTrue(pd.isna(df_in_radius["Distance (km)"].iloc[2]))
+        self.assertNotIn("Distance (km)", df_resultats.columns)  # The input frame is left untouched
+
+    def test_filtrer_par_rayon_passes_through_empty_results(self):
+        self.assertTrue(data_utils.filtrer_par_rayon(pd.DataFrame(), 48.85, 2.35, 5).empty)
+
+
+if __name__ == "__main__":
+    unittest.main()
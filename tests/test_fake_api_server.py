@@ -0,0 +1,219 @@
+import os
+import shutil
+
+# Ensure the path is set up correctly
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import api_client
+import config
+import fake_api_server  # Module to test
+
+
+class TestFakeDataset(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dataset = fake_api_server.FakeDataset(2000, seed=1)
+
+    def test_dataset_is_reproducible(self):
+        other = fake_api_server.FakeDataset(2000, seed=1)
+        self.assertEqual(self.dataset.companies[123], other.companies[123])
+
+    def test_paging_honours_page_and_per_page(self):
+        params = {"code_postal": "75001,75002", "per_page": "25"}
+        page1 = self.dataset.page(dict(params, page="1"))
+        page2 = self.dataset.page(dict(params, page="2"))
+        self.assertEqual(page1["per_page"], 25)
+        self.assertEqual(page1["total_pages"], -(-page1["total_results"] // 25))
+        self.assertEqual(len(page1["results"]), min(25, page1["total_results"]))
+        sirens = [result["siren"] for result in page1["results"] + page2["results"]]
+        self.assertEqual(len(sirens), len(set(sirens)))
+        self.assertEqual(self.dataset.page(dict(params, per_page="100"))["per_page"], fake_api_server.MAX_PER_PAGE)
+
+    def test_filters_and_matching_etablissements(self):
+        params = {"code_postal": "75001", "section_activite_principale": "J,M", "tranche_effectif_salarie": "11,12", "per_page": "25"}
+        body = self.dataset.page(params)
+        self.assertGreater(body["total_results"], 0)
+        for result in body["results"]:
+            self.assertIn(result["section_activite_principale"], {"J", "M"})
+            self.assertIn(result["tranche_effectif_salarie"], {"11", "12"})
+            self.assertTrue(result["matching_etablissements"])
+            self.assertTrue(all(etab["code_postal"] == "75001" for etab in result["matching_etablissements"]))
+        naf_code = body["results"][0]["activite_principale"]
+        by_naf = self.dataset.page({"code_postal": "75001", "activite_principale": naf_code})
+        self.assertTrue(all(result["activite_principale"] == naf_code for result in by_naf["results"]))
+        by_commune = self.dataset.page({"code_commune": fake_api_server.commune_for_postal_code("75001")})
+        self.assertEqual(by_commune["total_results"], self.dataset.page({"code_postal": "75001"})["total_results"])
+
+    def test_pages_beyond_result_limit_are_refused(self):
+        last_page = config.API_MAX_TOTAL_RESULTS // 25
+        self.assertIsNotNone(self.dataset.page({"code_postal": "75001", "per_page": "25", "page": str(last_page)}))
+        self.assertIsNone(self.dataset.page({"code_postal": "75001", "per_page": "25", "page": str(last_page + 1)}))
+
+    def test_near_point_filters_by_radius(self):
+        etab = self.dataset.companies[0]["etablissements"][0]
+        body = self.dataset.page({"lat": etab["latitude"], "long": etab["longitude"], "radius": "1", "per_page": "25"})
+        self.assertGreater(body["total_results"], 0)
+        for result in body["results"]:
+            for matching in result["matching_etablissements"]:
+                distance = fake_api_server._haversine_km(float(etab["latitude"]), float(etab["longitude"]), float(matching["latitude"]), float(matching["longitude"]))
+                self.assertLessEqual(distance, 1)
+
+    def test_parse_latency(self):
+        rng = fake_api_server.random.Random(0)
+        self.assertEqual(fake_api_server.parse_latency("0.2")(rng), 0.2)
+        self.assertTrue(0.1 <= fake_api_server.parse_latency("uniform:0.1:0.3")(rng) <= 0.3)
+        self.assertGreater(fake_api_server.parse_latency("lognormal:0.3:0.5")(rng), 0)
+        with self.assertRaises(ValueError):
+            fake_api_server.parse_latency("gamma:1")
+
+
+class TestFakeApiServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dataset = fake_api_server.FakeDataset(1000, seed=2)
+
+    def test_http_endpoints(self):
+        with fake_api_server.FakeApiServer(self.dataset) as server:
+            response = requests.get(f"{server.url}/search", params={"code_postal": "75001", "per_page": 5}, timeout=5)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["results"]), min(5, response.json()["total_results"]))
+            self.assertEqual(requests.get(f"{server.url}/near_point", params={"radius": 5}, timeout=5).status_code, 400)
+            self.assertEqual(requests.get(f"{server.url}/unknown", timeout=5).status_code, 404)
+            self.assertEqual(server.stats["ok"], 1)
+
+    def test_injected_429_carries_retry_after(self):
+        with fake_api_server.FakeApiServer(self.dataset, rate_429=1.0, retry_after=3) as server:
+            response = requests.get(f"{server.url}/search", params={"code_postal": "75001"}, timeout=5)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "3")
+        self.assertEqual(server.stats["throttled"], 1)
+
+    def test_max_rps_throttles_bursts(self):
+        with fake_api_server.FakeApiServer(self.dataset, max_rps=2) as server:
+            statuses = [requests.get(f"{server.url}/search", params={"code_postal": "75001"}, timeout=5).status_code for _ in range(5)]
+        self.assertEqual(statuses[:2], [200, 200])
+        self.assertIn(429, statuses[2:])
+
+    def test_stalled_request_times_out_client(self):
+        with fake_api_server.FakeApiServer(self.dataset, timeout_rate=1.0, timeout_delay=5) as server:
+            with self.assertRaises(requests.exceptions.Timeout):
+                requests.get(f"{server.url}/search", params={"code_postal": "75001"}, timeout=0.2)
+        self.assertEqual(server.stats["timeouts"], 1)
+
+    def _use_fast_client(self):
+        limiter = api_client.RateLimiter(rate=1000, burst=1000)
+        patches = [
+            patch.object(api_client, "rate_limiter", limiter),
+            patch.object(api_client, "rate_controller", api_client.AdaptiveRateController(limiter, min_rate=1, max_rate=1000, state_file=None)),
+            patch.object(api_client, "page_cache", None),
+            patch.object(api_client, "result_count_store", None),
+            patch.object(api_client, "search_job_store", None),
+            patch.object(api_client, "single_flight", api_client.SingleFlight()),
+            patch.object(config, "BATCH_PLANNER_PROBE_UNKNOWN", False),
+            patch.object(config, "INITIAL_RETRY_DELAY", 0.01),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_search_against_fake_server(self):
+        # Full client path (batches, paging, 429 retries) against the local server instead of the live API
+        self._use_fast_client()
+        codes = ["75001", "75002", "69001"]
+        params = {"section_activite_principale": "C,G,J,M", "tranche_effectif_salarie": "11,12,21"}
+        expected = {result[0]["siren"] for result in self.dataset.matching(self.dataset.query_key(dict(params, code_postal=",".join(codes))))}
+
+        with fake_api_server.FakeApiServer(self.dataset, rate_429=0.5, retry_after=0, seed=3) as server:
+            with patch.object(config, "API_BASE_URL", server.url):
+                entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(
+                    codes, params, force_full_fetch=True, code_type="postal", on_event=lambda event: None
+                )
+
+        self.assertEqual({entreprise["siren"] for entreprise in entreprises}, expected)
+        self.assertGreater(server.stats["throttled"], 0)
+
+    def test_cold_planned_search_sends_no_more_requests_than_fixed_batches(self):
+        default_probe_unknown = config.BATCH_PLANNER_PROBE_UNKNOWN  # Before _use_fast_client patches it
+        self._use_fast_client()
+        codes = self.dataset.postal_codes[:20]
+        params = {"section_activite_principale": "C,G,J,M"}
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir, True)
+
+        def search(count_store, probe_unknown):
+            with patch.object(api_client, "result_count_store", count_store), \
+                    patch.object(config, "BATCH_PLANNER_PROBE_UNKNOWN", probe_unknown), \
+                    fake_api_server.FakeApiServer(self.dataset) as server, patch.object(config, "API_BASE_URL", server.url):
+                entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(
+                    codes, params, force_full_fetch=True, code_type="postal", on_event=lambda event: None
+                )
+            return server.stats["requests"], {entreprise["siren"] for entreprise in entreprises}
+
+        baseline_requests, baseline_sirens = search(None, False)  # Fixed MAX_CODES_PER_API_CALL batches
+        count_store = api_client.ResultCountStore(os.path.join(store_dir, "counts.sqlite3"), ttl_seconds=3600)
+        self.addCleanup(count_store.close)
+        cold_requests, cold_sirens = search(count_store, default_probe_unknown)
+        warm_requests, warm_sirens = search(count_store, default_probe_unknown)
+
+        self.assertEqual(cold_sirens, baseline_sirens)
+        self.assertEqual(warm_sirens, baseline_sirens)
+        self.assertLessEqual(cold_requests, baseline_requests)  # No count probe on a cold store
+        self.assertLessEqual(warm_requests, baseline_requests)
+
+    def test_large_companies_completed_beyond_matching_limit(self):
+        self._use_fast_client()
+        dataset = fake_api_server.FakeDataset(300, seed=5, large_companies=2, large_company_size=80)
+        codes = dataset.postal_codes[:12]
+        patcher = patch.object(config, "API_MATCHING_ETABLISSEMENTS_LIMIT", 20)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        events = []
+
+        with fake_api_server.FakeApiServer(dataset) as server:
+            with patch.object(config, "API_BASE_URL", server.url):
+                entreprises = api_client.rechercher_entreprises_par_localisation_et_criteres(
+                    codes, {}, force_full_fetch=True, code_type="postal", on_event=events.append
+                )
+
+        expected_query = dataset.query_key(dict(api_client._build_search_params({}), code_postal=",".join(codes)))
+        expected = {company["siren"]: {etab["siret"] for etab in etabs} for company, etabs in dataset.matching(expected_query)}
+        found = {entreprise["siren"]: {etab["siret"] for etab in entreprise["matching_etablissements"]} for entreprise in entreprises}
+        chain_sirens = [siren for siren, sirets in expected.items() if len(sirets) > 20]
+        self.assertTrue(chain_sirens)
+        for siren in chain_sirens:  # Every establishment of the chains, beyond the limit of 20 per company
+            self.assertEqual(found[siren], expected[siren])
+        completion = next(event for event in events if event["type"] == "completion_finished")
+        self.assertEqual((completion["entreprises"], completion["failed_requests"]), (len(chain_sirens), 0))
+
+    def test_near_point_search_against_fake_server(self):
+        self._use_fast_client()
+        etab = self.dataset.companies[0]["etablissements"][0]
+        latitude, longitude = float(etab["latitude"]), float(etab["longitude"])
+        params = {"section_activite_principale": "C,G,J,M"}
+        events = []
+
+        with fake_api_server.FakeApiServer(self.dataset, rate_429=0.3, retry_after=0, seed=4) as server:
+            with patch.object(config, "API_BASE_URL", server.url):
+                entreprises = api_client.rechercher_entreprises_autour_du_point(
+                    latitude, longitude, 3, params, force_full_fetch=True, on_event=events.append
+                )
+
+        expected_query = self.dataset.query_key(dict(api_client._build_search_params(params), lat=str(latitude), long=str(longitude), radius="3"))
+        expected = {result[0]["siren"]: {e["siret"] for e in result[1]} for result in self.dataset.matching(expected_query)}
+        self.assertTrue(expected)
+        self.assertEqual({entreprise["siren"] for entreprise in entreprises}, set(expected))
+        for entreprise in entreprises:  # Only establishments inside the circle are returned
+            self.assertEqual({e["siret"] for e in entreprise["matching_etablissements"]}, expected[entreprise["siren"]])
+        started = next(event for event in events if event["type"] == "search_started")
+        self.assertEqual((started["code_type"], started["total_batches"]), ("point", 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
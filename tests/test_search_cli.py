@@ -0,0 +1,95 @@
+import os
+import shutil
+
+# Ensure the path is set up correctly
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import search_cli  # Module to test
+
+
+class TestSearchCli(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+
+    def test_read_search_rows_csv_and_jsonl(self):
+        csv_path = os.path.join(self.tmp_dir, "recherches.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write('id,adresse,rayon_km,sections,codes_naf,effectifs\n')
+            f.write('alice,"1 rue de Rivoli, Paris",5,"j, m",,"11,12"\n')
+        jsonl_path = os.path.join(self.tmp_dir, "recherches.jsonl")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            f.write('{"adresse": "Lyon", "rayon_km": 10, "codes_naf": ["62.01Z"], "effectifs": ["21"], "mode": "Rayon"}\n')
+
+        csv_row, = search_cli.read_search_rows(csv_path)
+        self.assertEqual(csv_row["sections"], ["J", "M"])
+        self.assertEqual(csv_row["effectifs"], ["11", "12"])
+        self.assertEqual(csv_row["mode"], "codes_postaux")  # Default mode
+        jsonl_row, = search_cli.read_search_rows(jsonl_path)
+        self.assertEqual(jsonl_row["id"], "1")  # Line number when no id is given
+        self.assertEqual(jsonl_row["codes_naf"], ["62.01Z"])
+        self.assertEqual(jsonl_row["mode"], "rayon")
+
+    @patch("search_cli.data_utils.traitement_reponse_api")
+    @patch("search_cli.api_client.rechercher_entreprises_par_localisation_et_criteres")
+    @patch("search_cli.geo_utils.get_communes_in_radius_cached")
+    @patch("search_cli.geo_utils.geocoder_ban_france")
+    def test_run_search_row_writes_results_and_report(self, mock_geocode, mock_communes, mock_search, mock_traitement):
+        mock_geocode.return_value = (48.86, 2.34)
+        mock_communes.return_value = ["75001", "75002"]
+
+        def fake_search(codes, api_params, force_full_fetch, code_type, on_event):
+            on_event({"type": "page_fetched", "label": "Lot 1", "page": 1, "success": True})
+            on_event({"type": "throttled", "page": 2, "retry_after": 1.0})
+            return [{"siren": "111"}]
+
+        mock_search.side_effect = fake_search
+        mock_traitement.return_value = pd.DataFrame({"SIRET": ["11100001", "11100002"], "code_naf_etablissement": ["62.01Z", "70.22Z"]})
+        row = {"id": "alice/1", "adresse": "Paris", "rayon_km": 5.0, "sections": [], "codes_naf": ["62.01Z"], "effectifs": ["11"]}
+
+        report = search_cli.run_search_row(row, self.tmp_dir, "csv")
+
+        self.assertEqual(report["statut"], "ok")
+        self.assertEqual((report["pages"], report["reponses_429"], report["etablissements"]), (1, 1, 1))
+        _, api_params = mock_search.call_args.args
+        self.assertEqual(api_params["activite_principale"], "62.01Z")  # Specific codes are filtered by the API
+        self.assertNotIn("section_activite_principale", api_params)
+        self.assertEqual(mock_search.call_args.kwargs["force_full_fetch"], True)
+        self.assertEqual(os.path.basename(report["fichier"]), "alice_1.csv")
+        self.assertEqual(list(pd.read_csv(report["fichier"])["SIRET"]), [11100001])
+
+    @patch("search_cli.data_utils.traitement_reponse_api")
+    @patch("search_cli.api_client.rechercher_entreprises_autour_du_point")
+    @patch("search_cli.geo_utils.get_communes_in_radius_cached")
+    @patch("search_cli.geo_utils.geocoder_ban_france")
+    def test_run_search_row_radius_mode_skips_postal_codes(self, mock_geocode, mock_communes, mock_search, mock_traitement):
+        mock_geocode.return_value = (48.86, 2.34)
+        mock_search.return_value = [{"siren": "111"}]
+        mock_traitement.return_value = pd.DataFrame({"SIRET": ["11100001"]})
+        row = {"id": "1", "adresse": "Paris", "rayon_km": 3.0, "sections": ["J"], "codes_naf": [], "effectifs": ["11"], "mode": "rayon"}
+
+        report = search_cli.run_search_row(row, self.tmp_dir, "csv")
+
+        self.assertEqual(report["statut"], "ok")
+        mock_communes.assert_not_called()
+        self.assertEqual(mock_search.call_args.args[:3], (48.86, 2.34, 3.0))
+        self.assertEqual(search_cli.run_search_row(dict(row, mode="cercle"), self.tmp_dir, "csv")["statut"], "erreur")
+
+    @patch("search_cli.geo_utils.geocoder_ban_france")
+    def test_run_search_row_reports_geocoding_failure(self, mock_geocode):
+        mock_geocode.return_value = None
+        row = {"id": "1", "adresse": "Nulle part", "rayon_km": 5.0, "sections": ["J"], "codes_naf": [], "effectifs": ["11"]}
+        report = search_cli.run_search_row(row, self.tmp_dir, "csv")
+        self.assertEqual(report["statut"], "erreur")
+        self.assertIn("Nulle part", report["message"])
+
+
+if __name__ == "__main__":
+    unittest.main()